@@ -0,0 +1,450 @@
+"""
+Name: Asyncio storage and compute engine
+
+Purpose: Asyncio versions of the upload, download, exists, list, get_instance and wait_for_operation functions, so
+         services running on an event loop can make thousands of concurrent calls without a thread per call.
+         Results are the same as the blocking functions of upload.py, download.py, sync.py and vm_manager.py
+
+Note: Requires aiohttp 3.11 or later (pip install aiohttp). Shared clients are closed with aclose() before the event
+      loop stops
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+from urllib.parse import quote
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from checksums import file_checksum, new_checksum
+from clients import get_endpoint
+from compression import GZIP, UNCOMPRESSED_CHECKSUM_KEYS, compression_of, decompressor, guess_mimetype
+from config import logger, PROJECT_NAME, STORAGE_BUCKET, STORAGE_SCOPE, COMPUTE_SCOPE, get_cached_credentials
+from download import CHUNK_SIZE
+from inventory import PAGE_SIZE
+from operations import OperationError, OperationTimeout, OPERATION_TIMEOUT, MIN_POLL_INTERVAL, MAX_POLL_INTERVAL
+from vm_manager import DEFAULT_VM_ZONE
+
+
+STORAGE_API_ROOT = 'https://storage.googleapis.com'
+COMPUTE_API_ROOT = 'https://compute.googleapis.com/compute/v1'
+
+MAX_CONCURRENCY = 256   # Maximum number of requests in flight at the same time, for all calls of a client
+POOL_SIZE = 100         # Maximum number of open keep-alive connections of a client
+TOKEN_MARGIN = 60       # Access tokens expiring within this many seconds are refreshed before a request
+
+
+class HttpStatusError(Exception):
+    """
+    Raised when the api answers with an unexpected status
+    """
+
+    def __init__(self, status, content):
+        super(HttpStatusError, self).__init__("HTTP %d: %s" % (status, content[:200]))
+        self.status = status
+        self.content = content
+
+
+class AsyncClient(object):
+    """
+    Connection pool, concurrency limit and access tokens shared by every call made on one event loop.
+
+    Access tokens come from the credential cache of config.py, so blocking and asyncio code share the same tokens.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, pool_size=POOL_SIZE):
+        """
+        :param max_concurrency: Maximum number of requests in flight at the same time
+        :param pool_size: Maximum number of open keep-alive connections
+        """
+        if aiohttp is None:
+            raise ImportError("aio requires aiohttp (pip install aiohttp)")
+        self.pool_size = pool_size
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+        self._credentials = {}
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+        return self._session
+
+    async def headers(self, scope, headers=None):
+        """
+        :param scope: Oauth scope of the request
+        :param headers: Extra headers
+        :return: Headers with a valid authorization
+        """
+        if get_endpoint() is not None:
+            # Servers set by clients.set_endpoint are called without credentials
+            return dict(headers or {})
+
+        cached = self._credentials.get(scope)
+        if cached is None or (cached.expires_in() or 0) <= TOKEN_MARGIN:
+            # Minting a token is blocking, it only happens once per token lifetime
+            loop = asyncio.get_event_loop()
+            cached = await loop.run_in_executor(None, get_cached_credentials, scope)
+            await loop.run_in_executor(None, cached.refresh, TOKEN_MARGIN)
+            self._credentials[scope] = cached
+
+        result = {'Authorization': 'Bearer %s' % cached.credentials.access_token}
+        result.update(headers or {})
+        return result
+
+    async def request(self, method, url, scope, params=None, headers=None, data=None, ok=(200,)):
+        """
+        Make a request and read its whole response
+        :return: (status, response headers, content)
+        """
+        headers = await self.headers(scope, headers)
+        async with self.semaphore:
+            async with self.session.request(method, url, params=params, headers=headers, data=data) as resp:
+                content = await resp.read()
+                if resp.status not in ok:
+                    raise HttpStatusError(resp.status, content)
+                return resp.status, resp.headers, content
+
+    async def request_json(self, method, url, scope, params=None, headers=None, data=None):
+        status, _, content = await self.request(method, url, scope, params, headers, data)
+        return json.loads(content.decode('utf-8'))
+
+    async def aclose(self):
+        """
+        Close the pooled connections
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+_clients = {}
+
+
+def get_client():
+    """
+    Get the shared client of the running event loop
+    :return: AsyncClient
+    """
+    loop = asyncio.get_event_loop()
+    client = _clients.get(loop)
+    if client is None:
+        for other in list(_clients):
+            if other.is_closed():
+                del _clients[other]
+        client = _clients[loop] = AsyncClient()
+    return client
+
+
+async def aclose():
+    """
+    Close the shared client of the running event loop (ex: before asyncio.run returns)
+    """
+    client = _clients.pop(asyncio.get_event_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def _storage_root():
+    """
+    :return: Root url of the storage api, the server set by clients.set_endpoint if any
+    """
+    endpoint = get_endpoint()
+    return endpoint if endpoint is not None else STORAGE_API_ROOT
+
+
+def _object_url(bucket, name, root=''):
+    return '%s%s/storage/v1/b/%s/o/%s' % (_storage_root(), root, quote(bucket, safe=''), quote(name, safe=''))
+
+
+async def _multipart_body(local_path, preamble, epilogue):
+    """
+    Body of a multipart upload, the file read a block at a time in the default executor so it is never held in memory
+    """
+    loop = asyncio.get_event_loop()
+    yield preamble
+    with open(local_path, 'rb') as fh:
+        while True:
+            block = await loop.run_in_executor(None, fh.read, CHUNK_SIZE)
+            if not block:
+                break
+            yield block
+    yield epilogue
+
+
+def _write_block(fh, received, written, engine, block):
+    """
+    Hash a block of a download as it was received and write it, decompressed if an engine is given. Run in an executor
+    so neither the hashes nor the write hold the event loop
+    """
+    received.update(block)
+    data = engine.decompress(block) if engine is not None else block
+    if data:
+        fh.write(data)
+        written.update(data)
+
+
+async def upload_file(local_path, remote_name, bucket=STORAGE_BUCKET, client=None):
+    """
+    Upload a file to Google Storage
+    :param local_path: The local path to the file to upload
+    :param remote_name: The name of the file in the google cloud storage
+    :param bucket: The bucket on google cloud storage you want to upload the file to
+    :param client: AsyncClient to use instead of the shared one
+    :return: True if uploaded, False otherwise
+    """
+    try:
+        client = client or get_client()
+        logger.info("Uploading %s to google cloud", local_path)
+
+        loop = asyncio.get_event_loop()
+        checksum = await loop.run_in_executor(None, file_checksum, local_path)
+        size = os.path.getsize(local_path)
+        mimetype = guess_mimetype(local_path)[0]
+
+        # Multipart upload: the metadata carries the checksum so storage rejects corrupted bytes
+        boundary = uuid.uuid4().hex
+        metadata = json.dumps(dict(checksum, name=remote_name)).encode('utf-8')
+        preamble = b''.join([
+            b'--', boundary.encode(), b'\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n', metadata,
+            b'\r\n--', boundary.encode(), b'\r\nContent-Type: ', mimetype.encode(), b'\r\n\r\n',
+        ])
+        epilogue = b''.join([b'\r\n--', boundary.encode(), b'--'])
+        headers = {'Content-Type': 'multipart/related; boundary=%s' % boundary,
+                   # Known length, so the streamed body is not sent with chunked encoding
+                   'Content-Length': str(len(preamble) + size + len(epilogue))}
+        url = '%s/upload/storage/v1/b/%s/o' % (_storage_root(), quote(bucket, safe=''))
+        resp = await client.request_json('POST', url, STORAGE_SCOPE, params={'uploadType': 'multipart'},
+                                         headers=headers, data=_multipart_body(local_path, preamble, epilogue))
+
+        if int(resp.get('size', -1)) != size or any(resp.get(field) != value for field, value in checksum.items()):
+            logger.debug("Upload of %s does not match the local file", local_path)
+            return False
+
+        logger.info("Upload complete!")
+        return True
+
+    except Exception as e:
+        logger.debug("Unable to upload file %s to google cloud: %s", local_path, e)
+        return False
+
+
+async def download_file_from_storage(file_name, local_path, bucket=STORAGE_BUCKET, client=None, decompress=True):
+    """
+    Download a file from the Google Cloud storage
+    :param file_name: The name of the file on google cloud storage (include extension!)
+    :param local_path: The local path to save the downloaded file to
+    :param bucket: The bucket on Cloud
+    :param client: AsyncClient to use instead of the shared one
+    :param decompress: False to save an object compressed on upload (gzip or zstd) as it is stored, True to
+                       decompress it while it is streamed to the local file
+    :return: True if successful, False otherwise
+    """
+    try:
+        client = client or get_client()
+        logger.info("Downloading file named %s from google cloud", file_name)
+
+        if not local_path.endswith('/'):
+            local_path = local_path + '/'
+        path = local_path + file_name
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        metadata = await client.request_json('GET', _object_url(bucket, file_name), STORAGE_SCOPE,
+                                             params={'fields': 'size,crc32c,md5Hash,generation,contentEncoding,'
+                                                               'metadata'})
+        compression = compression_of(metadata)
+        engine = decompressor(compression) if compression is not None and decompress else None
+        received = new_checksum(metadata)
+        custom = metadata.get('metadata') or {}
+        # Checksums of the uncompressed file recorded by the upload, by field of an object resource
+        recorded = dict((field, custom[key]) for field, key in UNCOMPRESSED_CHECKSUM_KEYS.items() if key in custom)
+        written = new_checksum(recorded or None)
+
+        loop = asyncio.get_event_loop()
+        headers = await client.headers(STORAGE_SCOPE)
+        async with client.semaphore:
+            # The bytes are read as they are stored, which the checksums of the object are computed on: objects
+            # stored with gzip content encoding are decompressed here, once hashed
+            async with client.session.get(_object_url(bucket, file_name, '/download'),
+                                          params={'alt': 'media', 'generation': metadata['generation']},
+                                          headers=headers, auto_decompress=False) as resp:
+                if resp.status != 200:
+                    raise HttpStatusError(resp.status, await resp.read())
+                if compression == GZIP and (resp.headers.get('Content-Encoding') or '').lower() != GZIP:
+                    raise IOError("%s was not served compressed" % file_name)
+
+                with open(path, 'wb') as fh:
+                    while True:
+                        block = await resp.content.read(CHUNK_SIZE)
+                        if not block:
+                            break
+                        await loop.run_in_executor(None, _write_block, fh, received, written, engine, block)
+
+        if received.b64digest() != metadata[received.field]:
+            logger.debug("%s mismatch for %s: expected %s, got %s", received.field, file_name,
+                         metadata[received.field], received.b64digest())
+            os.remove(path)
+            return False
+
+        if engine is not None:
+            expected = recorded.get(written.field)
+            if (compression == GZIP and not engine.eof) or (expected is not None and written.b64digest() != expected):
+                logger.debug("Decompressed %s does not match the uploaded file", file_name)
+                os.remove(path)
+                return False
+
+        logger.info("Download completed!")
+        return True
+
+    except Exception as e:
+        logger.debug("Download Failed: %s", e)
+        return False
+
+
+async def check_if_file_exists(name, bucket=STORAGE_BUCKET, client=None):
+    """
+    Check if file exists on google cloud storage
+    :param name: Name of file you are checking
+    :param bucket: Bucket where you expect the file to be
+    :param client: AsyncClient to use instead of the shared one
+    :return: True if exists. False otherwise
+    """
+    client = client or get_client()
+    try:
+        await client.request('GET', _object_url(bucket, name), STORAGE_SCOPE, params={'fields': 'name'})
+        return True
+
+    except HttpStatusError as e:
+        if e.status != 404:
+            raise
+        logger.debug("Image %s does not exist on google cloud", name)
+        return False
+
+
+async def list_remote_objects(prefix, bucket=STORAGE_BUCKET, client=None):
+    """
+    List every object under a prefix
+    :param prefix: Prefix of the objects
+    :param bucket: The bucket on Cloud
+    :param client: AsyncClient to use instead of the shared one
+    :return: Dict of object name to its metadata (size, crc32c, md5Hash, generation, contentEncoding and
+             metadata, which tell whether it was compressed on upload)
+    """
+    client = client or get_client()
+    url = '%s/storage/v1/b/%s/o' % (_storage_root(), quote(bucket, safe=''))
+    params = {'prefix': prefix,
+              'fields': 'items(name,size,crc32c,md5Hash,generation,contentEncoding,metadata),nextPageToken'}
+
+    objects = {}
+    while True:
+        resp = await client.request_json('GET', url, STORAGE_SCOPE, params=params)
+        for item in resp.get('items', []):
+            objects[item['name']] = item
+        if 'nextPageToken' not in resp:
+            return objects
+        params['pageToken'] = resp['nextPageToken']
+
+
+def _zone_url(project, zone, path):
+    endpoint = get_endpoint()
+    root = endpoint + '/compute/v1' if endpoint is not None else COMPUTE_API_ROOT
+    return '%s/projects/%s/zones/%s/%s' % (root, project, zone, path)
+
+
+async def list_vm_instances(project=PROJECT_NAME, zone=DEFAULT_VM_ZONE, client=None):
+    """
+    Lists the instances of a zone
+    :param project: Name of Project
+    :param zone: Zone of the instances
+    :param client: AsyncClient to use instead of the shared one
+    :return: Dict with the list of instances under 'items', like vm_manager.list_vm_instances
+    """
+    try:
+        client = client or get_client()
+        instances = []
+        params = {'maxResults': PAGE_SIZE}
+        while True:
+            resp = await client.request_json('GET', _zone_url(project, zone, 'instances'), COMPUTE_SCOPE,
+                                             params=params)
+            instances.extend(resp.get('items', []))
+            if 'nextPageToken' not in resp:
+                return {'items': instances}
+            params['pageToken'] = resp['nextPageToken']
+
+    except Exception as e:
+        logger.debug("Unable to list instances: %s", e)
+
+
+async def get_instance(name, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME, client=None):
+    """
+    Gets the information of the instance
+
+    :param name: Name of instance as specified on google cloud
+    :param zone: Zone the VM exists in
+    :param project: Name of Project
+    :param client: AsyncClient to use instead of the shared one
+    :return: Json object containing information on instance specified
+    """
+    try:
+        logger.info("Getting information for VM %s.", name)
+        client = client or get_client()
+        return await client.request_json('GET', _zone_url(project, zone, 'instances/%s' % name), COMPUTE_SCOPE)
+
+    except Exception as e:
+        logger.debug("Failed: %s", e)
+
+
+async def wait_for_operation(project, zone, operation, client=None, timeout=OPERATION_TIMEOUT):
+    """
+    Checks if operation demanded (create/start/stop/delete) is completed, with the long-polling wait endpoint.
+    Failed checks are retried with the same jittered backoff as operations.OperationWaiter
+
+    :param project: Project name on google cloud
+    :param zone: zone the vm_instance resides in
+    :param operation: which operation is being run
+    :param client: AsyncClient to use instead of the shared one
+    :param timeout: Deadline (sec) of the operation
+    :return: 'DONE' when completed, raises OperationError if the operation failed and OperationTimeout if it is not
+             done before the deadline
+    """
+    logger.debug('Waiting for operation to finish...')
+    client = client or get_client()
+    deadline = time.time() + timeout
+    interval = MIN_POLL_INTERVAL
+
+    while True:
+        left = deadline - time.time()
+        if left <= 0:
+            raise OperationTimeout("Operation %s not done after its deadline" % operation)
+        try:
+            result = await asyncio.wait_for(
+                client.request_json('POST', _zone_url(project, zone, 'operations/%s/wait' % operation), COMPUTE_SCOPE),
+                left)
+        except Exception as e:
+            # 4xx other than rate limiting will not get better by asking again
+            if isinstance(e, HttpStatusError) and 400 <= e.status < 500 and e.status != 429:
+                raise
+            logger.debug('Checking if operation is completed failed: %s', e)
+            await asyncio.sleep(min(random.uniform(MIN_POLL_INTERVAL, interval), max(deadline - time.time(), 0)))
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+            continue
+        interval = MIN_POLL_INTERVAL
+
+        if result['status'] == 'DONE':
+            if result.get('error'):
+                raise OperationError(result)
+            return result['status']
@@ -0,0 +1,155 @@
+"""
+Name: Batched metadata operations
+
+Purpose: Check, fetch metadata of and delete many objects of a google cloud storage bucket with few round trips, by
+         packing the sub-requests into http batch requests run concurrently. Sub-requests failed with a transient
+         error (429, 5xx, network) are sent again in a later batch, with a backoff
+"""
+
+import random
+import time
+import metrics
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from apiclient.errors import HttpError
+from chunking import is_transient
+from clients import get_storage_service
+from config import logger, STORAGE_BUCKET
+
+
+BATCH_SIZE = 100        # Maximum number of sub-requests in a single batch request (limit of the storage api)
+BATCH_WORKERS = 4       # Number of batch requests executed at the same time
+BATCH_RETRIES = 5       # Retries of a sub-request failed with a transient error before its error is reported
+BATCH_BACKOFF = 0.5     # Seconds before the first retry of the failed sub-requests of a batch, doubled at each retry
+
+# Outcome of the operation on one object: result is None when error is set
+BatchItem = namedtuple('BatchItem', ['result', 'error'])
+
+
+def _is_not_found(error):
+    return isinstance(error, HttpError) and error.resp.status == 404
+
+
+def _run_batches(names, build_request, service, max_workers):
+    """
+    Execute one sub-request per name, BATCH_SIZE per batch request. The sub-requests of a batch that failed with a
+    transient error are sent again together, up to BATCH_RETRIES times
+    :param names: Object names
+    :param build_request: Function building the sub-request of a name
+    :param service: Storage service
+    :param max_workers: Number of batch requests executed at the same time
+    :return: Dict of name to (response, exception) of its sub-request
+    """
+    names = list(dict.fromkeys(names))
+    chunks = [names[i:i + BATCH_SIZE] for i in range(0, len(names), BATCH_SIZE)]
+
+    def execute(chunk, responses):
+        def callback(request_id, response, exception):
+            responses[chunk[int(request_id)]] = (response, exception)
+
+        batch = service.new_batch_http_request(callback=callback)
+        for index, name in enumerate(chunk):
+            batch.add(build_request(name), request_id=str(index))
+
+        start = time.time()
+        try:
+            batch.execute()
+        except Exception as e:
+            metrics.api_call('batch', time.time() - start, e)
+            logger.debug("Batch request of %d objects failed: %s", len(chunk), e)
+            for name in chunk:
+                if name not in responses or responses[name][1] is not None:
+                    responses[name] = (None, e)
+        else:
+            metrics.api_call('batch', time.time() - start)
+        metrics.increment('api.batched_requests', len(chunk))
+
+    def run(chunk):
+        responses = {}
+        attempt = 0
+        while True:
+            execute(chunk, responses)
+            chunk = [name for name in chunk if responses[name][1] is not None and is_transient(responses[name][1])]
+            attempt += 1
+            if not chunk or attempt > BATCH_RETRIES:
+                return responses
+            logger.debug("Sending %d sub-requests again after transient errors", len(chunk))
+            metrics.increment('batch.retries', len(chunk))
+            time.sleep(min(BATCH_BACKOFF * 2 ** (attempt - 1), 30) * random.uniform(0.5, 1))
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for responses in pool.map(run, chunks):
+            results.update(responses)
+    return results
+
+
+def exists_many(names, bucket=STORAGE_BUCKET, service=None, max_workers=BATCH_WORKERS):
+    """
+    Check if many files exist on google cloud storage
+    :param names: Names of the files
+    :param bucket: Bucket where you expect the files to be
+    :param service: Storage service to use instead of the shared one
+    :param max_workers: Number of batch requests executed at the same time
+    :return: Dict of name to BatchItem, result being True if the file exists and False if it does not
+    """
+    service = get_storage_service(service)
+    responses = _run_batches(names, lambda name: service.objects().get(bucket=bucket, object=name, fields='name'),
+                             service, max_workers)
+
+    results = {}
+    for name, (response, error) in responses.items():
+        if error is None:
+            results[name] = BatchItem(True, None)
+        elif _is_not_found(error):
+            results[name] = BatchItem(False, None)
+        else:
+            results[name] = BatchItem(None, error)
+    return results
+
+
+def get_metadata_many(names, bucket=STORAGE_BUCKET, service=None, fields=None, max_workers=BATCH_WORKERS):
+    """
+    Get the metadata of many files on google cloud storage
+    :param names: Names of the files
+    :param bucket: Bucket where you expect the files to be
+    :param service: Storage service to use instead of the shared one
+    :param fields: Partial response selector (ex: 'name,size,crc32c'), None for every field
+    :param max_workers: Number of batch requests executed at the same time
+    :return: Dict of name to BatchItem, result being the object resource (None with a 404 error if missing)
+    """
+    service = get_storage_service(service)
+
+    def build_request(name):
+        if fields:
+            return service.objects().get(bucket=bucket, object=name, fields=fields)
+        return service.objects().get(bucket=bucket, object=name)
+
+    responses = _run_batches(names, build_request, service, max_workers)
+    return dict((name, BatchItem(response if error is None else None, error))
+                for name, (response, error) in responses.items())
+
+
+def delete_many(names, bucket=STORAGE_BUCKET, service=None, max_workers=BATCH_WORKERS):
+    """
+    Delete many files from google cloud storage
+    :param names: Names of the files
+    :param bucket: Bucket the files are in
+    :param service: Storage service to use instead of the shared one
+    :param max_workers: Number of batch requests executed at the same time
+    :return: Dict of name to BatchItem, result being True if deleted and False if the file did not exist
+    """
+    service = get_storage_service(service)
+    responses = _run_batches(names, lambda name: service.objects().delete(bucket=bucket, object=name),
+                             service, max_workers)
+
+    results = {}
+    for name, (response, error) in responses.items():
+        if error is None:
+            results[name] = BatchItem(True, None)
+        elif _is_not_found(error):
+            results[name] = BatchItem(False, None)
+        else:
+            results[name] = BatchItem(None, error)
+    return results
@@ -0,0 +1,749 @@
+"""
+Name: Fake google cloud server
+
+Purpose: In-process http server implementing the part of the google cloud storage json api and of the compute engine
+         api this repository calls: objects (simple, multipart and resumable uploads, ranged and gzip media downloads,
+         list, delete, compose), batch requests, instances, disks and zone operations. Latency, bandwidth, errors and
+         the time operations take are configurable and errors are drawn from a seeded generator, so benchmarks are
+         reproducible. The discovery documents it serves only describe that subset, the functions of the repository
+         run unchanged once clients.set_endpoint(server.url) was called
+
+Usage: with FakeServer(latency=0.02, bandwidth=50 * 1024 * 1024) as server:
+           clients.set_endpoint(server.url)
+"""
+
+import base64
+import datetime
+import gzip
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, quote, unquote, urlsplit
+from checksums import Crc32c
+
+
+DEFAULT_PAGE_SIZE = 1000        # Objects per page of a listing when the client does not ask for a size
+OPERATION_SECONDS = 0.5         # Seconds a compute engine operation stays RUNNING
+WAIT_SECONDS = 2                # Longest a call of the wait endpoint of an operation is held
+REASONS = {200: 'OK', 204: 'No Content', 206: 'Partial Content', 308: 'Resume Incomplete', 400: 'Bad Request',
+           404: 'Not Found', 409: 'Conflict', 412: 'Precondition Failed', 416: 'Requested Range Not Satisfiable',
+           503: 'Service Unavailable'}
+
+Request = namedtuple('Request', ['method', 'path', 'query', 'headers', 'body'])
+
+_ZONE = ('compute', 'v1', 'projects', '*', 'zones', '*')
+_ROUTES = [
+    ('GET', ('discovery', 'v1', 'apis', '*', '*', 'rest'), '_discovery'),
+    ('POST', ('batch', '*', 'v1'), '_batch'),
+    ('GET', ('storage', 'v1', 'b', '*', 'o'), '_list_objects'),
+    ('GET', ('storage', 'v1', 'b', '*', 'o', '*'), '_get_object'),
+    ('DELETE', ('storage', 'v1', 'b', '*', 'o', '*'), '_delete_object'),
+    ('POST', ('storage', 'v1', 'b', '*', 'o', '*', 'compose'), '_compose'),
+    ('POST', ('upload', 'storage', 'v1', 'b', '*', 'o'), '_insert_object'),
+    ('PUT', ('upload', 'storage', 'v1', 'b', '*', 'o'), '_upload_chunk'),
+    ('GET', ('download', 'storage', 'v1', 'b', '*', 'o', '*'), '_get_media'),
+    ('GET', _ZONE + ('instances',), '_list_instances'),
+    ('POST', _ZONE + ('instances',), '_insert_instance'),
+    ('GET', _ZONE + ('instances', '*'), '_get_instance'),
+    ('DELETE', _ZONE + ('instances', '*'), '_delete_instance'),
+    ('POST', _ZONE + ('instances', '*', 'start'), '_start_instance'),
+    ('POST', _ZONE + ('instances', '*', 'stop'), '_stop_instance'),
+    ('POST', _ZONE + ('instances', '*', 'setMetadata'), '_set_metadata'),
+    ('GET', ('compute', 'v1', 'projects', '*', 'aggregated', 'instances'), '_aggregated_instances'),
+    ('POST', _ZONE + ('disks',), '_insert_disk'),
+    ('DELETE', _ZONE + ('disks', '*'), '_delete_disk'),
+    ('GET', _ZONE + ('operations', '*'), '_get_operation'),
+    ('POST', _ZONE + ('operations', '*', 'wait'), '_wait_operation'),
+]
+
+
+def _method(method_id, http_method, path, path_parameters=(), query_parameters=(), request=None, response=None,
+            **extra):
+    """
+    :return: Description of an api method in a discovery document
+    """
+    parameters = dict((name, {'type': 'string', 'location': 'path', 'required': True}) for name in path_parameters)
+    parameters.update((name, {'type': 'string', 'location': 'query'}) for name in query_parameters)
+    method = {'id': method_id, 'path': path, 'httpMethod': http_method, 'parameters': parameters,
+              'parameterOrder': list(path_parameters)}
+    if request is not None:
+        method['request'] = {'$ref': request}
+    if response is not None:
+        method['response'] = {'$ref': response}
+    method.update(extra)
+    return method
+
+
+def _document(name, root_url, resources, schemas):
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': '%s:v1' % name,
+        'name': name,
+        'version': 'v1',
+        'rootUrl': root_url + '/',
+        'servicePath': '%s/v1/' % name,
+        'batchPath': 'batch/%s/v1' % name,
+        'protocol': 'rest',
+        'parameters': {
+            'alt': {'type': 'string', 'location': 'query'},
+            'fields': {'type': 'string', 'location': 'query'},
+            'prettyPrint': {'type': 'boolean', 'location': 'query'},
+            'quotaUser': {'type': 'string', 'location': 'query'},
+        },
+        'schemas': dict((schema, {'id': schema, 'type': 'object', 'properties': properties})
+                        for schema, properties in schemas.items()),
+        'resources': resources,
+    }
+
+
+def storage_document(root_url):
+    """
+    :return: Discovery document of the storage methods the fake implements
+    """
+    objects = {
+        'insert': _method('storage.objects.insert', 'POST', 'b/{bucket}/o', ['bucket'],
+                          ['name', 'predefinedAcl', 'ifGenerationMatch', 'contentEncoding'], 'Object', 'Object',
+                          supportsMediaUpload=True, mediaUpload={'accept': ['*/*']}),
+        'get': _method('storage.objects.get', 'GET', 'b/{bucket}/o/{object}', ['bucket', 'object'], ['generation'],
+                       response='Object', supportsMediaDownload=True, useMediaDownloadService=True),
+        'list': _method('storage.objects.list', 'GET', 'b/{bucket}/o', ['bucket'],
+                        ['prefix', 'delimiter', 'pageToken', 'maxResults', 'versions'], response='Objects'),
+        'delete': _method('storage.objects.delete', 'DELETE', 'b/{bucket}/o/{object}', ['bucket', 'object'],
+                          ['generation', 'ifGenerationMatch']),
+        'compose': _method('storage.objects.compose', 'POST', 'b/{destinationBucket}/o/{destinationObject}/compose',
+                           ['destinationBucket', 'destinationObject'], request='ComposeRequest', response='Object'),
+    }
+    page = {'items': {'type': 'array', 'items': {'type': 'object'}}, 'nextPageToken': {'type': 'string'}}
+    schemas = {'Object': {}, 'ComposeRequest': {}, 'Objects': page}
+    return _document('storage', root_url, {'objects': {'methods': objects}}, schemas)
+
+
+def compute_document(root_url):
+    """
+    :return: Discovery document of the compute engine methods the fake implements
+    """
+    zone = 'projects/{project}/zones/{zone}/'
+    scope = ['project', 'zone']
+    listing = ['maxResults', 'pageToken', 'filter']
+    instances = {
+        'list': _method('compute.instances.list', 'GET', zone + 'instances', scope, listing, response='InstanceList'),
+        'aggregatedList': _method('compute.instances.aggregatedList', 'GET', 'projects/{project}/aggregated/instances',
+                                  ['project'], listing, response='InstanceAggregatedList'),
+        'get': _method('compute.instances.get', 'GET', zone + 'instances/{instance}', scope + ['instance'],
+                       response='Instance'),
+        'insert': _method('compute.instances.insert', 'POST', zone + 'instances', scope, request='Instance',
+                          response='Operation'),
+        'delete': _method('compute.instances.delete', 'DELETE', zone + 'instances/{instance}', scope + ['instance'],
+                          response='Operation'),
+        'start': _method('compute.instances.start', 'POST', zone + 'instances/{instance}/start', scope + ['instance'],
+                         response='Operation'),
+        'stop': _method('compute.instances.stop', 'POST', zone + 'instances/{instance}/stop', scope + ['instance'],
+                        response='Operation'),
+        'setMetadata': _method('compute.instances.setMetadata', 'POST', zone + 'instances/{instance}/setMetadata',
+                               scope + ['instance'], request='Metadata', response='Operation'),
+    }
+    disks = {
+        'insert': _method('compute.disks.insert', 'POST', zone + 'disks', scope, ['sourceImage'], 'Disk', 'Operation'),
+        'delete': _method('compute.disks.delete', 'DELETE', zone + 'disks/{disk}', scope + ['disk'],
+                          response='Operation'),
+    }
+    operations = {
+        'get': _method('compute.zoneOperations.get', 'GET', zone + 'operations/{operation}', scope + ['operation'],
+                       response='Operation'),
+    }
+    page = {'items': {'type': 'array', 'items': {'type': 'object'}}, 'nextPageToken': {'type': 'string'}}
+    schemas = {'Instance': {}, 'Disk': {}, 'Metadata': {}, 'Operation': {}, 'InstanceList': page,
+               'InstanceAggregatedList': page}
+    resources = {'instances': {'methods': instances}, 'disks': {'methods': disks},
+                 'zoneOperations': {'methods': operations}}
+    return _document('compute', root_url, resources, schemas)
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _json(status, resource, headers=None):
+    headers = dict(headers or {})
+    headers['Content-Type'] = 'application/json; charset=UTF-8'
+    return status, headers, json.dumps(resource).encode('utf-8')
+
+
+def _error(status, message, reason='invalid'):
+    return _json(status, {'error': {'code': status, 'message': message,
+                                    'errors': [{'reason': reason, 'message': message}]}})
+
+
+def _split_multipart(body, content_type):
+    """
+    Split a multipart body without decoding its parts, which may be binary
+    :return: List of (dict of lower case header to value, payload bytes)
+    """
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode('ascii')
+    # Delimiters end lines the way the first one does, payload bytes may contain either line ending
+    first = body.find(b'--' + boundary) + len(boundary) + 2
+    newline = b'\r\n' if body[first:first + 2] == b'\r\n' else b'\n'
+    delimiter = newline + b'--' + boundary
+    body = newline + body
+    parts = []
+    for piece in body.split(delimiter)[1:]:
+        if piece.startswith(b'--'):
+            break
+        piece = piece[2:] if piece.startswith(b'\r\n') else piece[1:]
+        end = min(index for index in (piece.find(b'\r\n\r\n'), piece.find(b'\n\n'), len(piece)) if index >= 0)
+        separator = 4 if piece[end:end + 4] == b'\r\n\r\n' else 2
+        headers = {}
+        for line in piece[:end].decode('utf-8').splitlines():
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        parts.append((headers, piece[end + separator:]))
+    return parts
+
+
+class FakeServer(object):
+    """
+    State of the fake apis and the http server answering for them
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, operation_seconds=OPERATION_SECONDS,
+                 operation_error_rate=0.0, seed=0, address='127.0.0.1', port=0):
+        """
+        :param latency: Seconds added to every request
+        :param bandwidth: Bytes per second the bodies of a request and of its response go through, None for no limit
+        :param error_rate: Fraction of the requests answered with a 503 (every sub-request of a batch is drawn)
+        :param operation_seconds: Seconds a compute engine operation stays RUNNING
+        :param operation_error_rate: Fraction of the compute engine operations that end with an error
+        :param seed: Seed of the generator drawing the errors
+        :param address: Address the server listens on
+        :param port: Port the server listens on, 0 for any free port
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.operation_seconds = operation_seconds
+        self.operation_error_rate = operation_error_rate
+        self.requests = 0
+        self.errors = 0
+        self.objects = {}           # (bucket, name) to (object resource, stored bytes)
+        self.instances = {}         # (project, zone, name) to instance resource
+        self.disks = {}             # (project, zone, name) to disk resource
+        self._operations = {}       # Name to (operation resource, time it is done, error)
+        self._sessions = {}         # Upload id to (bucket, object resource, bytearray received)
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._http = ThreadingHTTPServer((address, port), _Handler)
+        self._http.daemon_threads = True
+        self._http.fake = self
+        self._thread = None
+        self.url = 'http://%s:%d' % self._http.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._http.serve_forever, name='fake-server')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._http.shutdown()
+        self._http.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset(self):
+        """
+        Forget every object, instance, disk and operation
+        """
+        with self._lock:
+            self.objects.clear()
+            self.instances.clear()
+            self.disks.clear()
+            self._operations.clear()
+            self._sessions.clear()
+            self.requests = self.errors = 0
+
+    def put_object(self, bucket, name, data, **fields):
+        """
+        Store an object without going through the api (ex: the source of a download benchmark)
+        :param fields: Other fields of the object resource (ex: contentType, contentEncoding, metadata)
+        :return: Object resource
+        """
+        _, _, body = self._store(bucket, dict(fields, name=name), data)
+        return json.loads(body.decode('utf-8'))
+
+    def throttle(self, size):
+        """
+        Wait as long as the latency and the bandwidth make a request carrying size bytes take
+        """
+        seconds = self.latency + (float(size) / self.bandwidth if self.bandwidth else 0)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def _draw(self, rate):
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def handle(self, request):
+        """
+        Answer a request (or a sub-request of a batch)
+        :return: (status, dict of headers, body bytes)
+        """
+        segments = tuple(unquote(segment) for segment in request.path.split('/')[1:])
+        for method, pattern, handler in _ROUTES:
+            if method == request.method and len(pattern) == len(segments) and \
+                    all(expected in ('*', segment) for expected, segment in zip(pattern, segments)):
+                break
+        else:
+            return _error(404, 'No route for %s %s' % (request.method, request.path), 'notFound')
+
+        arguments = [segment for expected, segment in zip(pattern, segments) if expected == '*']
+        if handler not in ('_discovery', '_batch'):
+            with self._lock:
+                self.requests += 1
+            if self._draw(self.error_rate):
+                with self._lock:
+                    self.errors += 1
+                return _error(503, 'Injected error', 'backendError')
+        try:
+            return getattr(self, handler)(request, *arguments)
+        except (KeyError, ValueError, TypeError) as e:
+            return _error(400, 'Invalid request: %r' % e)
+
+    def _discovery(self, request, api, version):
+        documents = {'storage': storage_document, 'compute': compute_document}
+        if api not in documents or version != 'v1':
+            return _error(404, 'Unknown api %s %s' % (api, version), 'notFound')
+        return _json(200, documents[api](self.url))
+
+    def _batch(self, request, api):
+        lines = []
+        boundary = 'batch_%s' % uuid.uuid4().hex
+        for headers, payload in _split_multipart(request.body, request.headers['content-type']):
+            status, response_headers, body = self.handle(self._parse_sub_request(payload))
+            lines += ['--' + boundary, 'Content-Type: application/http',
+                      'Content-ID: <response-%s>' % headers.get('content-id', '').strip('<>'), '',
+                      'HTTP/1.1 %d %s' % (status, REASONS.get(status, ''))]
+            lines += ['%s: %s' % header for header in response_headers.items()]
+            lines += ['Content-Length: %d' % len(body), '', body.decode('utf-8')]
+        lines += ['--%s--' % boundary, '']
+        return 200, {'Content-Type': 'multipart/mixed; boundary=%s' % boundary}, '\r\n'.join(lines).encode('utf-8')
+
+    @staticmethod
+    def _parse_sub_request(payload):
+        end = min(index for index in (payload.find(b'\r\n\r\n'), payload.find(b'\n\n'), len(payload)) if index >= 0)
+        head = payload[:end].decode('utf-8').splitlines()
+        body = payload[end:].lstrip(b'\r\n')
+        method, target = head[0].split(' ')[:2]
+        headers = {}
+        for line in head[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        parts = urlsplit(target)
+        return Request(method, parts.path, dict(parse_qsl(parts.query)), headers, body)
+
+    # Storage
+
+    def _store(self, bucket, body, data, components=None):
+        """
+        Create or replace an object
+        :param components: Number of source objects of a composite object, which has no md5Hash
+        :return: (status, headers, body) of the object resource, or of the error when a checksum does not match
+        """
+        crc = Crc32c()
+        crc.update(data)
+        if body.get('crc32c') and body['crc32c'] != crc.b64digest():
+            return _error(400, 'Provided CRC32C "%s" doesn\'t match calculated CRC32C "%s".'
+                          % (body['crc32c'], crc.b64digest()))
+        md5 = base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+        if body.get('md5Hash') and body['md5Hash'] != md5:
+            return _error(400, 'Provided MD5 hash "%s" doesn\'t match calculated MD5 hash "%s".'
+                          % (body['md5Hash'], md5))
+
+        name = body['name']
+        generation = str(int(time.time() * 1000000) + next(self._ids))
+        resource = {
+            'kind': 'storage#object',
+            'id': '%s/%s/%s' % (bucket, name, generation),
+            'selfLink': '%s/storage/v1/b/%s/o/%s' % (self.url, quote(bucket, safe=''), quote(name, safe='')),
+            'name': name,
+            'bucket': bucket,
+            'generation': generation,
+            'metageneration': '1',
+            'contentType': body.get('contentType') or 'application/octet-stream',
+            'size': str(len(data)),
+            'crc32c': crc.b64digest(),
+            'timeCreated': _now(),
+            'updated': _now(),
+        }
+        if components is None:
+            resource['md5Hash'] = md5
+        else:
+            resource['componentCount'] = components
+        for key in ('contentEncoding', 'metadata', 'cacheControl'):
+            if body.get(key):
+                resource[key] = body[key]
+        with self._lock:
+            self.objects[(bucket, name)] = (resource, bytes(data))
+        return _json(200, resource)
+
+    def _find(self, bucket, name, generation=None):
+        with self._lock:
+            stored = self.objects.get((bucket, name))
+        if stored is None or (generation is not None and stored[0]['generation'] != generation):
+            return None
+        return stored
+
+    def _insert_object(self, request, bucket):
+        upload_type = request.query.get('uploadType', 'media')
+        if 'upload_id' in request.query:
+            return _error(400, 'Upload sessions take PUT requests')
+
+        if upload_type == 'media':
+            body = {'name': request.query['name'], 'contentType': request.headers.get('content-type')}
+            return self._store(bucket, body, request.body)
+
+        if upload_type == 'multipart':
+            (_, metadata), (media_headers, data) = _split_multipart(request.body, request.headers['content-type'])
+            body = json.loads(metadata.decode('utf-8'))
+            body.setdefault('name', request.query.get('name'))
+            body.setdefault('contentType', media_headers.get('content-type'))
+            return self._store(bucket, body, data)
+
+        if upload_type == 'resumable':
+            body = json.loads(request.body.decode('utf-8')) if request.body else {}
+            body.setdefault('name', request.query.get('name'))
+            body.setdefault('contentType', request.headers.get('x-upload-content-type'))
+            upload_id = uuid.uuid4().hex
+            with self._lock:
+                self._sessions[upload_id] = (bucket, body, bytearray())
+            location = '%s/upload/storage/v1/b/%s/o?uploadType=resumable&upload_id=%s' % (
+                self.url, quote(bucket, safe=''), upload_id)
+            return 200, {'Location': location}, b''
+
+        return _error(400, 'Unsupported upload type %s' % upload_type)
+
+    def _upload_chunk(self, request, bucket):
+        with self._lock:
+            session = self._sessions.get(request.query.get('upload_id'))
+        if session is None:
+            return _error(404, 'No such upload session', 'notFound')
+        _, body, received = session
+
+        # bytes first-last/total, bytes */total (status query), total is * while unknown
+        match = re.match(r'bytes (\*|(\d+)-(\d+))/(\*|\d+)', request.headers.get('content-range', ''))
+        if match is None:
+            return _error(400, 'Invalid Content-Range')
+        total = None if match.group(4) == '*' else int(match.group(4))
+        if match.group(1) != '*':
+            first = int(match.group(2))
+            if first > len(received):
+                return _error(400, 'Chunk at %d leaves a gap after byte %d' % (first, len(received)))
+            # A chunk sent again after an error overlaps what was already committed
+            received[first:] = request.body
+
+        if total is not None and len(received) >= total:
+            with self._lock:
+                self._sessions.pop(request.query['upload_id'], None)
+            return self._store(bucket, body, bytes(received[:total]))
+
+        headers = {'Range': 'bytes=0-%d' % (len(received) - 1)} if received else {}
+        return 308, headers, b''
+
+    def _get_object(self, request, bucket, name):
+        if request.query.get('alt') == 'media':
+            return self._get_media(request, bucket, name)
+        stored = self._find(bucket, name, request.query.get('generation'))
+        if stored is None:
+            return _error(404, 'No such object: %s/%s' % (bucket, name), 'notFound')
+        return _json(200, stored[0])
+
+    def _get_media(self, request, bucket, name):
+        stored = self._find(bucket, name, request.query.get('generation'))
+        if stored is None:
+            return _error(404, 'No such object: %s/%s' % (bucket, name), 'notFound')
+        resource, data = stored
+        headers = {'Content-Type': resource['contentType'], 'X-Goog-Generation': resource['generation'],
+                   # Checksums of the stored bytes, whatever is served
+                   'X-Goog-Hash': ','.join('%s=%s' % (key, resource[field])
+                                           for key, field in (('crc32c', 'crc32c'), ('md5', 'md5Hash'))
+                                           if field in resource)}
+
+        if resource.get('contentEncoding') == 'gzip':
+            if 'gzip' in request.headers.get('accept-encoding', ''):
+                headers['Content-Encoding'] = 'gzip'
+            else:
+                # Decompressive transcoding, ranges are ignored like google cloud storage does
+                return 200, headers, gzip.decompress(data)
+
+        match = re.match(r'bytes=(\d+)-(\d*)', request.headers.get('range', ''))
+        if match is None:
+            return 200, headers, data
+        first = int(match.group(1))
+        last = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+        if first >= len(data):
+            return _error(416, 'Range starts after the end of the object')
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, len(data))
+        return 206, headers, data[first:last + 1]
+
+    def _list_objects(self, request, bucket):
+        prefix = request.query.get('prefix', '')
+        start = int(request.query.get('pageToken') or 0)
+        size = int(request.query.get('maxResults') or DEFAULT_PAGE_SIZE)
+        with self._lock:
+            names = sorted(name for object_bucket, name in self.objects
+                           if object_bucket == bucket and name.startswith(prefix))
+            items = [self.objects[(bucket, name)][0] for name in names[start:start + size]]
+        resource = {'kind': 'storage#objects', 'items': items}
+        if start + size < len(names):
+            resource['nextPageToken'] = str(start + size)
+        return _json(200, resource)
+
+    def _delete_object(self, request, bucket, name):
+        stored = self._find(bucket, name, request.query.get('generation'))
+        if stored is None:
+            return _error(404, 'No such object: %s/%s' % (bucket, name), 'notFound')
+        match = request.query.get('ifGenerationMatch')
+        if match is not None and stored[0]['generation'] != match:
+            return _error(412, 'Generation of %s/%s does not match' % (bucket, name), 'conditionNotMet')
+        with self._lock:
+            self.objects.pop((bucket, name), None)
+        return 204, {}, b''
+
+    def _compose(self, request, bucket, name):
+        body = json.loads(request.body.decode('utf-8'))
+        data = []
+        for source in body['sourceObjects']:
+            stored = self._find(bucket, source['name'], source.get('generation'))
+            if stored is None:
+                return _error(404, 'No such object: %s/%s' % (bucket, source['name']), 'notFound')
+            data.append(stored[1])
+        destination = dict(body.get('destination') or {})
+        destination['name'] = name
+        return self._store(bucket, destination, b''.join(data), len(data))
+
+    # Compute engine
+
+    def _link(self, project, zone, path=''):
+        return '%s/compute/v1/projects/%s/zones/%s%s' % (self.url, project, zone, path)
+
+    def _operation(self, project, zone, kind, target, apply):
+        """
+        Start an operation, whose change is applied right away unless the operation is drawn to fail
+        :param apply: Function making the change of the operation
+        :return: (status, headers, body) of the operation resource
+        """
+        error = None
+        if self._draw(self.operation_error_rate):
+            error = {'errors': [{'code': 'ZONE_RESOURCE_POOL_EXHAUSTED',
+                                 'message': 'Injected error of %s %s' % (kind, target)}]}
+        else:
+            apply()
+
+        name = 'operation-%d-%s' % (time.time() * 1000, uuid.uuid4().hex[:12])
+        operation = {
+            'kind': 'compute#operation',
+            'id': str(next(self._ids)),
+            'name': name,
+            'zone': self._link(project, zone),
+            'operationType': kind,
+            'targetLink': self._link(project, zone, '/' + target),
+            'status': 'RUNNING',
+            'progress': 0,
+            'insertTime': _now(),
+            'selfLink': self._link(project, zone, '/operations/' + name),
+        }
+        with self._lock:
+            self._operations[name] = (operation, time.time() + self.operation_seconds, error)
+        return _json(200, operation)
+
+    def _get_operation(self, request, project, zone, name):
+        with self._lock:
+            stored = self._operations.get(name)
+        if stored is None:
+            return _error(404, 'No such operation: %s' % name, 'notFound')
+        operation, done_at, error = stored
+        if time.time() < done_at:
+            return _json(200, operation)
+        operation = dict(operation, status='DONE', progress=100, endTime=_now())
+        if error is not None:
+            operation['error'] = error
+        return _json(200, operation)
+
+    def _wait_operation(self, request, project, zone, name):
+        """
+        Answer once the operation is done, or after WAIT_SECONDS like the wait endpoint of compute engine
+        """
+        with self._lock:
+            stored = self._operations.get(name)
+        if stored is not None:
+            time.sleep(max(min(stored[1] - time.time(), WAIT_SECONDS), 0))
+        return self._get_operation(request, project, zone, name)
+
+    def _instance(self, project, zone, name):
+        with self._lock:
+            return self.instances.get((project, zone, name))
+
+    def _insert_instance(self, request, project, zone):
+        body = json.loads(request.body.decode('utf-8'))
+        name = body['name']
+        if self._instance(project, zone, name) is not None:
+            return _error(409, "The resource '%s' already exists" % name, 'alreadyExists')
+
+        number = next(self._ids)
+        instance = dict(body)
+        instance.update({
+            'kind': 'compute#instance',
+            'id': str(number),
+            'zone': self._link(project, zone),
+            'status': 'RUNNING',
+            'creationTimestamp': _now(),
+            'selfLink': self._link(project, zone, '/instances/' + name),
+            'metadata': dict(body.get('metadata') or {}, kind='compute#metadata', fingerprint=uuid.uuid4().hex[:12]),
+        })
+        for index, interface in enumerate(instance.get('networkInterfaces', [])):
+            interface['networkIP'] = '10.%d.%d.%d' % (number >> 16 & 255, number >> 8 & 255, number & 255)
+            for config in interface.get('accessConfigs', []):
+                config['natIP'] = '198.51.%d.%d' % (number >> 8 & 255, number & 255)
+
+        def apply():
+            with self._lock:
+                self.instances[(project, zone, name)] = instance
+
+        return self._operation(project, zone, 'insert', 'instances/' + name, apply)
+
+    def _get_instance(self, request, project, zone, name):
+        instance = self._instance(project, zone, name)
+        if instance is None:
+            return _error(404, "The resource '%s' was not found" % name, 'notFound')
+        return _json(200, instance)
+
+    def _change_instance(self, project, zone, name, kind, change):
+        if self._instance(project, zone, name) is None:
+            return _error(404, "The resource '%s' was not found" % name, 'notFound')
+
+        def apply():
+            with self._lock:
+                change()
+
+        return self._operation(project, zone, kind, 'instances/' + name, apply)
+
+    def _delete_instance(self, request, project, zone, name):
+        return self._change_instance(project, zone, name, 'delete',
+                                     lambda: self.instances.pop((project, zone, name), None))
+
+    def _start_instance(self, request, project, zone, name):
+        return self._change_instance(project, zone, name, 'start',
+                                     lambda: self.instances[(project, zone, name)].update(status='RUNNING'))
+
+    def _stop_instance(self, request, project, zone, name):
+        return self._change_instance(project, zone, name, 'stop',
+                                     lambda: self.instances[(project, zone, name)].update(status='TERMINATED'))
+
+    def _set_metadata(self, request, project, zone, name):
+        instance = self._instance(project, zone, name)
+        if instance is None:
+            return _error(404, "The resource '%s' was not found" % name, 'notFound')
+        body = json.loads(request.body.decode('utf-8'))
+        if body.get('fingerprint') != instance['metadata']['fingerprint']:
+            return _error(412, 'Supplied fingerprint does not match current metadata fingerprint', 'conditionNotMet')
+        metadata = {'kind': 'compute#metadata', 'fingerprint': uuid.uuid4().hex[:12], 'items': body.get('items', [])}
+        return self._change_instance(project, zone, name, 'setMetadata',
+                                     lambda: instance.update(metadata=metadata))
+
+    def _page(self, request, items):
+        start = int(request.query.get('pageToken') or 0)
+        size = int(request.query.get('maxResults') or 500)
+        resource = {'items': items[start:start + size]}
+        if start + size < len(items):
+            resource['nextPageToken'] = str(start + size)
+        return resource
+
+    def _list_instances(self, request, project, zone):
+        with self._lock:
+            items = [instance for (p, z, name), instance in sorted(self.instances.items()) if (p, z) == (project, zone)]
+        return _json(200, dict(self._page(request, items), kind='compute#instanceList'))
+
+    def _aggregated_instances(self, request, project):
+        with self._lock:
+            instances = [(z, instance) for (p, z, name), instance in sorted(self.instances.items()) if p == project]
+        page = self._page(request, instances)
+        scoped = {}
+        for zone, instance in page['items']:
+            scoped.setdefault('zones/%s' % zone, {'instances': []})['instances'].append(instance)
+        page['items'] = scoped
+        return _json(200, dict(page, kind='compute#instanceAggregatedList'))
+
+    def _insert_disk(self, request, project, zone):
+        body = json.loads(request.body.decode('utf-8'))
+        name = body['name']
+        with self._lock:
+            exists = (project, zone, name) in self.disks
+        if exists:
+            return _error(409, "The resource '%s' already exists" % name, 'alreadyExists')
+        disk = dict(body, kind='compute#disk', status='READY', zone=self._link(project, zone),
+                    selfLink=self._link(project, zone, '/disks/' + name))
+
+        def apply():
+            with self._lock:
+                self.disks[(project, zone, name)] = disk
+
+        return self._operation(project, zone, 'insert', 'disks/' + name, apply)
+
+    def _delete_disk(self, request, project, zone, name):
+        with self._lock:
+            exists = (project, zone, name) in self.disks
+        if not exists:
+            return _error(404, "The resource '%s' was not found" % name, 'notFound')
+
+        def apply():
+            with self._lock:
+                self.disks.pop((project, zone, name), None)
+
+        return self._operation(project, zone, 'delete', 'disks/' + name, apply)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _serve(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        parts = urlsplit(self.path)
+        headers = dict((key.lower(), value) for key, value in self.headers.items())
+        request = Request(self.command, parts.path, dict(parse_qsl(parts.query, keep_blank_values=True)), headers,
+                          body)
+
+        status, response_headers, content = fake.handle(request)
+        if not parts.path.startswith('/discovery/'):
+            fake.throttle(len(body) + len(content))
+
+        self.send_response(status, REASONS.get(status))
+        for key, value in response_headers.items():
+            if key.lower() != 'content-length':
+                self.send_header(key, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _serve
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,338 @@
+"""
+Name: Benchmark suite
+
+Purpose: Measure upload.py, download.py, batch.py and vm_manager.py against the fake server of fake_server.py with the
+         latency, bandwidth and error rate given on the command line: small file upload rate, large file upload and
+         download throughput, metadata operation rate and the time to provision VMs. Every benchmark runs --runs times
+         and reports the median of the runs without failures, the failed operations and errors of each run being
+         recorded. The results are written as json with the commit, the settings and the api calls of each benchmark,
+         so runs can be tracked over time, and --baseline compares the run with a previous results file (exit status 1
+         when a benchmark regressed by more than --tolerance or no longer succeeds)
+
+Usage: python benchmarks/suite.py [--output results.json] [--baseline previous.json] [--only upload_large,download]
+                                  [--latency 0.02] [--bandwidth-mb 100] [--error-rate 0.01] [--runs 3]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import batch
+import clients
+import config
+import download
+import inventory
+import metrics
+import upload
+import vm_manager
+from fake_server import FakeServer
+
+BUCKET = 'benchmark-bucket'
+PROJECT = 'benchmark-project'
+ZONE = 'us-central1-a'
+RESULTS_VERSION = 2         # Version of the layout of the results file
+
+
+def _write(path, size):
+    with open(path, 'wb') as fh:
+        for _ in range(size // (1024 * 1024)):
+            fh.write(os.urandom(1024 * 1024))
+        fh.write(os.urandom(size % (1024 * 1024)))
+
+
+def _failures(results):
+    """
+    :return: Number of results telling the operation failed
+    """
+    return sum(1 for result in results if not result)
+
+
+def _attempt(function, *args):
+    """
+    Call a function raising on failure the way the functions returning False do
+    :return: Result of the function, False if it raised
+    """
+    try:
+        return function(*args)
+    except Exception:
+        return False
+
+
+def upload_small(server, args, scratch):
+    """
+    :return: Files uploaded per second with upload_file, args.workers at a time, and the failed uploads
+    """
+    paths = [os.path.join(scratch, 'small-%05d.bin' % index) for index in range(args.small_files)]
+    for path in paths:
+        _write(path, args.small_kb * 1024)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(lambda path: upload.upload_file(path, 'small/' + os.path.basename(path), BUCKET),
+                                paths))
+    seconds = time.time() - start
+    failures = _failures(results)
+    return (len(paths) - failures) / seconds, failures
+
+
+def _upload_large(args, scratch, composite):
+    path = os.path.join(scratch, 'large')
+    _write(path, args.large_mb * 1024 * 1024)
+
+    start = time.time()
+    result = upload.upload_file_in_chunks(path, 'large', BUCKET, composite=composite, resumable=False)
+    seconds = time.time() - start
+    return args.large_mb / seconds, _failures([result])
+
+
+def upload_large(server, args, scratch):
+    """
+    :return: MiB per second of a single resumable upload
+    """
+    return _upload_large(args, scratch, False)
+
+
+def upload_composite(server, args, scratch):
+    """
+    :return: MiB per second of a composite upload (parts uploaded in parallel then composed)
+    """
+    return _upload_large(args, scratch, True)
+
+
+def _download(server, args, scratch, sliced):
+    server.put_object(BUCKET, 'large', os.urandom(args.large_mb * 1024 * 1024))
+
+    start = time.time()
+    result = download.download_object('large', os.path.join(scratch, 'large'), BUCKET, sliced=sliced,
+                                      resumable=sliced)
+    seconds = time.time() - start
+    return args.large_mb / seconds, _failures([result])
+
+
+def download_sliced(server, args, scratch):
+    """
+    :return: MiB per second of a sliced download (byte ranges downloaded in parallel)
+    """
+    return _download(server, args, scratch, True)
+
+
+def download_stream(server, args, scratch):
+    """
+    :return: MiB per second of a download in a single stream
+    """
+    return _download(server, args, scratch, False)
+
+
+def metadata_batch(server, args, scratch):
+    """
+    :return: Objects per second whose metadata get_metadata_many fetched in batch requests, and the failed ones
+    """
+    names = ['metadata/%06d' % index for index in range(args.metadata_ops)]
+    for name in names:
+        server.put_object(BUCKET, name, b'x')
+
+    start = time.time()
+    results = batch.get_metadata_many(names, BUCKET)
+    seconds = time.time() - start
+    failures = _failures([item.result for item in results.values()])
+    return (len(names) - failures) / seconds, failures
+
+
+def metadata_single(server, args, scratch):
+    """
+    :return: check_if_file_exists calls per second, args.workers at a time, and the failed calls
+    """
+    names = ['metadata/%06d' % index for index in range(args.metadata_ops // 10 or 1)]
+    for name in names:
+        server.put_object(BUCKET, name, b'x')
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(lambda name: _attempt(upload.check_if_file_exists, name, BUCKET), names))
+    seconds = time.time() - start
+    failures = _failures(results)
+    return (len(names) - failures) / seconds, failures
+
+
+def provision(server, args, scratch):
+    """
+    :return: Seconds create_instances takes to create args.vms VMs, their disks and wait for every operation, and
+             the instances it failed to create
+    """
+    specs = [{'name': 'benchmark-vm-%04d' % index, 'disk_size': 10} for index in range(args.vms)]
+    inventory.reset()
+
+    start = time.time()
+    # The startup script is only sent in the body of the instances, its content does not matter here
+    reports = vm_manager.create_instances(specs, zone=ZONE, project=PROJECT, startup_script='')
+    seconds = time.time() - start
+    return seconds, _failures([report.created for report in reports.values()])
+
+
+# Name to (function returning (value, failed operations), unit, True when a higher value is better)
+BENCHMARKS = {
+    'upload_small': (upload_small, 'files/s', True),
+    'upload_large': (upload_large, 'MiB/s', True),
+    'upload_composite': (upload_composite, 'MiB/s', True),
+    'download_sliced': (download_sliced, 'MiB/s', True),
+    'download_stream': (download_stream, 'MiB/s', True),
+    'metadata_batch': (metadata_batch, 'objects/s', True),
+    'metadata_single': (metadata_single, 'calls/s', True),
+    'provision': (provision, 's', False),
+}
+
+
+def run(name, server, args):
+    """
+    Run a benchmark args.runs times, on an empty fake server each time. A run whose operations failed or that raised
+    is recorded with its failures or error and left out of the median, which is None when no run succeeded
+    :return: Dict of its results
+    """
+    function, unit, higher_is_better = BENCHMARKS[name]
+    values = []
+    failures = []
+    errors = []
+    injected = 0
+    sink = metrics.add_sink(metrics.MemorySink())
+    try:
+        for _ in range(args.runs):
+            server.reset()
+            value, failed, error = None, 0, None
+            try:
+                with tempfile.TemporaryDirectory() as scratch:
+                    value, failed = function(server, args, scratch)
+            except Exception as e:
+                error = "%s: %s" % (type(e).__name__, e)
+            values.append(value)
+            failures.append(failed)
+            errors.append(error)
+            injected += server.errors
+        snapshot = sink.snapshot()
+    finally:
+        metrics.remove_sink(sink)
+
+    api_calls = {}
+    for metric, tags, total in snapshot['counters']:
+        if metric == 'api.calls':
+            api_calls[tags['endpoint']] = total // args.runs
+    retries = sum(total for metric, _, total in snapshot['counters'] if metric == 'transfer.retries')
+    succeeded = [value for value, failed, error in zip(values, failures, errors) if not failed and error is None]
+    return {'unit': unit, 'higher_is_better': higher_is_better,
+            'median': statistics.median(succeeded) if succeeded else None, 'runs': values, 'failures': failures,
+            'errors': errors, 'api_calls': api_calls, 'retries': retries, 'injected_errors': injected}
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print how each benchmark changed since a previous results file
+    :return: Names of the benchmarks that regressed by more than tolerance
+    """
+    regressions = []
+    print("\n%-18s %12s %12s %9s" % ('benchmark', 'baseline', 'now', 'change'))
+    for name, result in sorted(results['benchmarks'].items()):
+        previous = baseline.get('benchmarks', {}).get(name)
+        if previous is None or previous['median'] is None:
+            continue
+        if result['median'] is None:
+            regressions.append(name)
+            print("%-18s %12.2f %12s %9s  failed" % (name, previous['median'], '-', '-'))
+            continue
+        # Above 1 when the benchmark got better, whichever direction better is
+        ratio = result['median'] / previous['median'] if result['higher_is_better'] else \
+            previous['median'] / result['median']
+        flag = ''
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            flag = '  regression'
+        print("%-18s %12.2f %12.2f %+8.1f%%%s" % (name, previous['median'], result['median'], (ratio - 1) * 100,
+                                                 flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='Json file the results are written to')
+    parser.add_argument('--baseline', help='Json results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Slowdown reported as a regression')
+    parser.add_argument('--only', help='Comma separated benchmarks to run, among: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--runs', type=int, default=3, help='Runs per benchmark, the median is reported')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds the fake server adds to a request')
+    parser.add_argument('--bandwidth-mb', type=float, default=200, help='MiB/s of the fake server, 0 for no limit')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 503')
+    parser.add_argument('--operation-seconds', type=float, default=2.0, help='Seconds an operation stays RUNNING')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the injected errors')
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent calls of the small file benchmarks')
+    parser.add_argument('--small-files', type=int, default=200, help='Files of the small file upload benchmark')
+    parser.add_argument('--small-kb', type=int, default=16, help='Size of a small file')
+    parser.add_argument('--large-mb', type=int, default=64, help='Size of the large file benchmarks')
+    parser.add_argument('--metadata-ops', type=int, default=1000, help='Objects of the batched metadata benchmark')
+    parser.add_argument('--vms', type=int, default=20, help='VMs of the provisioning benchmark')
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error("Unknown benchmarks: %s" % ', '.join(unknown))
+
+    # Keep the log of the measured modules out of the working directory
+    config.init_logging(os.path.join(tempfile.gettempdir(), 'logs', 'benchmark_log'))
+
+    settings = dict((key, value) for key, value in vars(args).items() if key not in ('output', 'baseline', 'only'))
+    results = {
+        'version': RESULTS_VERSION,
+        'started': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': settings,
+        'benchmarks': {},
+    }
+
+    server = FakeServer(latency=args.latency, bandwidth=args.bandwidth_mb * 1024 * 1024 or None,
+                        error_rate=args.error_rate, operation_seconds=args.operation_seconds, seed=args.seed)
+    with server:
+        clients.set_endpoint(server.url)
+        try:
+            print("%-18s %12s %-10s %10s %9s" % ('benchmark', 'median', 'unit', 'api calls', 'failures'))
+            for name in names:
+                result = results['benchmarks'][name] = run(name, server, args)
+                median = '-' if result['median'] is None else '%.2f' % result['median']
+                failed = sum(result['failures']) + sum(1 for error in result['errors'] if error is not None)
+                print("%-18s %12s %-10s %10d %9d" % (name, median, result['unit'], sum(result['api_calls'].values()),
+                                                     failed))
+        finally:
+            clients.set_endpoint(None)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compare(results, json.load(fh), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Name: Memory-mapped upload benchmark
+
+Purpose: Compare the CPU time, traced allocations and resident memory per GB of the two resumable upload paths of
+         upload.py: the file object read through MediaIoBaseUpload (_ChecksumReader) and the memory-mapped file sent
+         as memoryview slices (_MmapUpload). Chunks go through the real googleapiclient resumable protocol to an
+         in-process sink that consumes request bodies the way http.client does, so only the client side is measured
+
+Usage: python benchmarks/upload_mmap.py [--size-mb 1024] [--runs 3]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from googleapiclient.model import JsonModel
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+# Imported before anything is measured
+import apiclient
+import config
+import upload
+
+VARIANTS = ('file', 'mmap')
+BLOCK_SIZE = 8192   # Size of the reads http.client makes on a file-like request body
+
+
+class _SinkResponse(dict):
+
+    def __init__(self, status, headers):
+        super(_SinkResponse, self).__init__(headers)
+        self.status = status
+        self.reason = ''
+
+
+class _SinkHttp(object):
+    """
+    Accepts a resumable upload session and discards its chunks
+    """
+
+    def __init__(self):
+        self.received = 0
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        if 'uploadType=resumable' in uri:
+            return _SinkResponse(200, {'location': 'http://sink/session'}), b''
+
+        if hasattr(body, 'read'):
+            for block in iter(lambda: body.read(BLOCK_SIZE), b''):
+                self.received += len(block)
+        elif body is not None:
+            # Bytes-like bodies are handed to socket.sendall as they are
+            self.received += len(memoryview(body))
+
+        total = headers.get('Content-Range', '').rsplit('/', 1)[-1]
+        if total not in ('*', '') and int(total) == self.received:
+            return _SinkResponse(200, {}), json.dumps({'size': str(self.received)}).encode('utf-8')
+        return _SinkResponse(308, {'range': 'bytes=0-%d' % (self.received - 1)}), b''
+
+
+def _upload(variant, path):
+    if variant == 'mmap':
+        media = upload._MmapUpload(path, 'application/octet-stream')
+        checksum = media.checksum
+        fh = media
+    else:
+        fh = upload._ChecksumReader(path)
+        media = apiclient.http.MediaIoBaseUpload(fh, mimetype='application/octet-stream',
+                                                 chunksize=upload.CHUNK_SIZE, resumable=True)
+        checksum = fh.checksum
+
+    sink = _SinkHttp()
+    req = apiclient.http.HttpRequest(sink, JsonModel().response, 'http://sink/upload?uploadType=resumable',
+                                     method='POST', body='{"name": "benchmark"}',
+                                     headers={'content-type': 'application/json'}, resumable=media)
+    resp = None
+    while resp is None:
+        status, resp = req.next_chunk()
+    fh.close()
+
+    assert int(resp['size']) == os.path.getsize(path)
+    return checksum.b64digest()
+
+
+def run(variant, path, traced):
+    """
+    Upload the file once in this process
+    :return: Dict of measures
+    """
+    if traced:
+        tracemalloc.start()
+    cpu, wall = time.process_time(), time.time()
+    checksum = _upload(variant, path)
+    cpu, wall = time.process_time() - cpu, time.time() - wall
+
+    result = {'variant': variant, 'cpu': cpu, 'wall': wall, 'checksum': checksum,
+              'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    if traced:
+        result['traced_peak'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def _child(variant, path, traced):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', variant, path] +
+                                     (['--traced'] if traced else []))
+    return json.loads(output.decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=1024, help='Size of the uploaded file')
+    parser.add_argument('--runs', type=int, default=3, help='Runs per variant, the best one is reported')
+    parser.add_argument('--child', nargs=2, metavar=('VARIANT', 'PATH'), help=argparse.SUPPRESS)
+    parser.add_argument('--traced', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Keep the log of the measured modules out of the working directory
+    config.init_logging(os.path.join(tempfile.gettempdir(), 'logs', 'benchmark_log'))
+
+    if args.child:
+        print(json.dumps(run(args.child[0], args.child[1], args.traced)))
+        return
+
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(scratch, 'source.bin')
+        with open(path, 'wb') as fh:
+            for _ in range(args.size_mb):
+                fh.write(os.urandom(1024 * 1024))
+
+        gb = args.size_mb / 1024.0
+        print("%d MiB file, best of %d runs" % (args.size_mb, args.runs))
+        print("%-6s %12s %12s %16s %14s" % ('path', 'cpu s/GB', 'wall s/GB', 'traced peak MiB', 'max rss MiB'))
+        checksums = set()
+        for variant in VARIANTS:
+            # Timed runs without tracemalloc, whose hooks would dominate the cpu time, then one traced run
+            timed = [_child(variant, path, False) for _ in range(args.runs)]
+            traced = _child(variant, path, True)
+            best = min(timed, key=lambda result: result['cpu'])
+            checksums.update(result['checksum'] for result in timed + [traced])
+            print("%-6s %12.3f %12.3f %16.1f %14.1f" % (variant, best['cpu'] / gb, best['wall'] / gb,
+                                                        traced['traced_peak'] / 1048576.0,
+                                                        min(result['max_rss'] for result in timed) / 1048576.0))
+        assert len(checksums) == 1, "Both paths must compute the same checksum"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""
+Name: Checksums
+
+Purpose: Compute the CRC32C and MD5 hashes google cloud storage keeps (base64 encoded) in object metadata.
+         CRC32C needs the google_crc32c package to be fast: without it the pure Python CRC32C only runs at a few MB/s,
+         so new_checksum and file_checksum fall back to MD5, which storage keeps for every object but composites
+"""
+
+import base64
+import hashlib
+import struct
+
+try:
+    import google_crc32c    # Optional C implementation, hundreds of times faster than the fallback below
+except ImportError:
+    google_crc32c = None
+
+
+READ_SIZE = 1024 * 1024
+
+
+def _make_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_TABLE = _make_table()
+
+
+def _extend(crc, data):
+    if google_crc32c is not None:
+        if isinstance(data, bytes):
+            return google_crc32c.extend(crc, data)
+        # The C extension only takes bytes: copy views (ex: of a memory-mapped file) a block at a time
+        view = memoryview(data).cast('B')
+        for start in range(0, len(view), READ_SIZE):
+            crc = google_crc32c.extend(crc, bytes(view[start:start + READ_SIZE]))
+        return crc
+
+    crc ^= 0xFFFFFFFF
+    table = _TABLE
+    for byte in bytes(data):
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def _gf2_times(matrix, vector):
+    total = 0
+    for row in matrix:
+        if not vector:
+            break
+        if vector & 1:
+            total ^= row
+        vector >>= 1
+    return total
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, row) for row in matrix]
+
+
+def crc32c_combine(crc1, crc2, length2):
+    """
+    CRC32C of two pieces of data put end to end, from the CRC32C of each piece (the crc32_combine algorithm of zlib),
+    so the CRC32C of a composite object can be checked without reading its parts again
+    :param crc1: Base64 CRC32C of the first piece
+    :param crc2: Base64 CRC32C of the second piece
+    :param length2: Length of the second piece
+    :return: Base64 CRC32C of both pieces
+    """
+    crc = struct.unpack('>I', base64.b64decode(crc1))[0]
+    if length2 > 0:
+        # Operator appending one zero bit to the data, then two, four... zero bits by squaring it
+        odd = [0x82F63B78] + [1 << i for i in range(31)]
+        even = _gf2_square(odd)
+        odd = _gf2_square(even)
+        while length2:
+            even = _gf2_square(odd)
+            if length2 & 1:
+                crc = _gf2_times(even, crc)
+            length2 >>= 1
+            if not length2:
+                break
+            odd = _gf2_square(even)
+            if length2 & 1:
+                crc = _gf2_times(odd, crc)
+            length2 >>= 1
+    crc ^= struct.unpack('>I', base64.b64decode(crc2))[0]
+    return base64.b64encode(struct.pack('>I', crc)).decode('ascii')
+
+
+class _Checksum(object):
+
+    field = None    # Field of the object resource holding the same checksum
+
+    def b64digest(self):
+        """
+        :return: Checksum in the same format as the field of an object
+        """
+        return base64.b64encode(self.digest()).decode('ascii')
+
+    def fields(self):
+        """
+        :return: Dict of the field of the object resource to the checksum (ex: {'crc32c': 'yZRlqg=='}), to send in the
+                 body of an upload or compare with an object resource
+        """
+        return {self.field: self.b64digest()}
+
+
+class Crc32c(_Checksum):
+    """
+    Running CRC32C, fed with update() like the hashlib objects
+    """
+
+    field = 'crc32c'
+
+    def __init__(self, data=b''):
+        self.crc = 0
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        self.crc = _extend(self.crc, data)
+
+    def digest(self):
+        return struct.pack('>I', self.crc)
+
+
+class Md5(_Checksum):
+    """
+    Running MD5 with the same interface as Crc32c
+    """
+
+    field = 'md5Hash'
+
+    def __init__(self, data=b''):
+        self._md5 = hashlib.md5(data)
+
+    def update(self, data):
+        self._md5.update(data)
+
+    def digest(self):
+        return self._md5.digest()
+
+
+def new_checksum(resource=None):
+    """
+    Start the fastest checksum storage can compare with: CRC32C with google_crc32c, MD5 otherwise
+    :param resource: Object resource the checksum will be compared with, whose fields restrict the choice (composite
+                     objects have no md5Hash, so their CRC32C is computed whatever its speed)
+    :return: Crc32c or Md5
+    """
+    if resource is not None:
+        if 'md5Hash' not in resource:
+            return Crc32c()
+        if 'crc32c' not in resource:
+            return Md5()
+    return Crc32c() if google_crc32c is not None else Md5()
+
+
+def file_checksum(path, resource=None):
+    """
+    Compute the fastest checksum of a local file storage can compare with, see new_checksum
+    :param path: Path of the file
+    :param resource: Object resource the checksum will be compared with
+    :return: Dict of the field of the object resource to the base64 encoded checksum
+    """
+    checksum = new_checksum(resource)
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(READ_SIZE), b''):
+            checksum.update(block)
+    return checksum.fields()
+
+
+def md5_b64digest(md5):
+    """
+    :param md5: hashlib md5 object
+    :return: MD5 in the same format as the md5Hash field of an object
+    """
+    return base64.b64encode(md5.digest()).decode('ascii')
+
+
+def file_crc32c(path):
+    """
+    Compute the CRC32C of a local file
+    :param path: Path of the file
+    :return: Base64 encoded CRC32C
+    """
+    crc = Crc32c()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(READ_SIZE), b''):
+            crc.update(block)
+    return crc.b64digest()
+
+
+def file_md5(path):
+    """
+    Compute the MD5 of a local file
+    :param path: Path of the file
+    :return: Base64 encoded MD5
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(READ_SIZE), b''):
+            md5.update(block)
+    return md5_b64digest(md5)
@@ -0,0 +1,166 @@
+"""
+Name: Adaptive chunk sizing
+
+Purpose: Choose the size of the next chunk of an upload or a download from the throughput measured on the previous
+         chunks, so fast links send big chunks (few requests) and flaky links small ones (cheap to send again), and
+         keep statistics of the transfer
+"""
+
+import http.client
+import random
+import socket
+import threading
+import time
+
+from apiclient.errors import HttpError
+
+
+CHUNK_GRANULARITY = 256 * 1024          # Chunks of resumable uploads must be multiples of this size
+MIN_CHUNK_SIZE = 256 * 1024             # Smallest chunk, reached after repeated failures
+MAX_CHUNK_SIZE = 1024 * 1024 * 64       # Largest chunk, reached on fast links
+TARGET_CHUNK_SECONDS = 2.0              # Chunks are sized to take about this long at the measured throughput
+THROUGHPUT_WEIGHT = 0.3                 # Weight of the last chunk in the moving average of the throughput
+CHUNK_RETRIES = 5                       # Attempts of a chunk failed with a transient error before giving up
+
+
+def is_transient(error):
+    """
+    :return: True if a request failed with an error that may not happen again (server error, rate limit, network)
+    """
+    if isinstance(error, HttpError):
+        return error.resp.status in (408, 429) or error.resp.status >= 500
+    return isinstance(error, (ConnectionError, TimeoutError, socket.timeout, http.client.HTTPException))
+
+
+class TransferStats(object):
+    """
+    Statistics of one transfer, updated by its chunk policy
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.chunks = 0
+        self.retries = 0
+        self.busy_seconds = 0.0     # Time spent in requests, summed over concurrent requests
+        self.chunk_sizes = {}       # Chunk size chosen to number of chunks sent or received with it
+        self.started = time.time()
+        self.finished = None
+
+    def finish(self):
+        self.finished = time.time()
+
+    def throughput(self):
+        """
+        :return: Bytes per second over the whole transfer
+        """
+        elapsed = (self.finished or time.time()) - self.started
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            'bytes': self.bytes,
+            'chunks': self.chunks,
+            'retries': self.retries,
+            'seconds': (self.finished or time.time()) - self.started,
+            'busy_seconds': self.busy_seconds,
+            'throughput': self.throughput(),
+            'chunk_sizes': dict(self.chunk_sizes),
+        }
+
+    def __str__(self):
+        return "%d bytes in %d chunks (%d retries) at %.1f MiB/s, chunk sizes %s" % (
+            self.bytes, self.chunks, self.retries, self.throughput() / 1048576.0,
+            ', '.join('%d KiB x %d' % (size // 1024, count) for size, count in sorted(self.chunk_sizes.items())))
+
+
+class ChunkPolicy(object):
+    """
+    Chunk size of a transfer, shared by all its concurrent requests.
+
+    After each full chunk, the next size is the moving average of the throughput times TARGET_CHUNK_SECONDS, growing
+    at most twice and shrinking at most by half per chunk, and rounded down to the granularity. A failed chunk halves
+    the size. Uploads copy the size into their media before each chunk, so it does not change while a chunk is sent.
+    """
+
+    def __init__(self, initial, minimum=MIN_CHUNK_SIZE, maximum=MAX_CHUNK_SIZE, target_seconds=TARGET_CHUNK_SECONDS,
+                 granularity=CHUNK_GRANULARITY, stats=None, progress=None):
+        """
+        :param initial: Size of the first chunk
+        :param minimum: Smallest chunk
+        :param maximum: Largest chunk
+        :param target_seconds: Time a chunk should take
+        :param granularity: Chunk sizes are multiples of this size
+        :param stats: TransferStats to update, a new one by default
+        :param progress: progress.Progress counting the bytes of the chunks
+        """
+        self.minimum = max(minimum, granularity)
+        self.maximum = max(maximum, self.minimum)
+        self.target_seconds = target_seconds
+        self.granularity = granularity
+        self.stats = stats if stats is not None else TransferStats()
+        self.progress = progress
+        self.throughput = None
+        self._lock = threading.Lock()
+        self._size = self._bound(initial)
+
+    @classmethod
+    def fixed(cls, size, stats=None, progress=None):
+        """
+        :return: Policy always choosing the same size (still keeping statistics)
+        """
+        return cls(size, size, size, granularity=1, stats=stats, progress=progress)
+
+    def _bound(self, size):
+        size = int(size) // self.granularity * self.granularity
+        return min(max(size, self.minimum), self.maximum)
+
+    def size(self):
+        return self._size
+
+    def record(self, size, seconds, chosen=None):
+        """
+        Measure a chunk that went through
+        :param size: Bytes of the chunk
+        :param seconds: Time the request took
+        :param chosen: Chunk size the chunk was requested with (size() when it started), the current size by default
+        """
+        if self.progress is not None:
+            self.progress.add(size)
+
+        with self._lock:
+            chosen = chosen or self._size
+            stats = self.stats
+            stats.bytes += size
+            stats.chunks += 1
+            stats.busy_seconds += seconds
+            stats.chunk_sizes[chosen] = stats.chunk_sizes.get(chosen, 0) + 1
+
+            # The last, short chunk of a transfer says more about the latency than about the bandwidth
+            if size < chosen or seconds <= 0:
+                return
+
+            rate = size / seconds
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput = THROUGHPUT_WEIGHT * rate + (1 - THROUGHPUT_WEIGHT) * self.throughput
+
+            wanted = min(max(self.throughput * self.target_seconds, self._size / 2), self._size * 2)
+            self._size = self._bound(wanted)
+
+    def failed(self, error, attempt):
+        """
+        Shrink the chunks after a failed chunk, and wait before it is tried again
+        :param error: Exception raised by the request
+        :param attempt: Number of failures of this chunk so far (1 for the first)
+        :return: True if the chunk should be tried again
+        """
+        if attempt > CHUNK_RETRIES or not is_transient(error):
+            return False
+
+        with self._lock:
+            self.stats.retries += 1
+            self._size = self._bound(self._size // 2)
+
+        time.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1))
+        return True
@@ -0,0 +1,235 @@
+"""
+Name: API clients
+
+Purpose: Build the google cloud storage and compute engine services once per process and share a thread-safe pool of
+         authorized keep-alive http connections between all the functions of this repository
+"""
+
+import threading
+import time
+import httplib2
+import metrics
+
+from contextlib import contextmanager
+from apiclient import discovery
+from apiclient.http import HttpRequest
+from config import logger, get_storage_credentials, get_compute_engine_credentials
+
+
+STORAGE = 'storage'
+COMPUTE = 'compute'
+API_VERSION = 'v1'
+
+POOL_SIZE = 16      # Maximum number of idle connections kept per api
+HTTP_TIMEOUT = 60   # Socket timeout (sec) of every pooled connection
+NUM_RETRIES = 3     # Retries, with exponential backoff, of a single request failed with a 5xx, 429 or network error
+DISCOVERY_PATH = '/discovery/v1/apis/{api}/{apiVersion}/rest'  # Discovery documents of a server set by set_endpoint
+
+_CREDENTIALS = {
+    STORAGE: get_storage_credentials,
+    COMPUTE: get_compute_engine_credentials,
+}
+
+_lock = threading.Lock()
+_pools = {}
+_services = {}
+_endpoint = None    # Root url of the server the apis are called on when it is not google cloud
+
+
+class HttpPool(object):
+    """
+    Thread-safe pool of authorized httplib2 connections.
+
+    httplib2.Http keeps its sockets alive between requests but can not be shared between threads, so every request
+    borrows a connection from the pool and hands it back once the response has been read. The pool itself acts like
+    an httplib2.Http, which lets a single service object built by discovery be shared by every thread.
+    """
+
+    def __init__(self, api, max_idle=POOL_SIZE, timeout=HTTP_TIMEOUT):
+        """
+        :param api: Name of the api the connections are authorized for (storage or compute)
+        :param max_idle: Maximum number of idle connections kept around
+        :param timeout: Socket timeout (sec) of every connection
+        """
+        self.api = api
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        http = httplib2.Http(timeout=self.timeout)
+        # 308 answers a chunk of a resumable upload, httplib2 would take it for a redirect
+        http.redirect_codes = set(http.redirect_codes) - {308}
+        if _endpoint is not None:
+            return http
+        credentials = _CREDENTIALS[self.api]()
+        if credentials is None:
+            raise RuntimeError("Unable to get %s credentials" % self.api)
+        return credentials.authorize(http)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection from the pool. Connections that raised are dropped instead of being returned
+        :return: Authorized httplib2.Http
+        """
+        with self._lock:
+            http = self._idle.pop() if self._idle else None
+        if http is None:
+            http = self._new_connection()
+
+        try:
+            yield http
+        except Exception:
+            http.close()
+            raise
+
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(http)
+                http = None
+        if http is not None:
+            http.close()
+
+    def request(self, *args, **kwargs):
+        """
+        Same signature as httplib2.Http.request, executed on a pooled connection
+        """
+        with self.connection() as http:
+            return http.request(*args, **kwargs)
+
+    def close(self):
+        """
+        Close every idle connection of the pool
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for http in idle:
+            http.close()
+
+
+class InstrumentedRequest(HttpRequest):
+    """
+    HttpRequest counting every api call per method (ex: storage.objects.get) in the metrics, with its latency.
+    Resumable media requests are counted once per chunk
+    """
+
+    def execute(self, http=None, num_retries=0):
+        if self.resumable is not None:
+            # Sent chunk by chunk through next_chunk, which records each of them
+            return super(InstrumentedRequest, self).execute(http, num_retries)
+        return self._record(super(InstrumentedRequest, self).execute, http, num_retries)
+
+    def next_chunk(self, http=None, num_retries=0):
+        return self._record(super(InstrumentedRequest, self).next_chunk, http, num_retries)
+
+    def _record(self, send, http, num_retries):
+        start = time.time()
+        try:
+            response = send(http=http, num_retries=num_retries)
+        except Exception as e:
+            metrics.api_call(self.methodId, time.time() - start, e)
+            raise
+        metrics.api_call(self.methodId, time.time() - start)
+        return response
+
+
+def get_http_pool(api):
+    """
+    Get the process wide connection pool of an api
+    :param api: storage or compute
+    :return: HttpPool
+    """
+    with _lock:
+        pool = _pools.get(api)
+        if pool is None:
+            pool = _pools[api] = HttpPool(api)
+        return pool
+
+
+def get_service(api):
+    """
+    Get the process wide service object of an api. The discovery document is only fetched and parsed the first time
+    :param api: storage or compute
+    :return: Service object built by discovery
+    """
+    with _lock:
+        service = _services.get(api)
+    if service is not None:
+        return service
+
+    pool = get_http_pool(api)
+    with _lock:
+        service = _services.get(api)
+        if service is None:
+            logger.debug("Building %s service", api)
+            if _endpoint is None:
+                service = discovery.build(api, API_VERSION, http=pool, requestBuilder=InstrumentedRequest)
+            else:
+                service = discovery.build(api, API_VERSION, http=pool, requestBuilder=InstrumentedRequest,
+                                          discoveryServiceUrl=_endpoint + DISCOVERY_PATH, cache_discovery=False)
+            _services[api] = service
+        return service
+
+
+def get_storage_service(service=None):
+    """
+    Get the google cloud storage service
+    :param service: Service to use instead of the shared one (ex: a fake injected by tests)
+    :return: Storage service
+    """
+    return service if service is not None else get_service(STORAGE)
+
+
+def get_compute_service(service=None):
+    """
+    Get the google cloud compute engine service
+    :param service: Service to use instead of the shared one (ex: a fake injected by tests)
+    :return: Compute service
+    """
+    return service if service is not None else get_service(COMPUTE)
+
+
+def set_service(api, service):
+    """
+    Replace the shared service of an api for the whole process (ex: inject a fake client in tests)
+    :param api: storage or compute
+    :param service: Service object, None to go back to building the real service
+    """
+    with _lock:
+        if service is None:
+            _services.pop(api, None)
+        else:
+            _services[api] = service
+
+
+def set_endpoint(root_url=None):
+    """
+    Call the apis on another server implementing them (ex: the fake server of the benchmarks) instead of google cloud.
+    Requests are sent without credentials, and the discovery documents are fetched from the server
+    :param root_url: Root url of the server (ex: http://127.0.0.1:8080), None to go back to google cloud
+    """
+    global _endpoint
+    reset()
+    with _lock:
+        _endpoint = root_url.rstrip('/') if root_url else None
+
+
+def get_endpoint():
+    """
+    :return: Root url of the server set by set_endpoint, None when the apis are called on google cloud
+    """
+    return _endpoint
+
+
+def reset():
+    """
+    Drop every cached service and close every pooled connection
+    """
+    with _lock:
+        pools = list(_pools.values())
+        _pools.clear()
+        _services.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,127 @@
+"""
+Name: Compression
+
+Purpose: Compress files on the fly while they are uploaded (gzip, or zstd when the zstandard package is installed) and
+         decompress them while they are downloaded, so compressible data like logs costs fewer bytes on the wire
+"""
+
+import mimetypes
+import zlib
+
+try:
+    import zstandard    # Optional, only needed for zstd
+except ImportError:
+    zstandard = None
+
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+GZIP_LEVEL = 6                  # zlib compression level, 1 (fastest) to 9 (smallest)
+ZSTD_LEVEL = 3                  # zstd compression level, 1 (fastest) to 22 (smallest)
+SAMPLE_SIZE = 256 * 1024        # Bytes at the start of a file compressed to guess whether the file is compressible
+MIN_SAVING = 0.1                # Files whose sample shrinks by less than this fraction are uploaded as they are
+
+# Custom metadata of compressed objects. gzip objects also get contentEncoding=gzip so google cloud storage can serve
+# them decompressed to other clients, zstd objects are only marked by the custom metadata
+COMPRESSION_KEY = 'compression'
+UNCOMPRESSED_SIZE_KEY = 'uncompressed-size'
+UNCOMPRESSED_CRC32C_KEY = 'uncompressed-crc32c'
+UNCOMPRESSED_MD5_KEY = 'uncompressed-md5'
+UNCOMPRESSED_TYPE_KEY = 'uncompressed-content-type'
+
+# Field of the checksum of the object resource to the custom metadata holding it for the uncompressed file
+UNCOMPRESSED_CHECKSUM_KEYS = {'crc32c': UNCOMPRESSED_CRC32C_KEY, 'md5Hash': UNCOMPRESSED_MD5_KEY}
+
+# Content types whose data is already compressed
+COMPRESSED_TYPES = ('image/', 'video/', 'audio/', 'application/zip', 'application/gzip', 'application/x-gzip',
+                    'application/x-bzip2', 'application/x-xz', 'application/x-7z-compressed', 'application/zstd',
+                    'application/x-rar-compressed')
+
+
+def guess_mimetype(path):
+    """
+    :param path: Path or name of a file
+    :return: (content type, encoding) from the extension, ex: ('text/csv', None) or ('application/x-tar', 'gzip').
+             Unknown extensions are text/plain
+    """
+    mimetype, encoding = mimetypes.guess_type(path)
+    return mimetype or 'text/plain', encoding
+
+
+def check_method(method):
+    """
+    :param method: gzip, zstd, or True for gzip
+    :return: Name of the compression method
+    """
+    if method is True:
+        method = GZIP
+    if method not in (GZIP, ZSTD):
+        raise ValueError("Unsupported compression: %s" % method)
+    if method == ZSTD and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package")
+    return method
+
+
+def compressor(method):
+    """
+    :return: Object whose compress(data) and flush() return the compressed data
+    """
+    if method == GZIP:
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+def decompressor(method):
+    """
+    :return: Object whose decompress(data) returns the decompressed data
+    """
+    if method == GZIP:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if zstandard is None:
+        raise ValueError("zstd decompression needs the zstandard package")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def is_compressible(path, mimetype, encoding=None):
+    """
+    Guess whether compressing a file is worth it, from its content type and a sample of its data
+    :param path: Path of the file
+    :param mimetype: Content type of the file
+    :param encoding: Encoding guessed from the extension (ex: gzip for .tar.gz)
+    :return: True if the file should be compressed
+    """
+    if encoding is not None or mimetype.startswith(COMPRESSED_TYPES):
+        return False
+
+    with open(path, 'rb') as fh:
+        sample = fh.read(SAMPLE_SIZE)
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def compress_blocks(blocks, method):
+    """
+    Compress a stream on the fly
+    :param blocks: Iterable of bytes
+    :param method: gzip or zstd
+    :return: Generator of compressed bytes
+    """
+    engine = compressor(method)
+    for block in blocks:
+        data = engine.compress(block)
+        if data:
+            yield data
+    yield engine.flush()
+
+
+def compression_of(metadata):
+    """
+    :param metadata: Object resource (with its contentEncoding and metadata fields)
+    :return: Compression method of an object compressed on upload, None otherwise
+    """
+    method = (metadata.get('metadata') or {}).get(COMPRESSION_KEY)
+    if method is None and metadata.get('contentEncoding') == GZIP:
+        method = GZIP
+    return method
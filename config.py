@@ -4,17 +4,18 @@ Name: Configuration for this repository
 Purpose: Storage globally used variables, create logging service and provide google cloud storage credentials
 """
 
+import atexit
+import datetime
 import logging
 import json
+import os
+import queue
+import threading
 
 from httplib2 import Http
 from logging import handlers
 from oauth2client.service_account import ServiceAccountCredentials
 
-# ------------###############################--------------- #
-# Uncomment next line and comment out line 12 if you are using older version of oauth2client
-# from oauth2client.client import SignedJwtAssertionCredentials
-
 
 PROJECT_NAME = ''    # This is the project name you chose
 NETWORK_NAME = ''    # This is the network name you chose for your project
@@ -22,19 +23,227 @@ STORAGE_ZONE = ''    # This is the zone your google cloud storage bucket resides
 STORAGE_BUCKET = ''  # This is the name of the bucket that want to upload files to
 STORAGE_KEY = ''     # This will be the google cloud storage key file in json format
 
+STORAGE_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
+COMPUTE_SCOPE = 'https://www.googleapis.com/auth/compute'
+TOKEN_REFRESH_MARGIN = 300  # Refresh access tokens this many seconds before they expire
+JOURNAL_DIR = 'journal'     # Directory holding the state of unfinished transfers so they can be resumed
+
+
+LOG_FILENAME = 'logs/upload_log'    # Log file, a new one is started daily
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class _LazyQueueHandler(handlers.QueueHandler):
+    """
+    Puts records on the queue of the background listener, started by the first record if init_logging was not called.
+    Records are formatted by the listener thread, so logging only costs the thread that logs a put on a queue
+    """
+
+    def prepare(self, record):
+        # Formatting (and the % of the message arguments) is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        if _listener is None:
+            with _listener_lock:
+                # Records logged once the log was shut down (ex: by other atexit functions) are dropped instead of
+                # starting a listener nothing would stop
+                if _shut_down:
+                    return
+                if _listener is None:
+                    _start_listener(LOG_FILENAME)
+        self.queue.put_nowait(record)
+
+
+_log_queue = queue.SimpleQueue()
+_listener = None
+_listener_lock = threading.Lock()
+_shut_down = False          # Set by shutdown_logging, only an explicit init_logging starts the log again
+_exit_registered = False
 
-# Create logging service
+# Create logging service, the log file is only opened once something is logged
 logger = logging.getLogger('logger')
 logger.setLevel(logging.DEBUG)
+logger.addHandler(_LazyQueueHandler(_log_queue))
+
+
+def init_logging(filename=LOG_FILENAME, handler=None):
+    """
+    Start writing the log from a background thread. Called by the first log record otherwise
+    :param filename: Path of the log file, its directory is created if missing
+    :param handler: logging.Handler to write the log to instead of the file (ex: logging.StreamHandler())
+    :return: The handler the log is written to
+    """
+    global _shut_down
+    with _listener_lock:
+        _shut_down = False
+        if _listener is not None:
+            return _listener.handlers[0]
+        return _start_listener(filename, handler)
+
+
+def _start_listener(filename, handler=None):
+    """
+    Called with _listener_lock held
+    """
+    global _listener, _exit_registered
+    if handler is None:
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        handler = handlers.TimedRotatingFileHandler(filename, when='midnight')
+    if handler.formatter is None:
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    _listener = handlers.QueueListener(_log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    if not _exit_registered:
+        atexit.register(shutdown_logging)
+        _exit_registered = True
+    return handler
+
 
-# Create handler to output log to new file daily
-LOG_FILENAME = 'logs/upload_log'
-handler = logging.handlers.TimedRotatingFileHandler(LOG_FILENAME, when='midnight')
+def shutdown_logging():
+    """
+    Write the records still queued and stop the background thread (registered to run at exit). Records logged
+    afterwards are dropped until init_logging is called again
+    """
+    global _listener, _shut_down
+    with _listener_lock:
+        listener, _listener = _listener, None
+        _shut_down = True
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+class CachedCredentials(object):
+    """
+    Service account credentials for one key file and scope set, holding the access token in memory.
+
+    The token is minted once and refreshed in the background TOKEN_REFRESH_MARGIN seconds before it expires.
+    Refreshes are serialized by a lock and re-check the expiry once acquired, so concurrent callers share one exchange.
+    """
 
-# Create formatter for logging and add to logger
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+    def __init__(self, key_file, scopes):
+        """
+        :param key_file: Path of the json key file
+        :param scopes: Tuple of oauth scopes
+        """
+        self.key_file = key_file
+        self.scopes = scopes
+        self.credentials = ServiceAccountCredentials.from_json_keyfile_dict(load_key(key_file), scopes)
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def expires_in(self):
+        """
+        :return: Seconds until the current access token expires, None if there is no token yet
+        """
+        if not self.credentials.access_token or self.credentials.token_expiry is None:
+            return None
+        return (self.credentials.token_expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def _needs_refresh(self, margin):
+        expires_in = self.expires_in()
+        return expires_in is None or expires_in <= margin
+
+    def refresh(self, margin=0):
+        """
+        Exchange a new access token unless the current one is still valid for more than margin seconds
+        :param margin: Seconds of validity the current token must have left to be kept
+        """
+        if not self._needs_refresh(margin):
+            return
+
+        with self._lock:
+            # Another thread may have refreshed the token while we were waiting for the lock
+            if not self._needs_refresh(margin):
+                return
+            logger.debug("Refreshing access token for %s", ', '.join(self.scopes))
+            self.credentials.refresh(Http())
+            self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+        delay = max((self.expires_in() or 0) - TOKEN_REFRESH_MARGIN, 0)
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh(TOKEN_REFRESH_MARGIN)
+        except Exception as e:
+            logger.debug("Background refresh of access token failed: %s", e)
+
+    def get_access_token(self):
+        """
+        :return: A valid access token
+        """
+        self.refresh()
+        return self.credentials.access_token
+
+
+_key_cache = {}
+_credentials_cache = {}
+_cache_lock = threading.Lock()
+
+
+def load_key(key_file=None):
+    """
+    Get the parsed content of a json key file. Each file is only read once per process
+    :param key_file: Path of the json key file (defaults to STORAGE_KEY)
+    :return: Dict of the json key file
+    """
+    key_file = key_file or STORAGE_KEY
+    with _cache_lock:
+        key = _key_cache.get(key_file)
+    if key is None:
+        with open(key_file) as data:
+            key = json.load(data)
+        with _cache_lock:
+            key = _key_cache.setdefault(key_file, key)
+    return key
+
+
+def get_cached_credentials(scopes, key_file=None):
+    """
+    Get the process wide credentials of a key file and scope set, with a valid access token
+    :param scopes: An oauth scope or a list of them
+    :param key_file: Path of the json key file (defaults to STORAGE_KEY)
+    :return: CachedCredentials
+    """
+    if isinstance(scopes, str):
+        scopes = (scopes,)
+    scopes = tuple(sorted(set(scopes)))
+    cache_key = (key_file or STORAGE_KEY, scopes)
+
+    with _cache_lock:
+        cached = _credentials_cache.get(cache_key)
+    if cached is None:
+        cached = CachedCredentials(cache_key[0], scopes)
+        with _cache_lock:
+            cached = _credentials_cache.setdefault(cache_key, cached)
+
+    cached.refresh()
+    return cached
+
+
+def clear_credentials_cache():
+    """
+    Forget every parsed key file and access token (ex: after rotating STORAGE_KEY)
+    """
+    with _cache_lock:
+        cached = list(_credentials_cache.values())
+        _credentials_cache.clear()
+        _key_cache.clear()
+    for credentials in cached:
+        if credentials._timer is not None:
+            credentials._timer.cancel()
 
 
 def get_client_email_from_json():
@@ -43,12 +252,10 @@ def get_client_email_from_json():
     :return: Client Email
     """
     try:
-        with open(STORAGE_KEY) as data:
-            client_email = json.load(data)
-        return client_email['client_email']
+        return load_key()['client_email']
 
     except Exception as e:
-        logger.debug("Unable to get client email for credentials: %s" % e)
+        logger.debug("Unable to get client email for credentials: %s", e)
         return None
 
 
@@ -58,12 +265,10 @@ def get_private_key_from_json():
     :return: Private Key
     """
     try:
-        with open(STORAGE_KEY) as data:
-            private_key = json.load(data)
-        return private_key['private_key']
+        return load_key()['private_key']
 
     except Exception as e:
-        logger.debug("Unable to get private key for credentials: %s" % e)
+        logger.debug("Unable to get private key for credentials: %s", e)
         return None
 
 
@@ -73,33 +278,21 @@ def get_storage_credentials():
     :return: Google Cloud Credentials
     """
     try:
-        # ------------###############################---------------#
-        # Uncomment next few line and comment out line 75 if you are using older version of oauth2client
-        # client_email = get_client_email_from_json()
-        # private_key = get_private_key_from_json()
-        # credentials = SignedJwtAssertionCredentials(client_email, private_key,
-
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(STORAGE_KEY,
-                                                                'https://www.googleapis.com/auth/devstorage.read_write')
-        credentials.authorize(Http())
-        return credentials
+        return get_cached_credentials(STORAGE_SCOPE).credentials
 
     except Exception as e:
-        logger.debug("Unable to get credentials: %s" % e)
+        logger.debug("Unable to get credentials: %s", e)
         return None
 
 
 def get_compute_engine_credentials():
     """
-    Get the Google Cloud Storage Credentials
+    Get the Google Cloud Compute Engine Credentials
     :return: Google Cloud Credentials
     """
     try:
-        client_email = get_client_email_from_json()
-        private_key = get_private_key_from_json()
-        credentials = SignedJwtAssertionCredentials(client_email, private_key,
-                                                    'https://www.googleapis.com/auth/compute')
-        return credentials
+        return get_cached_credentials(COMPUTE_SCOPE).credentials
+
     except Exception as e:
-        logger.debug("Unable to get credentials: %s" % e)
+        logger.debug("Unable to get credentials: %s", e)
         return None
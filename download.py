@@ -4,52 +4,570 @@ Name: Google Cloud Storage Download
 Purpose: Download Files from a google cloud storage bucket
 """
 
+import http.client
 import io
+import os
+import threading
 import time
 import apiclient
+import httplib2
+import metrics
 
-from config import logger, STORAGE_BUCKET, get_storage_credentials
-from apiclient import discovery
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from urllib.parse import quote, urlsplit
+from apiclient.errors import HttpError
+from checksums import file_checksum, new_checksum, READ_SIZE
+from chunking import ChunkPolicy
+from clients import get_storage_service, get_endpoint, HTTP_TIMEOUT, NUM_RETRIES
+from compression import GZIP, UNCOMPRESSED_CHECKSUM_KEYS, compression_of, decompressor
+from config import logger, get_cached_credentials, STORAGE_BUCKET, STORAGE_SCOPE
+from journal import TransferJournal, DOWNLOAD
+from progress import Progress
 
 
-CHUNK_SIZE = 1024 * 1024 * 2
+CHUNK_SIZE = 1024 * 1024 * 2                    # First chunk of a range, the next ones adapt to the throughput
+MAX_DOWNLOAD_CHUNK_SIZE = 1024 * 1024 * 16      # Largest chunk, each download worker holds one in memory
 
+SLICED_DOWNLOAD_THRESHOLD = 1024 * 1024 * 64    # Objects at least this big are downloaded in slices
+SLICED_DOWNLOAD_SLICES = 8                      # Number of byte ranges the object is split into
+SLICED_DOWNLOAD_WORKERS = 8                     # Number of slices downloaded at the same time
 
-def download_file_from_storage(file_name, local_path, bucket=STORAGE_BUCKET):
+REMOTE_BLOCK_SIZE = 1024 * 1024                 # Bytes fetched by one ranged request of a file opened by open_remote
+REMOTE_READ_AHEAD = 4                           # Blocks fetched in the background ahead of a sequential reader
+REMOTE_CACHE_BLOCKS = 16                        # Blocks kept in the LRU cache of a file opened by open_remote
+
+# Compressed objects are streamed with http.client from this root: httplib2 reads whole responses in memory and
+# decompresses gzip ones itself, which also breaks ranged reads of their compressed bytes
+MEDIA_DOWNLOAD_ROOT = 'https://storage.googleapis.com/download/storage/v1'
+
+
+def download_file_from_storage(file_name, local_path, bucket=STORAGE_BUCKET, service=None, sliced=None,
+                               slices=SLICED_DOWNLOAD_SLICES, max_workers=SLICED_DOWNLOAD_WORKERS, resumable=True,
+                               stats=None, decompress=True, progress=None):
     """
     Download a file from the Google Cloud storage
     :param file_name: The name of the file on google cloud storage (include extension!)
     :param local_path: The local path to save the downloaded file to
     :param bucket: The bucket on Cloud
+    :param service: Storage service to use instead of the shared one
+    :param sliced: True to download byte ranges in parallel, False for a single stream,
+                   None to slice only objects of at least SLICED_DOWNLOAD_THRESHOLD bytes
+    :param slices: Number of byte ranges the object is split into when sliced
+    :param max_workers: Number of byte ranges downloaded at the same time when sliced
+    :param resumable: True to journal the progress of objects of at least SLICED_DOWNLOAD_THRESHOLD bytes so a rerun
+                      after a crash resumes where it stopped. Smaller objects are downloaded again from the start
+    :param stats: chunking.TransferStats filled with the bytes, chunk sizes and retries of the download
+    :param decompress: False to save objects compressed on upload as they are stored instead of decompressing them
+    :param progress: Called with (bytes downloaded, total bytes) at most every progress.PROGRESS_INTERVAL seconds
     :return: True if successful, False otherwise ---- if download of entire database, list of
                                                       datasets, with total size (last item) is returned
     """
+    check = local_path.endswith('/')
+    if check is not True:
+        local_path = local_path + '/'
+
+    return download_object(file_name, local_path+file_name, bucket, service, sliced, slices, max_workers,
+                           resumable=resumable, stats=stats, decompress=decompress, progress=progress)
+
+
+@metrics.timed('download.object')
+def download_object(file_name, path, bucket=STORAGE_BUCKET, service=None, sliced=None,
+                    slices=SLICED_DOWNLOAD_SLICES, max_workers=SLICED_DOWNLOAD_WORKERS, metadata=None, resumable=True,
+                    stats=None, decompress=True, progress=None):
+    """
+    Download a file from the Google Cloud storage to an exact local path, creating missing directories
+    :param file_name: The name of the file on google cloud storage
+    :param path: The local path of the downloaded file
+    :param bucket: The bucket on Cloud
+    :param service: Storage service to use instead of the shared one. Objects compressed on upload are streamed
+                    with http.client instead (see _download_compressed), which only follows clients.set_endpoint
+    :param sliced: True to download byte ranges in parallel, False for a single stream,
+                   None to slice only objects of at least SLICED_DOWNLOAD_THRESHOLD bytes
+    :param slices: Number of byte ranges the object is split into when sliced
+    :param max_workers: Number of byte ranges downloaded at the same time when sliced
+    :param metadata: size, crc32c, md5Hash, generation, contentEncoding and metadata of the object if already known
+                     (saves a request)
+    :param resumable: True to journal the progress of objects of at least SLICED_DOWNLOAD_THRESHOLD bytes so a rerun
+                      after a crash resumes where it stopped. Smaller objects are downloaded again from the start
+    :param stats: chunking.TransferStats filled with the bytes, chunk sizes and retries of a ranged download
+    :param decompress: False to save an object compressed on upload (see upload_file_in_chunks) as it is stored,
+                       True to decompress it while it is streamed to the local file
+    :param progress: Called with (bytes downloaded, total bytes) at most every progress.PROGRESS_INTERVAL seconds.
+                     Bytes are counted as they come over the network (compressed for a compressed object)
+    :return: True if successful, False otherwise
+    """
     try:
-        logger.info("Downloading file named %s from google cloud" % file_name)
-        service = discovery.build('storage', 'v1', credentials=get_storage_credentials())
+        logger.info("Downloading file named %s from google cloud", file_name)
+        service = get_storage_service(service)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        start = time.time()
+        reporter = Progress(progress)
+        policy = None
+        # The metadata tells how the object was compressed and what its checksum is, whatever the download path
+        if metadata is None:
+            metadata = service.objects().get(bucket=bucket, object=file_name,
+                                             fields='size,crc32c,md5Hash,generation,contentEncoding,'
+                                                    'metadata').execute(num_retries=NUM_RETRIES)
+        # Below the threshold a journal and ranged requests cost more than downloading the object again
+        large = int(metadata['size']) >= SLICED_DOWNLOAD_THRESHOLD
+        if sliced is None:
+            sliced = large
+        reporter.total = int(metadata['size'])
+
+        compression = compression_of(metadata)
+        if compression is not None:
+            # A compressed stream can only be decompressed in order, so it is not sliced nor journaled
+            policy = ChunkPolicy.fixed(READ_SIZE, stats, reporter)
+            downloaded = _download_compressed(bucket, file_name, path, metadata, compression, decompress, policy)
+        elif not sliced and not (resumable and large):
+            downloaded = _download_single_stream(service, bucket, file_name, path, metadata, reporter)
+            compression = 'none'
+        else:
+            journal = TransferJournal(DOWNLOAD, bucket, file_name, path) if resumable and large else None
+            policy = ChunkPolicy(CHUNK_SIZE, maximum=MAX_DOWNLOAD_CHUNK_SIZE, stats=stats, progress=reporter)
+            downloaded = _download_ranges(service, bucket, file_name, path, metadata, slices if sliced else 1,
+                                          max_workers, journal, policy)
+        if policy is not None:
+            policy.stats.finish()
+            metrics.record_transfer('download', policy.stats, compression=compression or 'none')
+            logger.debug("Downloaded %s: %s", file_name, policy.stats)
+        end = time.time()
 
-        req = service.objects().get_media(bucket=bucket, object=file_name)
+        if downloaded is not True:
+            return False
+        reporter.finish()
+        if policy is None:
+            metrics.increment('transfer.bytes', os.path.getsize(path), operation='download', compression=compression)
+
+        logger.info("Download completed!")
+        logger.info("Time to download: %d (sec)", end-start)
+
+        return True
+
+    except Exception as e:
+        logger.debug("Download Failed: %s", e)
+        return False
 
-        check = local_path.endswith('/')
-        if check is not True:
-            local_path = local_path + '/'
 
-        fh = io.FileIO(local_path+file_name, mode='wb')
+def open_remote(file_name, bucket=STORAGE_BUCKET, service=None, block_size=REMOTE_BLOCK_SIZE,
+                read_ahead=REMOTE_READ_AHEAD, cache_blocks=REMOTE_CACHE_BLOCKS, metadata=None):
+    """
+    Open a file of the Google Cloud storage as a read-only, seekable binary file read with ranged requests, so it can
+    be parsed or piped without a local copy (ex: zipfile.ZipFile(open_remote(name)), io.TextIOWrapper(...) for a csv).
+    Memory stays under (cache_blocks + read_ahead) * block_size whatever the size of the file
+    :param file_name: The name of the file on google cloud storage
+    :param bucket: The bucket on Cloud
+    :param service: Storage service to use instead of the shared one
+    :param block_size: Bytes fetched by one request
+    :param read_ahead: Blocks fetched in the background while the file is read sequentially, 0 to disable
+    :param cache_blocks: Blocks kept in memory, most recently used first
+    :param metadata: size and generation of the file if already known (saves a request)
+    :return: Buffered binary file object, to close once done (raises HttpError if the file does not exist)
+    """
+    service = get_storage_service(service)
+    if metadata is None:
+        metadata = service.objects().get(bucket=bucket, object=file_name, fields='size,generation').execute()
+
+    raw = _RemoteFile(service, bucket, file_name, metadata, block_size, read_ahead, cache_blocks)
+    return io.BufferedReader(raw)
+
+
+class _ChecksumWriter(object):
+    """
+    Write-only file hashing what is written to it, for MediaIoBaseDownload
+    """
+
+    def __init__(self, fh, checksum):
+        self._fh = fh
+        self.checksum = checksum
+
+    def write(self, data):
+        self.checksum.update(data)
+        return self._fh.write(data)
+
+
+def _download_single_stream(service, bucket, file_name, path, metadata, progress):
+    """
+    Download an object in a single stream of chunks, hashed as they are written and checked against the metadata
+    :return: True if successful, False otherwise
+    """
+    req = service.objects().get_media(bucket=bucket, object=file_name, generation=metadata['generation'])
+
+    with io.FileIO(path, mode='wb') as raw:
+        fh = _ChecksumWriter(raw, new_checksum(metadata))
         downloader = apiclient.http.MediaIoBaseDownload(fh, req, chunksize=CHUNK_SIZE)
         done = False
 
-        start = time.time()
         while not done:
-            status, done = downloader.next_chunk()
+            start = time.time()
+            try:
+                status, done = downloader.next_chunk(num_retries=NUM_RETRIES)
+            except Exception as e:
+                metrics.api_call('storage.objects.get', time.time() - start, e)
+                raise
+            metrics.api_call('storage.objects.get', time.time() - start)
             if status:
-                logger.info('Download %d%%.' % int(status.progress() * 100))
-        end = time.time()
+                progress.update(status.resumable_progress, status.total_size)
 
-        logger.info("Download completed!")
-        logger.info("Time to download: %d (sec)" % (end-start))
+    checksum = fh.checksum
+    if checksum.b64digest() != metadata[checksum.field]:
+        logger.debug("%s mismatch for %s: expected %s, got %s",
+                     checksum.field, file_name, metadata[checksum.field], checksum.b64digest())
+        os.remove(path)
+        return False
+    return True
+
+
+def _split_ranges(size, slices):
+    """
+    Split an object into contiguous byte ranges
+    :param size: Size of the object
+    :param slices: Maximum number of ranges
+    :return: List of (first byte, last byte) tuples
+    """
+    if size == 0:
+        return []
+    slices = max(1, min(slices, size // CHUNK_SIZE or 1))
+    step = -(-size // slices)
+    return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+
+def _preallocate(fd, size):
+    if hasattr(os, 'posix_fallocate') and size:
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass    # Not supported by every file system, a sparse file will do
+    os.ftruncate(fd, size)
+
+
+def _download_range(service, bucket, file_name, generation, fd, first, last, journal, policy):
+    """
+    Download one byte range of an object in chunks sized by the chunk policy, straight to its offset in the local
+    file, fetching again the chunks that failed with a transient error
+    """
+    offset = first
+    attempt = 0
+    while offset <= last:
+        chosen = policy.size()
+        end = min(offset + chosen, last + 1) - 1
+        req = service.objects().get_media(bucket=bucket, object=file_name, generation=generation)
+        req.headers['range'] = 'bytes=%d-%d' % (offset, end)
+        start = time.time()
+        try:
+            with metrics.span('download.chunk', offset=offset, size=end - offset + 1):
+                data = req.execute()
+        except Exception as e:
+            attempt += 1
+            if not policy.failed(e, attempt):
+                raise
+            logger.debug("Fetching bytes %d-%d of %s again after: %s", offset, end, file_name, e)
+            continue
+
+        attempt = 0
+        policy.record(len(data), time.time() - start, chosen)
+
+        if len(data) != end - offset + 1:
+            raise IOError("Expected %d bytes at offset %d, got %d" % (end - offset + 1, offset, len(data)))
+
+        chunk_start = offset
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            offset += written
+            view = view[written:]
+
+        if journal is not None:
+            journal.add_range(chunk_start, end)
 
+
+def _resume_state(journal, path, metadata):
+    """
+    Load the journal of a previous attempt, discarding it if the object or the local file changed since
+    :return: True if the download can resume from the journal
+    """
+    if journal is None or journal.load() is None:
+        return False
+
+    if journal.state.get('generation') != metadata['generation']:
+        journal.discard("object generation changed")
+    elif not os.path.exists(path) or os.path.getsize(path) != int(metadata['size']):
+        journal.discard("local file changed")
+    else:
         return True
+    return False
+
+
+def _download_ranges(service, bucket, file_name, path, metadata, slices, max_workers, journal, policy):
+    """
+    Download the byte ranges of an object concurrently into a preallocated file, skipping the ranges a previous
+    attempt already journaled, then check the checksum of the file (see checksums.new_checksum). The ranges share the
+    chunk policy
+    """
+    size = int(metadata['size'])
+    ranges = _split_ranges(size, slices)
+
+    if _resume_state(journal, path, metadata):
+        ranges = journal.missing_ranges(ranges)
+        if policy.progress is not None:
+            policy.progress.add(size - sum(last - first + 1 for first, last in ranges))
+        fd = os.open(path, os.O_RDWR)
+        logger.info("Resuming download of %s, %d bytes left", file_name, sum(b - a + 1 for a, b in ranges))
+    else:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        if journal is not None:
+            journal.save(generation=metadata['generation'], size=size, ranges=[])
+
+    if len(ranges) > 1:
+        logger.info("Downloading %s in %d slices", file_name, len(ranges))
+
+    try:
+        _preallocate(fd, size)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(_download_range, service, bucket, file_name, metadata['generation'], fd, first,
+                                   last, journal, policy) for first, last in ranges]
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+
+    if journal is not None:
+        journal.delete()
 
+    for field, value in file_checksum(path, metadata).items():
+        if value != metadata[field]:
+            logger.debug("%s mismatch for %s: expected %s, got %s", field, file_name, metadata[field], value)
+            os.remove(path)
+            return False
+
+    return True
+
+
+def _open_media(url, offset):
+    """
+    Send a GET of the media of an object with http.client, whose response can be read as it arrives and is left
+    compressed
+    :param url: Media url of the object
+    :param offset: First byte to get
+    :return: (connection, response), the connection to close once the response is read
+    """
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    connection = connection_class(parts.netloc, timeout=HTTP_TIMEOUT)
+    headers = {'Accept-Encoding': GZIP}
+    if get_endpoint() is None:
+        headers['Authorization'] = 'Bearer %s' % get_cached_credentials(STORAGE_SCOPE).get_access_token()
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+
+    start = time.time()
+    try:
+        connection.request('GET', '%s?%s' % (parts.path, parts.query), headers=headers)
+        resp = connection.getresponse()
+        if resp.status != (206 if offset else 200):
+            raise HttpError(httplib2.Response({'status': resp.status}), resp.read(), uri=url)
     except Exception as e:
-        logger.debug("Download Failed: %s" % e)
+        metrics.api_call('storage.objects.get', time.time() - start, e)
+        connection.close()
+        raise
+    metrics.api_call('storage.objects.get', time.time() - start)
+    return connection, resp
+
+
+def _download_compressed(bucket, file_name, path, metadata, compression, decompress, policy):
+    """
+    Stream an object compressed on upload to a local file, decompressing it on the way. A stream cut by a transient
+    error goes on from the last byte received. The checksum of the bytes received, and of the decompressed file when
+    the upload recorded it, are checked.
+
+    The storage service is bypassed: httplib2 reads a whole response in memory and decompresses gzip itself, so the
+    media is read with http.client from the server of clients.set_endpoint (or google cloud storage with the cached
+    credentials of STORAGE_SCOPE), on a connection of its own
+    :return: True if successful, False otherwise
+    """
+    endpoint = get_endpoint()
+    root = endpoint + '/download/storage/v1' if endpoint is not None else MEDIA_DOWNLOAD_ROOT
+    url = '%s/b/%s/o/%s?alt=media&generation=%s' % (root, quote(bucket, safe=''), quote(file_name, safe=''),
+                                                    metadata['generation'])
+    size = int(metadata['size'])
+    engine = decompressor(compression) if decompress else None
+    received = new_checksum(metadata)
+    custom = metadata.get('metadata') or {}
+    # Checksums of the uncompressed file recorded by the upload, by field of an object resource
+    recorded = dict((field, custom[key]) for field, key in UNCOMPRESSED_CHECKSUM_KEYS.items() if key in custom)
+    written = new_checksum(recorded or None)
+    offset = 0
+    attempt = 0
+
+    logger.info("Streaming %s compressed with %s", file_name, compression)
+    with open(path, 'wb') as fh:
+        while True:
+            first = offset
+            start = time.time()
+            try:
+                connection, resp = _open_media(url, offset)
+                try:
+                    if compression == GZIP and (resp.getheader('Content-Encoding') or '').lower() != GZIP:
+                        raise IOError("%s was not served compressed" % file_name)
+                    for block in iter(lambda: resp.read(READ_SIZE), b''):
+                        received.update(block)
+                        offset += len(block)
+                        data = engine.decompress(block) if engine is not None else block
+                        if data:
+                            fh.write(data)
+                            written.update(data)
+                    if offset < size:
+                        # http.client ends a response cut short like a complete one
+                        raise http.client.IncompleteRead(b'', size - offset)
+                finally:
+                    connection.close()
+            except Exception as e:
+                if offset > first:
+                    policy.record(offset - first, time.time() - start)
+                attempt = attempt + 1 if offset == first else 1
+                if not policy.failed(e, attempt):
+                    raise
+                logger.debug("Streaming %s again from byte %d after: %s", file_name, offset, e)
+                continue
+
+            policy.record(offset - first, time.time() - start)
+            break
+
+    if received.b64digest() != metadata[received.field]:
+        logger.debug("%s mismatch for %s: expected %s, got %s",
+                     received.field, file_name, metadata[received.field], received.b64digest())
+        os.remove(path)
         return False
+
+    if engine is not None:
+        expected = recorded.get(written.field)
+        if (compression == GZIP and not engine.eof) or (expected is not None and written.b64digest() != expected):
+            logger.debug("Decompressed %s does not match the uploaded file", file_name)
+            os.remove(path)
+            return False
+
+    return True
+
+
+class _RemoteFile(io.RawIOBase):
+    """
+    Read-only, seekable view of a file of the storage, read block by block with ranged requests of one generation of
+    the file (a file replaced while it is read does not mix two versions).
+
+    Blocks are kept in a small LRU cache, and reading a block right after the previous one fetches the next blocks in
+    the background.
+    """
+
+    def __init__(self, service, bucket, file_name, metadata, block_size, read_ahead, cache_blocks):
+        super(_RemoteFile, self).__init__()
+        self.name = file_name
+        self.size = int(metadata['size'])
+        self.generation = metadata['generation']
+        self._service = service
+        self._bucket = bucket
+        self._block_size = block_size
+        self._read_ahead = read_ahead
+        self._cache_blocks = max(cache_blocks, 1)
+        self._blocks = -(-self.size // block_size)
+        self._position = 0
+        self._last_block = None
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=read_ahead) if read_ahead > 0 else None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self._position
+        elif whence == io.SEEK_END:
+            position += self.size
+        self._position = min(max(position, 0), self.size)
+        return self._position
+
+    def _fetch(self, index):
+        first = index * self._block_size
+        last = min(first + self._block_size, self.size) - 1
+        req = self._service.objects().get_media(bucket=self._bucket, object=self.name, generation=self.generation)
+        req.headers['range'] = 'bytes=%d-%d' % (first, last)
+        with metrics.span('download.block', offset=first):
+            data = req.execute()
+
+        if len(data) != last - first + 1:
+            raise IOError("Expected %d bytes at offset %d, got %d" % (last - first + 1, first, len(data)))
+        return data
+
+    def _block(self, index):
+        with self._lock:
+            data = self._cache.get(index)
+            if data is not None:
+                self._cache.move_to_end(index)
+                return data
+            future = self._pending.pop(index, None)
+
+        try:
+            data = future.result() if future is not None else self._fetch(index)
+        except CancelledError:
+            data = self._fetch(index)
+
+        with self._lock:
+            self._cache[index] = data
+            while len(self._cache) > self._cache_blocks:
+                self._cache.popitem(last=False)
+        return data
+
+    def _prefetch(self, index):
+        """
+        Fetch the read_ahead blocks following index in the background, dropping the prefetches left by a previous
+        sequence of reads
+        """
+        window = range(index + 1, min(index + 1 + self._read_ahead, self._blocks))
+        with self._lock:
+            for ahead in list(self._pending):
+                if ahead not in window:
+                    self._pending.pop(ahead).cancel()
+            for ahead in window:
+                if ahead not in self._cache and ahead not in self._pending:
+                    self._pending[ahead] = self._pool.submit(self._fetch, ahead)
+
+    def readinto(self, buffer):
+        if self._position >= self.size:
+            return 0
+
+        index, offset = divmod(self._position, self._block_size)
+        data = self._block(index)
+
+        sequential = index == self._last_block + 1 if self._last_block is not None else index == 0
+        if self._pool is not None and sequential:
+            self._prefetch(index)
+        self._last_block = index
+
+        size = min(len(buffer), len(data) - offset)
+        memoryview(buffer)[:size] = memoryview(data)[offset:offset + size]
+        self._position += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            with self._lock:
+                for future in self._pending.values():
+                    future.cancel()
+                self._pending.clear()
+                self._cache.clear()
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+        super(_RemoteFile, self).close()
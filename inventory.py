@@ -0,0 +1,335 @@
+"""
+Name: Instance inventory
+
+Purpose: In-memory index of the google cloud compute engine instances of a zone (or of every zone of a project), built
+         by paging through instances().list (or aggregatedList) and trusted for a TTL, so looking up an instance or
+         its IP address does not cost an api call. vm_manager keeps it up to date when it creates, starts, stops or
+         deletes instances, and an expired listing is refreshed in the background while lookups keep being answered
+"""
+
+import threading
+import time
+
+from apiclient.errors import HttpError
+from clients import get_compute_service
+from config import logger
+
+
+INVENTORY_TTL = 30      # Seconds a listing of the instances is trusted, then it is listed again in the background
+PAGE_SIZE = 500         # Instances per page of the listing (maximum of the compute api)
+
+
+def _zone_name(instance):
+    return instance.get('zone', '').rsplit('/', 1)[-1] or None
+
+
+class Inventory(object):
+    """
+    Instances of a project keyed by (zone, name), instance names being only unique within a zone.
+
+    Instances changed by this process are marked stale and fetched again on their next lookup, the rest of the
+    index is listed again once the TTL expired. Only the first listing is waited for: an expired index keeps
+    answering lookups while a background thread lists the instances again.
+    """
+
+    def __init__(self, project, zone=None, service=None, ttl=INVENTORY_TTL):
+        """
+        :param project: Name of Project
+        :param zone: Zone of the instances, None for the instances of every zone (aggregatedList)
+        :param service: Compute service to use instead of the shared one
+        :param ttl: Seconds a listing is trusted
+        """
+        self.project = project
+        self.zone = zone
+        self.service = service
+        self.ttl = ttl
+        self._instances = {}
+        self._stale = set()         # (zone, name) of the instances to fetch again
+        self._touched = None        # (zone, name) of the instances changed while a refresh is listing the instances
+        self._listed_at = None
+        self._retry_at = 0          # Time before which a failed background listing is not tried again
+        self._refresher = None      # Thread listing the instances in the background
+        self._lock = threading.Lock()
+        self._refreshing = threading.RLock()
+
+    def _list(self):
+        """
+        Page through the instances
+        :return: Dict of (zone, name) to instance resource
+        """
+        compute = get_compute_service(self.service)
+        instances = {}
+        if self.zone is None:
+            req = compute.instances().aggregatedList(project=self.project, maxResults=PAGE_SIZE)
+            while req is not None:
+                resp = req.execute()
+                for scoped in resp.get('items', {}).values():
+                    for instance in scoped.get('instances', []):
+                        instances[(_zone_name(instance), instance['name'])] = instance
+                req = compute.instances().aggregatedList_next(req, resp)
+        else:
+            req = compute.instances().list(project=self.project, zone=self.zone, maxResults=PAGE_SIZE)
+            while req is not None:
+                resp = req.execute()
+                for instance in resp.get('items', []):
+                    instances[(_zone_name(instance) or self.zone, instance['name'])] = instance
+                req = compute.instances().list_next(req, resp)
+        return instances
+
+    def refresh(self):
+        """
+        List the instances again and replace the index
+        :return: Number of instances
+        """
+        with self._refreshing:
+            with self._lock:
+                self._touched = set()
+            try:
+                instances = self._list()
+            except Exception:
+                with self._lock:
+                    self._touched = None
+                raise
+
+            with self._lock:
+                # Changes made during the listing are newer than the listing
+                for key in self._touched:
+                    if key in self._instances:
+                        instances[key] = self._instances[key]
+                    else:
+                        instances.pop(key, None)
+                self._stale = set(key for key in self._stale if key in self._touched)
+                self._instances = instances
+                self._touched = None
+                self._listed_at = time.time()
+                logger.debug("Listed %d instances of %s", len(instances), self.zone or self.project)
+                return len(instances)
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.debug("Unable to list the instances of %s: %s", self.zone or self.project, e)
+            with self._lock:
+                self._retry_at = time.time() + self.ttl
+        finally:
+            with self._lock:
+                self._refresher = None
+
+    def _ensure_fresh(self):
+        listed_at = self._listed_at
+        now = time.time()
+        if listed_at is not None and now - listed_at < self.ttl:
+            return
+
+        if listed_at is None:
+            # Nothing to answer with yet
+            with self._refreshing:
+                # Another thread may have refreshed while this one waited
+                if self._listed_at is None:
+                    self.refresh()
+            return
+
+        with self._lock:
+            if self._refresher is not None or now < self._retry_at:
+                return
+            self._refresher = threading.Thread(target=self._refresh_in_background)
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def _key(self, name, zone=None):
+        """
+        Called with the lock held
+        :return: (zone, name) of an instance, the zone being None when it is not known
+        """
+        zone = zone or self.zone
+        if zone is None:
+            for key in self._instances:
+                if key[1] == name:
+                    return key
+        return zone, name
+
+    def _fetch(self, key, keep_stale=False):
+        """
+        Fetch an instance from the api. Only a 404 removes it from the index, other errors (ex: a transient 5xx or
+        429) are raised, or answered with the cached instance still marked stale when keep_stale is True
+        :return: Instance resource, None if it does not exist
+        """
+        zone, name = key
+        compute = get_compute_service(self.service)
+        try:
+            instance = compute.instances().get(project=self.project, zone=zone, instance=name).execute()
+        except HttpError as e:
+            if e.resp.status != 404:
+                return self._fetch_failed(key, e, keep_stale)
+            instance = None
+        except Exception as e:
+            return self._fetch_failed(key, e, keep_stale)
+
+        with self._lock:
+            self._stale.discard(key)
+            if instance is not None:
+                self._instances[key] = instance
+            else:
+                self._instances.pop(key, None)
+        return instance
+
+    def _fetch_failed(self, key, error, keep_stale):
+        logger.debug("Unable to get instance %s: %s", key[1], error)
+        if not keep_stale:
+            raise error
+        with self._lock:
+            return self._instances.get(key)
+
+    def get(self, name, fresh=False, zone=None):
+        """
+        :param name: Name of instance
+        :param fresh: True to fetch the instance from the api whatever the age of the index
+        :param zone: Zone of the instance, needed when the inventory covers every zone and several zones have an
+                     instance of that name
+        :return: Instance resource, None if there is no instance of that name. Raises the error of the api when
+                 fresh is True and the instance could not be fetched
+        """
+        self._ensure_fresh()
+        with self._lock:
+            key = self._key(name, zone)
+            instance = self._instances.get(key)
+            if key not in self._stale and not fresh:
+                return instance
+        if key[0] is None:
+            return instance
+        return self._fetch(key, keep_stale=not fresh)
+
+    def instances(self):
+        """
+        :return: List of instance resources
+        """
+        self._ensure_fresh()
+        with self._lock:
+            stale = list(self._stale)
+        for key in stale:
+            self._fetch(key, keep_stale=True)
+        with self._lock:
+            return list(self._instances.values())
+
+    def ip_address(self, name, zone=None):
+        """
+        :param name: Name of instance
+        :param zone: Zone of the instance, see get
+        :return: External IP address of the instance, None if it has none
+        """
+        instance = self.get(name, zone=zone)
+        if instance is not None and 'status' not in instance:
+            # Put from what creating it sent, the instance got its ephemeral address since
+            instance = self.get(name, True, zone)
+        try:
+            return instance['networkInterfaces'][0]['accessConfigs'][0]['natIP']
+        except (TypeError, KeyError, IndexError):
+            return None
+
+    def put(self, instance):
+        """
+        Add or replace an instance resource
+        """
+        key = (_zone_name(instance) or self.zone, instance['name'])
+        with self._lock:
+            self._instances[key] = instance
+            self._stale.discard(key)
+            if self._touched is not None:
+                self._touched.add(key)
+
+    def invalidate(self, name, zone=None):
+        """
+        Fetch an instance again on its next lookup (ex: it was started with a new IP address)
+        :param name: Name of instance
+        :param zone: Zone of the instance, needed when the inventory covers every zone
+        """
+        with self._lock:
+            key = self._key(name, zone)
+            if key[0] is not None:
+                self._stale.add(key)
+            if self._touched is not None:
+                self._touched.add(key)
+
+    def remove(self, name, zone=None):
+        """
+        Forget a deleted instance
+        :param name: Name of instance
+        :param zone: Zone of the instance, needed when the inventory covers every zone
+        """
+        with self._lock:
+            key = self._key(name, zone)
+            self._instances.pop(key, None)
+            self._stale.discard(key)
+            if self._touched is not None:
+                self._touched.add(key)
+
+    def clear(self):
+        """
+        Forget every instance, the next lookup lists them again
+        """
+        with self._lock:
+            self._instances = {}
+            self._stale = set()
+            self._listed_at = None
+
+
+_inventories = {}
+_lock = threading.Lock()
+
+
+def get_inventory(project, zone=None, service=None):
+    """
+    Get the shared inventory of a zone, created on first use
+    :param project: Name of Project
+    :param zone: Zone of the instances, None for every zone of the project
+    :param service: Compute service to use instead of the shared one
+    :return: Inventory
+    """
+    key = (project, zone, service)
+    inventory = _inventories.get(key)
+    if inventory is None:
+        with _lock:
+            inventory = _inventories.get(key)
+            if inventory is None:
+                inventory = _inventories[key] = Inventory(project, zone, service)
+    return inventory
+
+
+def _matching(project, zone):
+    with _lock:
+        return [inventory for (p, z, _), inventory in _inventories.items() if p == project and z in (zone, None)]
+
+
+def put(instance, project, zone):
+    """
+    Add an instance resource to the inventories of a zone (ex: built from what creating the instance sent)
+    """
+    instance = dict(instance)
+    instance.setdefault('zone', zone)
+    for inventory in _matching(project, zone):
+        inventory.put(instance)
+
+
+def invalidate(name, project, zone):
+    """
+    Make the inventories of a zone fetch an instance again on its next lookup
+    """
+    for inventory in _matching(project, zone):
+        inventory.invalidate(name, zone)
+
+
+def remove(name, project, zone):
+    """
+    Remove a deleted instance from the inventories of a zone
+    """
+    for inventory in _matching(project, zone):
+        inventory.remove(name, zone)
+
+
+def reset():
+    """
+    Drop every inventory
+    """
+    with _lock:
+        _inventories.clear()
@@ -0,0 +1,115 @@
+"""
+Name: Transfer journal
+
+Purpose: Persist the progress of uploads and downloads to small local files, so a transfer interrupted by a crash or a
+         restart resumes where it stopped instead of starting again from byte zero
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from config import logger, JOURNAL_DIR
+
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+
+class TransferJournal(object):
+    """
+    State of one transfer, identified by its direction, bucket, object name and local path.
+
+    Uploads keep the resumable session uri and the offset committed by the server. Downloads keep the generation of
+    the object and the byte ranges already written to the local file.
+    """
+
+    def __init__(self, direction, bucket, name, local_path, directory=None):
+        """
+        :param direction: UPLOAD or DOWNLOAD
+        :param bucket: The bucket on Cloud
+        :param name: Name of the object
+        :param local_path: Path of the local file
+        :param directory: Directory of the journal files (defaults to JOURNAL_DIR)
+        """
+        key = '%s|%s|%s|%s' % (direction, bucket, name, os.path.abspath(local_path))
+        self.path = os.path.join(directory or JOURNAL_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+        self.state = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        :return: State saved by a previous attempt, None if there is none
+        """
+        try:
+            with open(self.path) as data:
+                self.state = json.load(data)
+            return self.state
+        except (IOError, ValueError):
+            self.state = {}
+            return None
+
+    def save(self, **state):
+        """
+        Update the state and write it atomically
+        """
+        with self._lock:
+            self.state.update(state)
+            self._write()
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as data:
+            json.dump(self.state, data)
+        os.replace(tmp, self.path)
+
+    def add_range(self, first, last):
+        """
+        Record that bytes first to last (included) of a download are on disk, merging contiguous ranges
+        """
+        with self._lock:
+            ranges = sorted(self.state.get('ranges', []) + [[first, last]])
+            merged = [ranges[0]]
+            for start, end in ranges[1:]:
+                if start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.state['ranges'] = merged
+            self._write()
+
+    def missing_ranges(self, ranges):
+        """
+        Remove the bytes already downloaded from a list of ranges
+        :param ranges: List of (first byte, last byte) tuples
+        :return: List of (first byte, last byte) tuples still to download
+        """
+        done = self.state.get('ranges', [])
+        missing = []
+        for first, last in ranges:
+            for start, end in done:
+                if end < first or start > last:
+                    continue
+                if start > first:
+                    missing.append((first, start - 1))
+                first = max(first, end + 1)
+            if first <= last:
+                missing.append((first, last))
+        return missing
+
+    def delete(self):
+        """
+        Forget the transfer (once it succeeded or when its state became invalid)
+        """
+        with self._lock:
+            self.state = {}
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def discard(self, reason):
+        logger.debug("Discarding journal %s: %s", self.path, reason)
+        self.delete()
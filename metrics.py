@@ -0,0 +1,448 @@
+"""
+Name: Metrics
+
+Purpose: Record latency histograms, counters (bytes transferred, retries, api calls per endpoint) and the wait time of
+         compute engine operations, and send them to pluggable sinks: in memory, StatsD over udp or a Prometheus text
+         exporter. Optional tracing spans show where the time of a call goes. Nothing is recorded until a sink is added
+         (or tracing enabled), so the instrumentation costs almost nothing by default
+"""
+
+import bisect
+import functools
+import itertools
+import socket
+import threading
+import time
+
+from collections import deque, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import logger
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)   # Seconds
+THROUGHPUT_BUCKETS = tuple(1024 * 1024 * 2 ** power for power in range(-4, 12))                       # Bytes/sec
+BUCKETS = {'transfer.throughput': THROUGHPUT_BUCKETS}   # Buckets of histograms that are not latencies
+STATSD_ADDRESS = ('127.0.0.1', 8125)
+METRICS_PREFIX = 'gcloud'                               # Prefix of the metric names sent to StatsD and Prometheus
+MAX_SPANS = 10000                                       # Finished spans kept by a SpanRecorder
+
+Span = namedtuple('Span', ['name', 'span_id', 'parent_id', 'start', 'seconds', 'tags', 'error'])
+
+
+class Histogram(object):
+    """
+    Count of observations per bucket, with their sum
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)     # The last one counts observations above every bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip(self.buckets + (float('inf'),), itertools.accumulate(self.counts)))}
+
+
+class Sink(object):
+    """
+    Receives every metric. Subclasses override count and observe
+    """
+
+    def count(self, name, value, tags):
+        """
+        :param name: Name of the counter
+        :param value: Amount added
+        :param tags: Tuple of (tag, value) pairs
+        """
+
+    def observe(self, name, value, tags):
+        """
+        :param name: Name of the histogram
+        :param value: Observed value (seconds for latencies)
+        :param tags: Tuple of (tag, value) pairs
+        """
+
+
+class MemorySink(Sink):
+    """
+    Aggregates the metrics in memory, read with snapshot()
+    """
+
+    def __init__(self):
+        self.counters = {}      # (name, tags) to total
+        self.histograms = {}    # (name, tags) to Histogram
+        self._lock = threading.Lock()
+
+    def count(self, name, value, tags):
+        with self._lock:
+            self.counters[(name, tags)] = self.counters.get((name, tags), 0) + value
+
+    def observe(self, name, value, tags):
+        with self._lock:
+            histogram = self.histograms.get((name, tags))
+            if histogram is None:
+                histogram = self.histograms[(name, tags)] = Histogram(BUCKETS.get(name, LATENCY_BUCKETS))
+            histogram.observe(value)
+
+    def snapshot(self):
+        """
+        :return: {'counters': [(name, tags dict, total)], 'histograms': [(name, tags dict, histogram dict)]}
+        """
+        with self._lock:
+            return {
+                'counters': [(name, dict(tags), total) for (name, tags), total in sorted(self.counters.items())],
+                'histograms': [(name, dict(tags), histogram.as_dict())
+                               for (name, tags), histogram in sorted(self.histograms.items())],
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+def _prometheus_name(name, prefix):
+    return ''.join(c if c.isalnum() else '_' for c in '%s_%s' % (prefix, name))
+
+
+def _prometheus_labels(tags, extra=()):
+    labels = tuple(tags) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in labels)
+
+
+class PrometheusSink(MemorySink):
+    """
+    Aggregates the metrics in memory and renders them in the Prometheus text format, served by serve() on /metrics
+    """
+
+    def __init__(self, prefix=METRICS_PREFIX):
+        super(PrometheusSink, self).__init__()
+        self.prefix = prefix
+        self.server = None
+
+    def render(self):
+        """
+        :return: Metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = [(key, histogram.buckets, list(histogram.counts), histogram.sum, histogram.count)
+                          for key, histogram in sorted(self.histograms.items())]
+
+        typed = set()
+        for (name, tags), total in counters:
+            metric = _prometheus_name(name, self.prefix) + '_total'
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE %s counter' % metric)
+            lines.append('%s%s %s' % (metric, _prometheus_labels(tags), total))
+
+        for (name, tags), buckets, counts, total, count in histograms:
+            metric = _prometheus_name(name, self.prefix)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE %s histogram' % metric)
+            for bound, cumulative in zip(buckets + (float('inf'),), itertools.accumulate(counts)):
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append('%s_bucket%s %d' % (metric, _prometheus_labels(tags, (('le', le),)), cumulative))
+            lines.append('%s_sum%s %s' % (metric, _prometheus_labels(tags), repr(total)))
+            lines.append('%s_count%s %d' % (metric, _prometheus_labels(tags), count))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, address=''):
+        """
+        Serve the metrics on http://address:port/metrics from a background thread
+        :return: The http server (port 0 picks a free port, see server.server_address)
+        """
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = sink.render().encode('utf-8')
+                self.send_response(200 if self.path.split('?')[0] == '/metrics' else 404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, name='metrics-exporter')
+        thread.daemon = True
+        thread.start()
+        return self.server
+
+
+class StatsdSink(Sink):
+    """
+    Sends every metric as a StatsD udp datagram (DogStatsD tags), without waiting for anything
+    """
+
+    def __init__(self, address=STATSD_ADDRESS, prefix=METRICS_PREFIX):
+        """
+        :param address: (host, port) of the StatsD agent
+        :param prefix: Prefix of the metric names
+        """
+        self.address = address
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _send(self, name, value, kind, tags):
+        line = '%s.%s:%s|%s' % (self.prefix, name, value, kind)
+        if tags:
+            line += '|#' + ','.join('%s:%s' % tag for tag in tags)
+        try:
+            self._socket.sendto(line.encode('utf-8'), self.address)
+        except OSError:
+            pass    # Metrics are best effort, a full buffer or a missing agent drops them
+
+    def count(self, name, value, tags):
+        self._send(name, value, 'c', tags)
+
+    def observe(self, name, value, tags):
+        if name.endswith('seconds'):
+            self._send(name, '%.3f' % (value * 1000), 'ms', tags)
+        else:
+            self._send(name, value, 'h', tags)
+
+    def close(self):
+        self._socket.close()
+
+
+class SpanRecorder(object):
+    """
+    Keeps the last finished spans
+    """
+
+    def __init__(self, max_spans=MAX_SPANS):
+        self.spans = deque(maxlen=max_spans)
+
+    def record(self, span):
+        self.spans.append(span)
+
+    def summary(self):
+        """
+        :return: List of (span name, count, total seconds), most time first
+        """
+        totals = {}
+        for span in list(self.spans):
+            count, seconds = totals.get(span.name, (0, 0.0))
+            totals[span.name] = (count + 1, seconds + span.seconds)
+        return sorted(((name, count, seconds) for name, (count, seconds) in totals.items()),
+                      key=lambda item: -item[2])
+
+    def children(self, span_id):
+        """
+        :return: Spans started inside a span (on the same thread)
+        """
+        return [span for span in list(self.spans) if span.parent_id == span_id]
+
+
+_sinks = ()
+_tracer = None
+_lock = threading.Lock()
+_local = threading.local()
+_span_ids = itertools.count(1)
+
+
+def add_sink(sink):
+    """
+    Send the metrics to a sink from now on
+    :return: The sink
+    """
+    global _sinks
+    with _lock:
+        _sinks = _sinks + (sink,)
+    return sink
+
+
+def remove_sink(sink):
+    global _sinks
+    with _lock:
+        _sinks = tuple(s for s in _sinks if s is not sink)
+
+
+def enable_tracing(recorder=None):
+    """
+    Record spans from now on
+    :param recorder: Object whose record(span) is called with every finished span, a new SpanRecorder by default
+    :return: The recorder
+    """
+    global _tracer
+    _tracer = recorder if recorder is not None else SpanRecorder()
+    return _tracer
+
+
+def disable_tracing():
+    global _tracer
+    _tracer = None
+
+
+def reset():
+    """
+    Remove every sink and stop tracing
+    """
+    global _sinks
+    with _lock:
+        _sinks = ()
+    disable_tracing()
+
+
+def _tags(tags):
+    return tuple(sorted((key, str(value)) for key, value in tags.items()))
+
+
+def increment(name, value=1, **tags):
+    """
+    Add to a counter
+    """
+    sinks = _sinks
+    if not sinks:
+        return
+    tags = _tags(tags)
+    for sink in sinks:
+        try:
+            sink.count(name, value, tags)
+        except Exception as e:
+            logger.debug("Metrics sink %s failed: %s", sink, e)
+
+
+def observe(name, value, **tags):
+    """
+    Add an observation to a histogram
+    """
+    sinks = _sinks
+    if not sinks:
+        return
+    tags = _tags(tags)
+    for sink in sinks:
+        try:
+            sink.observe(name, value, tags)
+        except Exception as e:
+            logger.debug("Metrics sink %s failed: %s", sink, e)
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _ActiveSpan(object):
+
+    def __init__(self, tracer, name, tags):
+        self.tracer = tracer
+        self.name = name
+        self.tags = tags
+        self.span_id = next(_span_ids)
+
+    def __enter__(self):
+        stack = getattr(_local, 'spans', None)
+        if stack is None:
+            stack = _local.spans = []
+        self.parent_id = stack[-1] if stack else None
+        stack.append(self.span_id)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.time() - self.start
+        _local.spans.pop()
+        try:
+            self.tracer.record(Span(self.name, self.span_id, self.parent_id, self.start, seconds, self.tags,
+                                    repr(exc_value) if exc_value is not None else None))
+        except Exception as e:
+            logger.debug("Tracer failed: %s", e)
+        return False
+
+
+def span(name, **tags):
+    """
+    Trace a block of code, nested in the span the thread is in
+    :return: Context manager, doing nothing when tracing is disabled
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _ActiveSpan(tracer, name, tags)
+
+
+def timed(name, **tags):
+    """
+    Decorator recording the latency of every call in the histogram <name>.seconds, tagged with result=ok when the
+    function returned something truthy and result=failed otherwise (the functions of this repository return False or
+    None when they fail), and tracing the call as a span
+    """
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _sinks and _tracer is None:
+                return function(*args, **kwargs)
+
+            start = time.time()
+            result = None
+            try:
+                with span(name, **tags):
+                    result = function(*args, **kwargs)
+                return result
+            finally:
+                observe(name + '.seconds', time.time() - start, result='ok' if result else 'failed', **tags)
+
+        return wrapper
+
+    return decorator
+
+
+def api_call(endpoint, seconds, error=None):
+    """
+    Count a request to a google cloud api
+    :param endpoint: Method of the api (ex: storage.objects.insert) or batch
+    :param seconds: Time the request took
+    :param error: Exception raised by the request
+    """
+    if not _sinks:
+        return
+    increment('api.calls', endpoint=endpoint)
+    observe('api.seconds', seconds, endpoint=endpoint)
+    if error is not None:
+        increment('api.errors', endpoint=endpoint, status=getattr(getattr(error, 'resp', None), 'status', 'network'))
+
+
+def record_transfer(operation, stats, **tags):
+    """
+    Record the bytes, retries and throughput of a finished transfer
+    :param operation: upload or download
+    :param stats: chunking.TransferStats of the transfer
+    """
+    if not _sinks:
+        return
+    increment('transfer.bytes', stats.bytes, operation=operation, **tags)
+    increment('transfer.chunks', stats.chunks, operation=operation, **tags)
+    if stats.retries:
+        increment('transfer.retries', stats.retries, operation=operation, **tags)
+    if stats.bytes:
+        observe('transfer.throughput', stats.throughput(), operation=operation, **tags)
@@ -0,0 +1,234 @@
+"""
+Name: Operation waiter
+
+Purpose: Wait for many google cloud compute engine zone operations together, polling their status in batch requests
+         with jittered exponential backoff, per-operation deadlines and operation errors raised as exceptions
+"""
+
+import random
+import threading
+import time
+import metrics
+
+from apiclient.errors import HttpError
+from batch import BatchItem
+from clients import get_compute_service
+from config import logger
+
+
+OPERATION_TIMEOUT = 600     # Seconds an operation may take before it is reported as timed out
+MIN_POLL_INTERVAL = 1       # Seconds between the first status checks
+MAX_POLL_INTERVAL = 20      # Upper bound of the backoff between status checks
+BATCH_SIZE = 100            # Maximum number of status checks in a single batch request
+
+
+class OperationError(Exception):
+    """
+    Raised when an operation finished with an error payload
+    """
+
+    def __init__(self, operation):
+        errors = operation.get('error', {}).get('errors', [])
+        message = '; '.join('%s: %s' % (error.get('code'), error.get('message')) for error in errors)
+        super(OperationError, self).__init__("Operation %s failed: %s" % (operation.get('name'), message))
+        self.operation = operation
+        self.errors = errors
+
+
+class OperationTimeout(Exception):
+    """
+    Raised when an operation is not done before its deadline
+    """
+
+
+class OperationWaiter(object):
+    """
+    Tracks pending zone operations and checks all of them in each polling round.
+
+    Operations can be added at any time, from any thread, including from the callback of another operation, which
+    lets a caller chain work (ex: insert a VM once its disk is ready) on a single polling loop. Operation names are
+    only unique within a zone, so operations and their results are keyed by (zone, operation name).
+    """
+
+    def __init__(self, service=None, timeout=OPERATION_TIMEOUT, min_interval=MIN_POLL_INTERVAL,
+                 max_interval=MAX_POLL_INTERVAL):
+        """
+        :param service: Compute service to use instead of the shared one
+        :param timeout: Default deadline (sec) of every operation
+        :param min_interval: Seconds between the first status checks
+        :param max_interval: Upper bound of the backoff between status checks
+        """
+        self.service = service
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.results = {}
+        self._pending = {}
+        self._stopped = False
+        self._added = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def add(self, project, zone, operation, timeout=None, callback=None):
+        """
+        Start tracking an operation
+        :param project: Project name on google cloud
+        :param zone: Zone of the operation
+        :param operation: Name of the operation, or the operation resource returned by an insert/delete call
+        :param timeout: Deadline (sec) of this operation, defaults to the waiter timeout
+        :param callback: Called with (operation resource, exception) once the operation is done, failed or timed out
+        :return: (zone, operation name), the key of the operation in the results
+        """
+        key = (zone, operation['name'] if isinstance(operation, dict) else operation)
+        added = time.time()
+        deadline = added + (timeout if timeout is not None else self.timeout)
+        with self._lock:
+            self._pending[key] = (project, deadline, callback, added)
+            self._added += 1
+            self._changed.notify_all()
+        return key
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _finish(self, key, result, error):
+        with self._lock:
+            project, deadline, callback, added = self._pending.pop(key)
+            self.results[key] = BatchItem(result, error)
+
+        if isinstance(error, OperationTimeout):
+            outcome = 'timeout'
+        else:
+            outcome = 'ok' if error is None else 'error'
+        metrics.observe('operation.wait.seconds', time.time() - added, result=outcome,
+                        operation_type=(result or {}).get('operationType', 'unknown'))
+
+        if callback is not None:
+            try:
+                callback(result, error)
+            except Exception as e:
+                logger.debug("Callback of operation %s failed: %s", key[1], e)
+
+    def _check(self, operations):
+        """
+        Get the status of operations in batch requests
+        :param operations: List of ((zone, operation name), project)
+        :return: Dict of (zone, operation name) to (operation resource, exception)
+        """
+        compute = get_compute_service(self.service)
+        statuses = {}
+
+        for i in range(0, len(operations), BATCH_SIZE):
+            chunk = operations[i:i + BATCH_SIZE]
+
+            def callback(request_id, response, exception, chunk=chunk):
+                statuses[chunk[int(request_id)][0]] = (response, exception)
+
+            batch = compute.new_batch_http_request(callback=callback)
+            for index, ((zone, name), project) in enumerate(chunk):
+                batch.add(compute.zoneOperations().get(project=project, zone=zone, operation=name),
+                          request_id=str(index))
+            start = time.time()
+            try:
+                batch.execute()
+            except Exception as e:
+                metrics.api_call('batch', time.time() - start, e)
+                logger.debug('Checking if operations are completed failed: %s', e)
+            else:
+                metrics.api_call('batch', time.time() - start)
+            metrics.increment('api.batched_requests', len(chunk))
+
+        return statuses
+
+    def poll(self):
+        """
+        Check every pending operation once, finishing those that are done, failed or past their deadline
+        :return: Number of operations still pending
+        """
+        with self._lock:
+            operations = [(key, project) for key, (project, _, _, _) in self._pending.items()]
+
+        now = time.time()
+        for key, (result, error) in self._check(operations).items():
+            if error is not None:
+                # 4xx other than rate limiting will not get better by asking again
+                if isinstance(error, HttpError) and 400 <= error.resp.status < 500 and error.resp.status != 429:
+                    self._finish(key, None, error)
+                else:
+                    logger.debug('Checking if operation %s is completed failed: %s', key[1], error)
+            elif result.get('status') == 'DONE':
+                if result.get('error'):
+                    self._finish(key, result, OperationError(result))
+                else:
+                    self._finish(key, result, None)
+
+        with self._lock:
+            expired = [key for key, (_, deadline, _, _) in self._pending.items() if deadline <= now]
+        for key in expired:
+            self._finish(key, None, OperationTimeout("Operation %s not done after its deadline" % key[1]))
+
+        return self.pending()
+
+    def wait(self, stop_when_idle=True):
+        """
+        Poll until every operation is finished, including operations added by callbacks while waiting
+        :param stop_when_idle: False to keep waiting for new operations (until stop() is called)
+        :return: Dict of (zone, operation name) to BatchItem(operation resource, exception)
+        """
+        logger.debug('Waiting for operations to finish...')
+        interval = self.min_interval
+        added = None
+        while True:
+            with self._lock:
+                while not self._pending and not stop_when_idle and not self._stopped:
+                    self._changed.wait()
+                if not self._pending or self._stopped:
+                    return dict(self.results)
+                # New operations are checked soon, whatever the backoff of the older ones reached
+                if added != self._added:
+                    added = self._added
+                    interval = self.min_interval
+
+            if self.poll():
+                self._sleep(random.uniform(self.min_interval, interval), added)
+                interval = min(interval * 2, self.max_interval)
+
+    def _sleep(self, delay, added):
+        """
+        Wait between two polling rounds. An operation added meanwhile cuts the wait to min_interval, so it is checked
+        soon whatever the backoff of the older ones reached, and stop() ends it
+        :param added: Number of operations added when the round started
+        """
+        end = time.time() + delay
+        with self._lock:
+            while not self._stopped:
+                if self._added != added:
+                    added = self._added
+                    end = min(end, time.time() + self.min_interval)
+                left = end - time.time()
+                if left <= 0:
+                    return
+                self._changed.wait(left)
+
+    def stop(self):
+        """
+        Make a wait(stop_when_idle=False) return
+        """
+        with self._lock:
+            self._stopped = True
+            self._changed.notify_all()
+
+
+def wait_for_operations(operations, service=None, timeout=OPERATION_TIMEOUT):
+    """
+    Wait for many operations together
+    :param operations: List of (project, zone, operation name or resource)
+    :param service: Compute service to use instead of the shared one
+    :param timeout: Deadline (sec) of every operation
+    :return: Dict of (zone, operation name) to BatchItem(operation resource, exception)
+    """
+    waiter = OperationWaiter(service, timeout)
+    for project, zone, operation in operations:
+        waiter.add(project, zone, operation)
+    return waiter.wait()
@@ -0,0 +1,77 @@
+"""
+Name: Transfer progress
+
+Purpose: Report the progress of an upload or a download to a callback at most every PROGRESS_INTERVAL seconds, however
+         many chunks and concurrent requests the transfer is made of
+"""
+
+import threading
+import time
+
+from config import logger
+
+
+PROGRESS_INTERVAL = 1.0     # Minimum seconds between two calls of a progress callback
+
+
+class Progress(object):
+    """
+    Bytes transferred so far, reported as callback(bytes done, total bytes). The total is None when it is not known
+    (ex: a stream). Thread-safe, the callback is called outside the lock, and an exception it raises is logged and
+    ignored.
+    """
+
+    def __init__(self, callback, total=None, interval=PROGRESS_INTERVAL):
+        """
+        :param callback: Called with (bytes done, total bytes), None to report nothing
+        :param total: Size of the transfer if known
+        :param interval: Minimum seconds between two calls
+        """
+        self.callback = callback
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self._reported = None       # Time of the last call
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        """
+        Count bytes transferred
+        """
+        if self.callback is None:
+            return
+        with self._lock:
+            self.done += count
+        self._report(False)
+
+    def update(self, done, total=None):
+        """
+        Set the bytes transferred so far
+        """
+        if self.callback is None:
+            return
+        with self._lock:
+            self.done = done
+            if total is not None:
+                self.total = total
+        self._report(False)
+
+    def finish(self):
+        """
+        Report the final progress, whenever the last call was
+        """
+        if self.callback is not None:
+            self._report(True)
+
+    def _report(self, force):
+        now = time.time()
+        with self._lock:
+            if not force and self._reported is not None and now - self._reported < self.interval:
+                return
+            self._reported = now
+            done, total = self.done, self.total
+
+        try:
+            self.callback(done, total)
+        except Exception as e:
+            logger.debug("Progress callback failed: %s", e)
@@ -0,0 +1,385 @@
+"""
+Name: Serve images from storage
+
+Purpose: Small http server serving the objects of STORAGE_BUCKET (GET /<object name>) from a size bounded LRU cache on
+         the local disk, so an image is only downloaded from google cloud storage the first time it is asked for.
+         Supports Range requests and conditional requests (the ETag is the generation of the object), and concurrent
+         requests for an object that is not cached yet wait for a single download
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+from apiclient.errors import HttpError
+from clients import get_storage_service
+from compression import ZSTD, UNCOMPRESSED_TYPE_KEY, compression_of
+from config import logger, STORAGE_BUCKET
+from download import download_object
+
+
+SERVER_ADDRESS = ''                         # Interface the server listens on, all of them by default
+SERVER_PORT = 8080                          # Port the server listens on
+CACHE_DIR = 'image_cache'                   # Directory of the cached objects
+CACHE_SIZE = 1024 * 1024 * 1024             # Bytes of cached objects kept on disk
+METADATA_TTL = 30                           # Seconds the generation of an object is trusted before it is checked again
+METADATA_ENTRIES = 100000                   # Objects whose metadata is kept in memory, oldest fetched dropped first
+CACHE_CONTROL = 'public, max-age=300'       # Cache-Control header of the responses
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class DiskCache(object):
+    """
+    Files of objects kept in a directory, the least recently used deleted once the cache is over its size.
+
+    A file is named after the object and its generation, so a new generation of an object is a new entry (the older
+    one is deleted). Files are opened under the lock, so one evicted while it is being sent is still read to the end.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_SIZE):
+        """
+        :param directory: Directory of the cached files, created if missing. Files left by a previous run are kept
+        :param max_bytes: Size of the cache, the most recent entry is kept even if it is bigger
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.partial = os.path.join(directory, 'partial')
+        self._entries = OrderedDict()     # File name to size, least recently used first
+        self._current = {}                # Object digest to the file name of its cached generation
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        shutil.rmtree(self.partial, ignore_errors=True)
+        os.makedirs(self.partial)
+        files = []
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_atime, entry.name, stat.st_size))
+        for _, filename, size in sorted(files):
+            self._add(filename, size)
+        self._evict()
+
+    @staticmethod
+    def key(name, generation):
+        """
+        :return: File name of a generation of an object
+        """
+        return '%s-%s' % (hashlib.sha256(name.encode('utf-8')).hexdigest(), generation)
+
+    def _add(self, filename, size):
+        digest = filename.split('-', 1)[0]
+        older = self._current.get(digest)
+        if older is not None and older != filename:
+            self._remove(older)
+        self._current[digest] = filename
+        self._bytes += size - self._entries.pop(filename, 0)
+        self._entries[filename] = size
+
+    def _remove(self, filename):
+        self._bytes -= self._entries.pop(filename, 0)
+        digest = filename.split('-', 1)[0]
+        if self._current.get(digest) == filename:
+            del self._current[digest]
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except OSError as e:
+            logger.debug("Unable to delete cached file %s: %s", filename, e)
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+
+    def open(self, key):
+        """
+        :return: Cached file opened for reading, None if the entry is not cached
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            try:
+                return open(os.path.join(self.directory, key), 'rb')
+            except OSError:
+                self._remove(key)
+                return None
+
+    def partial_path(self, key):
+        """
+        :return: Path to download an entry to before it is added
+        """
+        return os.path.join(self.partial, key)
+
+    def add(self, key):
+        """
+        Move a downloaded file into the cache, evicting the least recently used entries above the size of the cache
+        """
+        path = self.partial_path(key)
+        size = os.path.getsize(path)
+        os.replace(path, os.path.join(self.directory, key))
+        with self._lock:
+            self._add(key, size)
+            self._evict()
+
+    def size(self):
+        """
+        :return: Bytes of cached files
+        """
+        with self._lock:
+            return self._bytes
+
+
+class ImageStore(object):
+    """
+    Objects of a bucket read through a disk cache, with their metadata trusted for METADATA_TTL. Concurrent requests
+    missing the same metadata or object share one call to google cloud storage.
+    """
+
+    def __init__(self, bucket=STORAGE_BUCKET, service=None, cache=None, metadata_ttl=METADATA_TTL):
+        """
+        :param bucket: The bucket on Cloud
+        :param service: Storage service to use instead of the shared one
+        :param cache: DiskCache, one in CACHE_DIR by default
+        :param metadata_ttl: Seconds the metadata of an object is trusted
+        """
+        self.bucket = bucket
+        self.service = service
+        self.cache = cache if cache is not None else DiskCache()
+        self.metadata_ttl = metadata_ttl
+        self._metadata = OrderedDict()      # Name of object to (time fetched, metadata or None if it does not exist)
+        self._flights = {}                  # Key of a call in progress to its Future
+        self._lock = threading.Lock()
+
+    def _single_flight(self, key, function):
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+
+        if leader:
+            try:
+                future.set_result(function())
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._flights[key]
+        return future.result()
+
+    def _fetch_metadata(self, name):
+        service = get_storage_service(self.service)
+        try:
+            metadata = service.objects().get(bucket=self.bucket, object=name,
+                                             fields='size,crc32c,md5Hash,generation,contentType,contentEncoding,'
+                                                    'metadata').execute()
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            metadata = None
+        with self._lock:
+            self._metadata.pop(name, None)
+            self._metadata[name] = (time.time(), metadata)
+            if len(self._metadata) > METADATA_ENTRIES:
+                self._metadata.popitem(last=False)
+        return metadata
+
+    def metadata(self, name):
+        """
+        :param name: Name of the object
+        :return: Metadata of the object, None if it does not exist
+        """
+        with self._lock:
+            cached = self._metadata.get(name)
+        if cached is not None and time.time() - cached[0] < self.metadata_ttl:
+            return cached[1]
+        return self._single_flight(('metadata', name), lambda: self._fetch_metadata(name))
+
+    def _download(self, name, metadata, key):
+        logger.info("Caching %s generation %s", name, metadata['generation'])
+        if not download_object(name, self.cache.partial_path(key), self.bucket, self.service,
+                               metadata=metadata, resumable=False):
+            raise IOError("Unable to download %s" % name)
+        self.cache.add(key)
+
+    def open(self, name, metadata):
+        """
+        Open the cached file of an object, downloading it first if it is not cached
+        :param name: Name of the object
+        :param metadata: Metadata of the object
+        :return: File opened for reading
+        """
+        key = DiskCache.key(name, metadata['generation'])
+        fh = self.cache.open(key)
+        while fh is None:
+            self._single_flight(('object', key), lambda: self._download(name, metadata, key))
+            # Evicted again right away only if the cache is smaller than what is downloaded at the same time
+            fh = self.cache.open(key)
+        return fh
+
+
+def _etag(metadata):
+    return '"%s"' % metadata['generation']
+
+
+def _content_type(metadata):
+    if compression_of(metadata) == ZSTD:
+        return (metadata.get('metadata') or {}).get(UNCOMPRESSED_TYPE_KEY, 'application/octet-stream')
+    return metadata.get('contentType') or 'application/octet-stream'
+
+
+def _matches(header, etag):
+    """
+    :return: True if an If-None-Match header matches the etag (weak comparison)
+    """
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
+def _parse_range(header, size):
+    """
+    :param header: Range header, only a single range of bytes is supported
+    :param size: Size of the file
+    :return: (first, last) byte, None to send the whole file, False if the range can not be satisfied
+    """
+    match = _RANGE.match(header.replace(' ', ''))
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last bytes of the file
+        length = int(last)
+        if length == 0 or size == 0:
+            return False
+        return max(size - length, 0), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size or last < first:
+        return False
+    return first, last
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET and HEAD of /<object name>, served by the ImageStore of the server
+    """
+
+    server_version = 'ImageServer/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug("%s - " + format, self.address_string(), *args)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _send_empty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _serve(self, send_body):
+        store = self.server.store
+        name = unquote(urlsplit(self.path).path).lstrip('/')
+        if not name:
+            self._send_empty(404)
+            return
+
+        try:
+            metadata = store.metadata(name)
+        except Exception as e:
+            logger.debug("Unable to get metadata of %s: %s", name, e)
+            self._send_empty(502)
+            return
+        if metadata is None:
+            self._send_empty(404)
+            return
+
+        etag = _etag(metadata)
+        validators = {'ETag': etag, 'Cache-Control': CACHE_CONTROL}
+        if _matches(self.headers.get('If-None-Match', ''), etag):
+            self._send_empty(304, validators)
+            return
+
+        try:
+            fh = store.open(name, metadata)
+        except Exception as e:
+            logger.debug("Unable to serve %s: %s", name, e)
+            self._send_empty(502)
+            return
+
+        with fh:
+            size = os.fstat(fh.fileno()).st_size
+            byte_range = None
+            if 'Range' in self.headers and self.headers.get('If-Range', etag) == etag:
+                byte_range = _parse_range(self.headers['Range'], size)
+            if byte_range is False:
+                validators['Content-Range'] = 'bytes */%d' % size
+                self._send_empty(416, validators)
+                return
+
+            first, last = byte_range or (0, size - 1)
+            self.send_response(206 if byte_range else 200)
+            self.send_header('Content-Type', _content_type(metadata))
+            self.send_header('Content-Length', str(last - first + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            for header, value in validators.items():
+                self.send_header(header, value)
+            if byte_range:
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+            self.end_headers()
+
+            if send_body and last >= first:
+                # Straight from the page cache to the socket
+                self.connection.sendfile(fh, first, last - first + 1)
+
+
+def create_server(address=SERVER_ADDRESS, port=SERVER_PORT, bucket=STORAGE_BUCKET, service=None, cache_dir=CACHE_DIR,
+                  cache_size=CACHE_SIZE):
+    """
+    Create the server, one thread per connection
+    :param address: Interface to listen on
+    :param port: Port to listen on (0 for any free port)
+    :param bucket: The bucket on Cloud
+    :param service: Storage service to use instead of the shared one
+    :param cache_dir: Directory of the cached objects
+    :param cache_size: Bytes of cached objects kept on disk
+    :return: ThreadingHTTPServer whose store attribute is the ImageStore
+    """
+    server = ThreadingHTTPServer((address, port), ImageRequestHandler)
+    server.daemon_threads = True
+    server.store = ImageStore(bucket, service, DiskCache(cache_dir, cache_size))
+    return server
+
+
+def serve(address=SERVER_ADDRESS, port=SERVER_PORT, bucket=STORAGE_BUCKET, cache_dir=CACHE_DIR, cache_size=CACHE_SIZE):
+    """
+    Serve the objects of a bucket until interrupted
+    """
+    server = create_server(address, port, bucket, cache_dir=cache_dir, cache_size=cache_size)
+    logger.info("Serving %s on port %d", bucket, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    serve()
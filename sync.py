@@ -0,0 +1,262 @@
+"""
+Name: Directory sync
+
+Purpose: Incrementally upload or download a directory tree, transferring only the files that changed since the last sync
+"""
+
+import json
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from checksums import file_checksum, new_checksum
+from clients import get_storage_service
+from config import logger, STORAGE_BUCKET
+from download import download_object
+from upload import CHUNK_SIZE, upload_file, upload_file_in_chunks
+
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+MANIFEST_NAME = '.gcs-sync-manifest.json'  # Kept at the root of the synced directory, never uploaded
+SYNC_WORKERS = 16                           # Number of files hashed and transferred at the same time
+MANIFEST_SAVE_INTERVAL = 30                 # Seconds between two saves of the manifest during a sync
+
+
+class Manifest(object):
+    """
+    On-disk cache of the checksum of local files keyed by (path, mtime, size), so files that did not change are never
+    hashed again. Each entry keeps the field of the object resource its checksum compares with (crc32c or md5Hash,
+    see checksums.new_checksum) and the generation of the remote object the file was last synced with
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the manifest file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as data:
+                self.entries = json.load(data)
+        except (IOError, ValueError):
+            self.entries = {}
+
+        for entry in self.entries.values():
+            # Manifests written before MD5 was supported only hold a crc32c
+            if 'checksum' not in entry:
+                crc32c = entry.pop('crc32c', None)
+                entry['checksum'] = {'crc32c': crc32c} if crc32c is not None else {}
+
+    def lookup(self, name, stat):
+        """
+        :param name: Relative path of the file
+        :param stat: os.stat_result of the file
+        :return: Entry of the file if it did not change since it was recorded, None otherwise
+        """
+        entry = self.entries.get(name)
+        if entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            return entry
+        return None
+
+    def checksum(self, name, path, stat, resource):
+        """
+        Get the checksum of a local file to compare with an object resource, hashing the file only if it changed since
+        it was recorded or if the recorded checksum is not one the object has
+        :param resource: Object resource with its crc32c and/or md5Hash
+        :return: Dict of the field of the object resource to the base64 encoded checksum
+        """
+        entry = self.lookup(name, stat)
+        if entry is not None and entry['checksum'] and all(field in resource for field in entry['checksum']):
+            return entry['checksum']
+
+        checksum = file_checksum(path, resource)
+        self.record(name, stat, checksum)
+        return checksum
+
+    def record(self, name, stat, checksum, generation=None):
+        """
+        :param checksum: Dict of the field of the object resource to the base64 encoded checksum of the file
+        """
+        with self._lock:
+            self.entries[name] = {
+                'mtime': stat.st_mtime_ns,
+                'size': stat.st_size,
+                'checksum': checksum or {},
+                'generation': generation,
+            }
+
+    def save(self):
+        """
+        Write the manifest atomically so an interrupted sync never leaves a corrupted file behind
+        """
+        with self._lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as data:
+                json.dump(self.entries, data)
+            os.replace(tmp, self.path)
+
+
+def list_remote_objects(prefix, bucket=STORAGE_BUCKET, service=None):
+    """
+    List every object under a prefix
+    :param prefix: Prefix of the objects
+    :param bucket: The bucket on Cloud
+    :param service: Storage service to use instead of the shared one
+    :return: Dict of object name to its metadata (size, crc32c, md5Hash, generation, contentEncoding and
+             metadata, which tell whether it was compressed on upload)
+    """
+    service = get_storage_service(service)
+    objects = {}
+    req = service.objects().list(bucket=bucket, prefix=prefix,
+                                 fields='items(name,size,crc32c,md5Hash,generation,contentEncoding,metadata),'
+                                        'nextPageToken')
+    while req is not None:
+        resp = req.execute()
+        for item in resp.get('items', []):
+            objects[item['name']] = item
+        req = service.objects().list_next(req, resp)
+    return objects
+
+
+def _object_checksum(resource):
+    """
+    :return: Dict of the field of the checksum new_checksum picks for an object resource to its value, to record
+    """
+    field = new_checksum(resource).field
+    return {field: resource[field]} if field in resource else {}
+
+
+def _walk(local_dir):
+    """
+    :return: Dict of relative path ('/' separated) to os.stat_result of every file under local_dir
+    """
+    files = {}
+    pending = [local_dir]
+    while pending:
+        directory = pending.pop()
+        for entry in os.scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+            elif entry.is_file():
+                name = os.path.relpath(entry.path, local_dir).replace(os.sep, '/')
+                if name != MANIFEST_NAME:
+                    files[name] = entry.stat()
+    return files
+
+
+def _unchanged(manifest, name, path, stat, remote):
+    """
+    Check if a local file and a remote object hold the same bytes, without hashing when the manifest already knows
+    """
+    if remote is None or stat is None or int(remote['size']) != stat.st_size:
+        return False
+
+    entry = manifest.lookup(name, stat)
+    if entry is not None and entry['generation'] == remote['generation']:
+        return True
+
+    if 'crc32c' not in remote and 'md5Hash' not in remote:
+        return False
+
+    checksum = manifest.checksum(name, path, stat, remote)
+    same = all(remote.get(field) == value for field, value in checksum.items())
+    if same:
+        manifest.record(name, stat, checksum, remote['generation'])
+    return same
+
+
+def sync(local_dir, prefix, direction, bucket=STORAGE_BUCKET, service=None, max_workers=SYNC_WORKERS,
+         manifest_path=None):
+    """
+    Synchronize a local directory with the objects under a prefix, only transferring files that changed
+    :param local_dir: The local directory
+    :param prefix: Prefix of the objects on google cloud storage (ex: 'backups/2016/')
+    :param direction: UPLOAD to make the bucket match local_dir, DOWNLOAD to make local_dir match the bucket
+    :param bucket: The bucket on Cloud
+    :param service: Storage service to use instead of the shared one
+    :param max_workers: Number of files hashed and transferred at the same time
+    :param manifest_path: Path of the manifest (defaults to MANIFEST_NAME inside local_dir)
+    :return: Dict with the list of 'transferred' and 'failed' names and the number of 'unchanged' files
+    """
+    if direction not in (UPLOAD, DOWNLOAD):
+        raise ValueError("direction must be %r or %r" % (UPLOAD, DOWNLOAD))
+
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    if direction == DOWNLOAD:
+        os.makedirs(local_dir, exist_ok=True)
+
+    service = get_storage_service(service)
+    manifest = Manifest(manifest_path or os.path.join(local_dir, MANIFEST_NAME))
+    local = _walk(local_dir)
+    remote = dict((name[len(prefix):], item) for name, item in list_remote_objects(prefix, bucket, service).items()
+                  if not name.endswith('/'))
+
+    names = sorted(local) if direction == UPLOAD else sorted(remote)
+    report = {'transferred': [], 'failed': [], 'unchanged': 0}
+
+    def transfer(name):
+        path = os.path.join(local_dir, *name.split('/'))
+        stat = local.get(name)
+        try:
+            if _unchanged(manifest, name, path, stat, remote.get(name)):
+                return None
+
+            if direction == UPLOAD:
+                entry = manifest.lookup(name, stat)
+                # A file that fits in one chunk goes in a single request, without a resumable session nor a journal
+                upload = upload_file if stat.st_size < CHUNK_SIZE else upload_file_in_chunks
+                resource = {}
+                done = upload(path, prefix + name, bucket, service,
+                              crc32c=entry['checksum'].get('crc32c') if entry is not None else None, resource=resource)
+                if done:
+                    # The next sync finds the file unchanged without hashing it nor comparing it with the object
+                    manifest.record(name, stat, _object_checksum(resource), resource['generation'])
+                return done
+
+            item = remote[name]
+            done = download_object(prefix + name, path, bucket, service, metadata=item)
+            if done:
+                manifest.record(name, os.stat(path), _object_checksum(item), item['generation'])
+            return done
+
+        except Exception as e:
+            logger.debug("Unable to sync %s: %s", name, e)
+            return False
+
+    try:
+        # Files the manifest already vouches for are settled here, only the others go to the pool
+        pending = []
+        for name in names:
+            stat = local.get(name)
+            entry = manifest.lookup(name, stat) if stat is not None else None
+            item = remote.get(name)
+            if entry is not None and item is not None and entry['generation'] == item['generation']:
+                report['unchanged'] += 1
+            else:
+                pending.append(name)
+
+        logger.info("Syncing %d of %d files between %s and %s", len(pending), len(names), local_dir, prefix)
+
+        saved = time.time()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for name, done in zip(pending, pool.map(transfer, pending)):
+                if done is None:
+                    report['unchanged'] += 1
+                elif done:
+                    report['transferred'].append(name)
+                else:
+                    report['failed'].append(name)
+                # An interrupted sync of a large tree keeps the hashes and transfers done so far
+                if time.time() - saved >= MANIFEST_SAVE_INTERVAL:
+                    manifest.save()
+                    saved = time.time()
+    finally:
+        manifest.save()
+
+    logger.info("Sync done: %d transferred, %d unchanged, %d failed",
+                len(report['transferred']), report['unchanged'], len(report['failed']))
+    return report
@@ -4,97 +4,792 @@ Name: Upload to google cloud storage
 Purpose: Upload files to google cloud storage buckets
 """
 
+import calendar
 import io
+import mmap
+import os
+import hashlib
+import time
 import apiclient
+import metrics
 
-from apiclient import discovery
-from config import logger, STORAGE_BUCKET, get_storage_credentials
+from concurrent.futures import ThreadPoolExecutor
+from apiclient.errors import HttpError
+from batch import delete_many
+from checksums import crc32c_combine, file_checksum, new_checksum, READ_SIZE
+from chunking import ChunkPolicy
+from clients import get_storage_service, NUM_RETRIES
+from compression import GZIP, COMPRESSION_KEY, UNCOMPRESSED_SIZE_KEY, UNCOMPRESSED_CHECKSUM_KEYS, \
+    UNCOMPRESSED_TYPE_KEY, check_method, compress_blocks, guess_mimetype, is_compressible
+from config import logger, STORAGE_BUCKET
+from journal import TransferJournal, UPLOAD
+from progress import Progress
 
 
-def upload_file(local_path, remote_name, bucket=STORAGE_BUCKET):
+CHUNK_SIZE = 1024 * 1024 * 2                    # Size of the first chunk, the next ones adapt to the throughput
+MAX_STREAM_CHUNK_SIZE = 1024 * 1024 * 16        # Largest chunk of upload_stream, which keeps two chunks in memory
+
+COMPOSITE_UPLOAD_THRESHOLD = 1024 * 1024 * 150  # Files at least this big are uploaded as a parallel composite
+COMPOSITE_UPLOAD_PARTS = 16                     # Number of parts the file is split into
+COMPOSITE_UPLOAD_WORKERS = 8                    # Number of parts uploaded at the same time
+COMPOSITE_PARTS_PREFIX = '.composite-parts/'    # Temporary parts are uploaded under this prefix
+MAX_COMPOSE_COMPONENTS = 32                     # Maximum number of source objects of a single compose call
+COMPOSITE_PARTS_MAX_AGE = 60 * 60 * 24          # Seconds the parts of a failed composite upload are kept for a retry
+COMPOSITE_REAP_INTERVAL = 60 * 60               # Seconds between two deletions of the expired parts of a bucket
+
+_reaped_at = {}     # Bucket to the last time its expired parts were deleted
+
+
+@metrics.timed('upload.file')
+def upload_file(local_path, remote_name, bucket=STORAGE_BUCKET, service=None, crc32c=None, paranoid=False,
+                resource=None):
     """
     Upload a file to Google Storage
     :param local_path: The local path to the file to upload
     :param remote_name: The name of the file in the google cloud storage
     :param bucket: The bucket on google cloud storage you want to upload the file to
+    :param service: Storage service to use instead of the shared one
+    :param crc32c: Base64 CRC32C of the file if already known, its checksum is computed otherwise (see
+                   checksums.new_checksum)
+    :param paranoid: True to also fetch the object back once uploaded to check it exists
+    :param resource: Dict filled with the object resource stored (ex: its crc32c and generation) once uploaded
     :return: True if uploaded, False otherwise
     """
     try:
-        service = discovery.build('storage', 'v1', credentials=get_storage_credentials())
-        logger.info("Uploading %s to google cloud" % local_path)
+        service = get_storage_service(service)
+        logger.info("Uploading %s to google cloud", local_path)
+
+        checksum = {'crc32c': crc32c} if crc32c is not None else file_checksum(local_path)
+
         req = service.objects().insert(
             bucket=bucket,
             name=remote_name,
+            # Google cloud storage rejects the upload if the bytes it received do not match this checksum
+            body=dict(checksum, name=remote_name),
             # predefinedAcl="publicRead",         Uncomment this line if you want your files to be accessible to anyone
-            media_body=local_path)
-        req.execute()
+            media_body=apiclient.http.MediaFileUpload(local_path, mimetype=guess_mimetype(local_path)[0]))
+        resp = req.execute(num_retries=NUM_RETRIES)
+        metrics.increment('transfer.bytes', os.path.getsize(local_path), operation='upload', compression='none')
 
-        uploaded = check_if_file_exists(remote_name)
-
-        if uploaded is True:
-            logger.info("Upload complete!")
-            return True
-        else:
-            return False
+        return _check_upload(resp, local_path, remote_name, checksum, os.path.getsize(local_path), bucket, service,
+                             paranoid, resource)
 
     except Exception as e:
-        logger.debug("Unable to upload file %s to google cloud: %s" % (local_path, e))
+        logger.debug("Unable to upload file %s to google cloud: %s", local_path, e)
         return False
 
 
-def upload_file_in_chunks(local_path, remote_name, bucket=STORAGE_BUCKET):
+@metrics.timed('upload.file_in_chunks')
+def upload_file_in_chunks(local_path, remote_name, bucket=STORAGE_BUCKET, service=None, composite=None,
+                          parts=COMPOSITE_UPLOAD_PARTS, max_workers=COMPOSITE_UPLOAD_WORKERS, crc32c=None,
+                          paranoid=False, resumable=True, stats=None, compress=None, progress=None, resource=None):
     """
-    Upload a large file to Google Cloud storage in chunks
+    Upload a large file to Google Cloud storage in chunks sized to the measured throughput
     :param local_path: The local path to the file to upload
     :param remote_name: The new name of the file in the remote storage
     :param bucket: The bucket on Cloud
+    :param service: Storage service to use instead of the shared one
+    :param composite: True to upload parts in parallel and compose them, False for a single resumable upload,
+                      None to upload as a composite only files bigger than COMPOSITE_UPLOAD_THRESHOLD
+    :param parts: Number of parts the file is split into when uploaded as a composite
+    :param max_workers: Number of parts uploaded at the same time when uploaded as a composite
+    :param crc32c: Base64 CRC32C of the file if already known (sent so storage rejects a corrupted upload),
+                   computed while the file is streamed otherwise
+    :param paranoid: True to also fetch the object back once uploaded to check it exists
+    :param resumable: True to journal the upload session so a rerun after a crash resumes where it stopped
+                      (composite uploads always reuse the parts a failed attempt left behind)
+    :param stats: chunking.TransferStats filled with the bytes, chunk sizes and retries of the upload
+    :param compress: gzip (or True) or zstd to compress the file on the fly if its content looks compressible, in a
+                     single resumable session that is not journaled. None to upload the file as it is
+    :param progress: Called with (bytes uploaded, total bytes) at most every progress.PROGRESS_INTERVAL seconds. The
+                     total is None when the file is compressed
+    :param resource: Dict filled with the object resource stored (ex: its crc32c and generation) once uploaded
     :return: True if successful, False otherwise
     """
     try:
-        service = discovery.build('storage', 'v1', credentials=get_storage_credentials())
+        service = get_storage_service(service)
+        reporter = Progress(progress, os.path.getsize(local_path))
+        policy = ChunkPolicy(CHUNK_SIZE, stats=stats, progress=reporter)
+
+        logger.info("Uploading %s to google cloud", local_path)
 
-        logger.info("Uploading %s to google cloud" % local_path)
+        mimetype, encoding = guess_mimetype(local_path)
+        if compress:
+            method = check_method(compress)
+            if is_compressible(local_path, mimetype, encoding):
+                reporter.total = None
+                resp, media = _upload_compressed(service, local_path, remote_name, bucket, mimetype, method, crc32c,
+                                                 policy)
+                policy.stats.finish()
+                reporter.finish()
+                metrics.record_transfer('upload', policy.stats, compression=method)
+                logger.info("Uploaded %s compressed with %s: %d bytes sent for %d",
+                            local_path, method, media.size(), os.path.getsize(local_path))
+                return _check_upload(resp, local_path, remote_name, media.checksum.fields(), media.size(), bucket,
+                                     service, paranoid, resource)
 
-        fh = io.FileIO(local_path, mode='r')
+        size = os.path.getsize(local_path)
+        if composite is None:
+            composite = size >= COMPOSITE_UPLOAD_THRESHOLD
 
-        if local_path.endswith(".zip"):
-            media = apiclient.http.MediaIoBaseUpload(fh, mimetype='application/zip', chunksize=1024*1024*2,
-                                                     resumable=True)
+        if composite:
+            _reap_parts(service, bucket)
+            resp, crc32c = _upload_composite(service, local_path, remote_name, bucket, mimetype, parts, max_workers,
+                                             policy)
+            checksum = {'crc32c': crc32c}
         else:
-            media = apiclient.http.MediaIoBaseUpload(fh, mimetype='text/plain', chunksize=1024*1024*2,
-                                                     resumable=True)
+            body = {'name': remote_name}
+            if crc32c is not None:
+                body['crc32c'] = crc32c
+            journal = TransferJournal(UPLOAD, bucket, remote_name, local_path) if resumable else None
+            try:
+                media = _MmapUpload(local_path, mimetype, chunksize=policy.size())
+            except (OSError, ValueError, OverflowError) as e:
+                # Files that can not be memory-mapped are read through a regular file object
+                logger.debug("Unable to memory-map %s: %s", local_path, e)
+                media = None
 
-        req = service.objects().insert(bucket=bucket, name=remote_name, media_body=media)
-        req.execute()
+            if media is not None:
+                with media:
+                    resp = _resumable_upload(service, bucket, body, local_path, media, journal, policy)
+                streamed = media.checksum
+            else:
+                policy = ChunkPolicy.fixed(CHUNK_SIZE, policy.stats, reporter)
+                with _ChecksumReader(local_path) as fh:
+                    media = apiclient.http.MediaIoBaseUpload(fh, mimetype=mimetype, chunksize=CHUNK_SIZE,
+                                                             resumable=True)
+                    resp = _resumable_upload(service, bucket, body, local_path, media, journal, policy)
+                streamed = fh.checksum
+            checksum = {'crc32c': crc32c} if crc32c is not None else streamed.fields()
 
-        uploaded = check_if_file_exists(remote_name)
+        policy.stats.finish()
+        reporter.finish()
+        metrics.record_transfer('upload', policy.stats, compression='none')
+        logger.debug("Uploaded %s: %s", local_path, policy.stats)
 
-        if uploaded is True:
-            logger.info("Upload complete!")
-            return True
-        else:
+        return _check_upload(resp, local_path, remote_name, checksum, size, bucket, service, paranoid, resource)
+
+    except Exception as e:
+        logger.debug("Unable to upload file %s to google cloud: %s", local_path, e)
+        return False
+
+
+@metrics.timed('upload.stream')
+def upload_stream(source, remote_name, bucket=STORAGE_BUCKET, service=None, mimetype='application/octet-stream',
+                  paranoid=False, stats=None, progress=None):
+    """
+    Upload data that is not in a local file (a pipe, a generated archive, a database dump...) without writing it to
+    disk first. The data goes through a resumable upload with at most a couple of chunks in memory
+    :param source: File-like object opened in binary mode, bytes, or an iterable/generator of bytes of any length
+    :param remote_name: The name of the file in the google cloud storage
+    :param bucket: The bucket on Cloud
+    :param service: Storage service to use instead of the shared one
+    :param mimetype: Content type of the object
+    :param paranoid: True to also fetch the object back once uploaded to check it exists
+    :param stats: chunking.TransferStats filled with the bytes, chunk sizes and retries of the upload
+    :param progress: Called with (bytes uploaded, None) at most every progress.PROGRESS_INTERVAL seconds
+    :return: True if successful, False otherwise
+    """
+    try:
+        service = get_storage_service(service)
+        reporter = Progress(progress)
+        policy = ChunkPolicy(CHUNK_SIZE, maximum=MAX_STREAM_CHUNK_SIZE, stats=stats, progress=reporter)
+
+        logger.info("Uploading stream to google cloud as %s", remote_name)
+
+        media = _StreamUpload(source, mimetype, policy.size())
+        req = service.objects().insert(bucket=bucket, name=remote_name, body={'name': remote_name},
+                                       media_body=media)
+        resp = _send_chunks(req, policy)
+
+        policy.stats.finish()
+        reporter.finish()
+        metrics.record_transfer('upload', policy.stats, compression='none')
+        logger.debug("Uploaded stream %s: %s", remote_name, policy.stats)
+
+        # The checksum is only known once the last byte went through, so it is compared afterwards
+        return _check_upload(resp, 'stream', remote_name, media.checksum.fields(), media.size(), bucket, service,
+                             paranoid)
+
+    except Exception as e:
+        logger.debug("Unable to upload stream to %s: %s", remote_name, e)
+        return False
+
+
+def _resumable_upload(service, bucket, body, local_path, media, journal, policy):
+    """
+    Upload a file through a resumable session. With a journal, the session uri and the committed offset are saved
+    after every chunk, and a session left by a previous attempt on the same unchanged file is resumed
+    :return: Object resource of the uploaded file
+    """
+    stat = os.stat(local_path)
+    identity = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    state = journal.load() if journal is not None else None
+    if state is not None and (state.get('size'), state.get('mtime')) != (stat.st_size, stat.st_mtime_ns):
+        journal.discard("local file changed")
+        state = None
+
+    def new_request():
+        return service.objects().insert(bucket=bucket, name=body['name'], body=body, media_body=media)
+
+    req = new_request()
+    if state is not None:
+        logger.info("Resuming upload of %s from byte %d", body['name'], state.get('offset', 0))
+        req.resumable_uri = state['resumable_uri']
+        # Makes the next chunk start by asking the server how many bytes it already committed
+        req._in_error_state = True
+
+    def save(status):
+        journal.save(resumable_uri=req.resumable_uri, offset=status.resumable_progress, **identity)
+
+    while True:
+        try:
+            resp = _send_chunks(req, policy, save if journal is not None else None)
+            break
+        except HttpError as e:
+            if state is None or e.resp.status not in (404, 410):
+                raise
+            journal.discard("upload session expired")
+            state = None
+            req = new_request()
+
+    if journal is not None:
+        journal.delete()
+    return resp
+
+
+def _upload_compressed(service, local_path, remote_name, bucket, mimetype, method, crc32c, policy):
+    """
+    Upload a file compressed on the fly through a resumable session. The size and checksum of the uncompressed file
+    are kept in the custom metadata of the object, so a download can check what it decompressed
+    :return: (object resource, media), the media holding the size and checksum of the compressed data
+    """
+    checksum = {'crc32c': crc32c} if crc32c is not None else file_checksum(local_path)
+    metadata = {COMPRESSION_KEY: method, UNCOMPRESSED_SIZE_KEY: str(os.path.getsize(local_path))}
+    for field, value in checksum.items():
+        metadata[UNCOMPRESSED_CHECKSUM_KEYS[field]] = value
+    body = {'name': remote_name, 'metadata': metadata}
+    if method == GZIP:
+        # Other clients get the file decompressed by google cloud storage, with its own content type
+        body['contentType'] = mimetype
+        body['contentEncoding'] = GZIP
+    else:
+        body['contentType'] = 'application/zstd'
+        metadata[UNCOMPRESSED_TYPE_KEY] = mimetype
+
+    with open(local_path, 'rb') as fh:
+        media = _StreamUpload(compress_blocks(_read_pieces(fh, READ_SIZE), method), body['contentType'],
+                              policy.size())
+        req = service.objects().insert(bucket=bucket, name=remote_name, body=body, media_body=media)
+        resp = _send_chunks(req, policy)
+    return resp, media
+
+
+def _send_chunks(req, policy, callback=None):
+    """
+    Send the chunks of a resumable upload, sized by the chunk policy, sending again the chunks that failed with a
+    transient error
+    :param req: Insert request with a resumable media
+    :param policy: ChunkPolicy of the transfer
+    :param callback: Called with the upload status after every chunk but the last
+    :return: Object resource of the uploaded file
+    """
+    resp = None
+    attempt = 0
+    while resp is None:
+        chosen = policy.size()
+        if hasattr(req.resumable, 'resize'):
+            req.resumable.resize(chosen)
+
+        progress = req.resumable_progress
+        start = time.time()
+        try:
+            with metrics.span('upload.chunk', offset=progress, size=chosen):
+                status, resp = req.next_chunk()
+        except Exception as e:
+            attempt += 1
+            if not policy.failed(e, attempt):
+                raise
+            logger.debug("Sending chunk at byte %d again after: %s", req.resumable_progress, e)
+            continue
+
+        attempt = 0
+        committed = int(resp.get('size', progress)) if resp is not None else status.resumable_progress
+        policy.record(committed - progress, time.time() - start, chosen)
+        if callback is not None and status is not None:
+            callback(status)
+    return resp
+
+
+def _check_upload(resp, local_path, remote_name, checksum, size, bucket, service, paranoid, resource=None):
+    """
+    Compare the object resource returned by the upload with what was sent. An object that does not match is deleted,
+    so a corrupted upload is never left live in the bucket
+    :param checksum: Dict of the checksum fields of the object resource to their expected value, None to only compare
+                     the size
+    :param resource: Dict filled with the object resource if it matches
+    :return: True if the object matches the local file
+    """
+    if int(resp.get('size', -1)) != size:
+        logger.debug("Size mismatch after uploading %s: sent %d bytes, stored %s",
+                     local_path, size, resp.get('size'))
+        _delete_generation(service, bucket, remote_name, resp)
+        return False
+
+    for field, value in (checksum or {}).items():
+        if resp.get(field) != value:
+            logger.debug("%s mismatch after uploading %s: sent %s, stored %s",
+                         field, local_path, value, resp.get(field))
+            _delete_generation(service, bucket, remote_name, resp)
             return False
 
+    if paranoid and check_if_file_exists(remote_name, bucket, service) is not True:
+        return False
+
+    if resource is not None:
+        resource.update(resp)
+    logger.info("Upload complete!")
+    return True
+
+
+def _delete_generation(service, bucket, remote_name, resp):
+    """
+    Delete the object an upload stored, unless it was replaced since (ifGenerationMatch)
+    """
+    try:
+        service.objects().delete(bucket=bucket, object=remote_name, ifGenerationMatch=resp['generation']).execute()
     except Exception as e:
-        logger.debug("Unable to upload file %s to google cloud: %s" % (local_path, e))
+        logger.debug("Unable to delete mismatched upload %s: %s", remote_name, e)
+
+
+class _FileSlice(io.RawIOBase):
+    """
+    Read-only, seekable view of length bytes of a file starting at offset, so a part can be read without copying it
+    """
+
+    def __init__(self, path, offset, length):
+        super(_FileSlice, self).__init__()
+        self.path = path
+        self._fh = io.FileIO(path, mode='r')
+        self._offset = offset
+        self._length = length
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self._position
+        elif whence == io.SEEK_END:
+            position += self._length
+        self._position = min(max(position, 0), self._length)
+        return self._position
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._length - self._position)
+        if size <= 0:
+            return 0
+        self._fh.seek(self._offset + self._position)
+        read = self._fh.readinto(memoryview(buffer)[:size])
+        self._position += read
+        return read
+
+    def close(self):
+        self._fh.close()
+        super(_FileSlice, self).close()
+
+
+class _ChecksumReader(_FileSlice):
+    """
+    Read-only file computing the checksum of its content as it is read. Bytes read again after a seek backwards
+    (ex: a chunk sent again after an error) are only hashed once, bytes skipped by a seek forward are read to be hashed
+    """
+
+    def __init__(self, path):
+        super(_ChecksumReader, self).__init__(path, 0, os.path.getsize(path))
+        self.checksum = new_checksum()
+        self._hashed = 0
+
+    def _hash_until(self, position):
+        # Reads skipped bytes (ex: those committed before a resumed upload) so the checksum covers the whole file
+        self._fh.seek(self._hashed)
+        while self._hashed < position:
+            block = self._fh.read(min(CHUNK_SIZE, position - self._hashed))
+            if not block:
+                break
+            self.checksum.update(block)
+            self._hashed += len(block)
+
+    def readinto(self, buffer):
+        position = self.tell()
+        if position > self._hashed:
+            self._hash_until(position)
+        read = super(_ChecksumReader, self).readinto(buffer)
+        if read and position + read > self._hashed:
+            self.checksum.update(memoryview(buffer)[self._hashed - position:read])
+            self._hashed = position + read
+        return read
+
+
+class _MmapUpload(apiclient.http.MediaUpload):
+    """
+    Resumable media of length bytes of a file starting at offset. The file is memory-mapped and every chunk is sent as
+    a memoryview of the mapping, so no chunk is copied into new bytes objects on its way to the socket, and the pages
+    of the chunks committed by storage are released so the resident memory stays flat whatever the size of the file.
+    """
+
+    def __init__(self, path, mimetype, offset=0, length=None, chunksize=CHUNK_SIZE):
+        """
+        :param path: The local path of the file
+        :param mimetype: Content type of the object
+        :param offset: First byte of the file to upload
+        :param length: Number of bytes to upload, up to the end of the file by default
+        :param chunksize: Bytes sent per request
+        """
+        self.path = path
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._length = os.path.getsize(path) - offset if length is None else length
+        self._map = None
+        self._view = memoryview(b'')
+        self._skip = offset % mmap.ALLOCATIONGRANULARITY   # A mapping starts on a multiple of the granularity
+        self._released = 0
+        self._hashed = 0
+        self.checksum = new_checksum()
+
+        if self._length:
+            with open(path, 'rb') as fh:
+                self._map = mmap.mmap(fh.fileno(), self._skip + self._length, offset=offset - self._skip,
+                                      access=mmap.ACCESS_READ)
+            if hasattr(self._map, 'madvise'):
+                self._map.madvise(mmap.MADV_SEQUENTIAL)
+            self._view = memoryview(self._map)[self._skip:self._skip + self._length]
+
+    def chunksize(self):
+        return self._chunksize
+
+    def resize(self, chunksize):
+        """
+        Set the size of the next chunks (only between two chunks)
+        """
+        self._chunksize = chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._length
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def _release(self, offset):
+        # Bytes before offset were committed by storage: their pages can leave the resident memory (they are read
+        # again from the page cache if ever needed)
+        if self._map is None or not hasattr(self._map, 'madvise'):
+            return
+        end = (self._skip + offset) // mmap.PAGESIZE * mmap.PAGESIZE
+        if end > self._released:
+            self._map.madvise(mmap.MADV_DONTNEED, self._released, end - self._released)
+            self._released = end
+
+    def getbytes(self, begin, length):
+        end = min(begin + length, self._length)
+        # Bytes are hashed once, those skipped by a resumed upload included
+        if end > self._hashed:
+            self.checksum.update(self._view[self._hashed:end])
+            self._hashed = end
+        self._release(begin)
+        return self._view[begin:end]
+
+    def to_json(self):
+        raise NotImplementedError("Memory-mapped media can not be serialized")
+
+    def close(self):
+        try:
+            self._view.release()
+            if self._map is not None:
+                self._map.close()
+        except BufferError:
+            pass    # A chunk is still referenced, the file is unmapped once it is garbage collected
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _StreamUpload(apiclient.http.MediaUpload):
+    """
+    Resumable media read from a file-like object or an iterable of bytes of unknown length.
+
+    Only the chunk not yet committed by storage and the next one are buffered, and the checksum is computed as the bytes
+    are read from the source.
+    """
+
+    def __init__(self, source, mimetype, chunksize=CHUNK_SIZE):
+        """
+        :param source: File-like object opened in binary mode, bytes, or an iterable of bytes
+        :param mimetype: Content type of the object
+        :param chunksize: Bytes sent per request
+        """
+        if hasattr(source, 'read'):
+            self._pieces = _read_pieces(source, min(chunksize, READ_SIZE))
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            self._pieces = iter([source])
+        else:
+            self._pieces = iter(source)
+
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._buffer = bytearray()
+        self._start = 0         # Offset in the stream of the first byte of the buffer
+        self._next = 0          # Offset of the chunk expected to be sent next
+        self._size = None       # Length of the stream, known once the source is exhausted
+        self.checksum = new_checksum()
+
+    def chunksize(self):
+        return self._chunksize
+
+    def resize(self, chunksize):
+        """
+        Set the size of the next chunks (only between two chunks)
+        """
+        self._chunksize = chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def resumable(self):
+        return True
+
+    def size(self):
+        # The request of the last chunk must carry the total length: reading one byte past the next chunk tells
+        # whether it is the last one (a stream ending on a chunk boundary would otherwise need an empty request)
+        self._fill(self._next + self._chunksize + 1)
+        return self._size
+
+    def _fill(self, end):
+        """
+        Read from the source until the buffer reaches offset end of the stream or the source is exhausted
+        """
+        while self._size is None and self._start + len(self._buffer) < end:
+            try:
+                piece = next(self._pieces)
+            except StopIteration:
+                self._size = self._start + len(self._buffer)
+                break
+            if isinstance(piece, str):
+                raise TypeError("Streamed data must be bytes, not str")
+            self.checksum.update(piece)
+            self._buffer += piece
+
+    def getbytes(self, begin, length):
+        if begin < self._start:
+            raise ValueError("Byte %d of the stream is not buffered anymore" % begin)
+
+        # Storage asks for the bytes after those it committed, which are not needed anymore
+        del self._buffer[:begin - self._start]
+        self._start = begin
+        self._fill(begin + length)
+        data = bytes(self._buffer[:length])
+        self._next = begin + len(data)
+        return data
+
+    def has_stream(self):
         return False
 
+    def to_json(self):
+        raise NotImplementedError("Streamed media can not be serialized")
+
+
+def _read_pieces(fh, size):
+    while True:
+        piece = fh.read(size)
+        if not piece:
+            return
+        yield piece
+
+
+def _composite_upload_id(local_path, remote_name, bucket):
+    """
+    Identify an upload by its source file and destination, so a retry of the same upload reuses the same part names
+    """
+    stat = os.stat(local_path)
+    key = '%s|%s|%s|%d|%d' % (bucket, remote_name, os.path.abspath(local_path), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def _file_slice_checksum(local_path, offset, length):
+    checksum = new_checksum()
+    with _FileSlice(local_path, offset, length) as fh:
+        for block in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            checksum.update(block)
+    return checksum.fields()
+
+
+def _upload_part(service, local_path, bucket, name, offset, length, mimetype, existing, policy):
+    """
+    Upload one part of a file as a temporary object, unless a previous attempt already uploaded the same bytes
+    :return: Object resource of the part
+    """
+    checksum = _file_slice_checksum(local_path, offset, length)
+    previous = existing.get(name)
+    if previous is not None and all(previous.get(field) == value for field, value in checksum.items()):
+        logger.debug("Part %s already uploaded", name)
+        return previous
+
+    with metrics.span('upload.part', part=name, size=length), \
+            _MmapUpload(local_path, mimetype, offset, length, policy.size()) as media:
+        # Sending the checksum makes google cloud storage reject the part if it was corrupted on the way
+        req = service.objects().insert(bucket=bucket, body=dict(checksum, name=name), media_body=media)
+        return _send_chunks(req, policy)
+
+
+def _list_parts(service, bucket, prefix):
+    """
+    :return: Dict of the name of every object under prefix to its resource (with its crc32c and md5Hash)
+    """
+    parts = {}
+    req = service.objects().list(bucket=bucket, prefix=prefix, fields='items(name,crc32c,md5Hash),nextPageToken')
+    while req is not None:
+        resp = req.execute()
+        for item in resp.get('items', []):
+            parts[item['name']] = item
+        req = service.objects().list_next(req, resp)
+    return parts
+
+
+def _reap_parts(service, bucket, max_age=COMPOSITE_PARTS_MAX_AGE):
+    """
+    Delete the parts failed composite uploads left under COMPOSITE_PARTS_PREFIX more than max_age seconds ago, at
+    most once every COMPOSITE_REAP_INTERVAL per bucket. A retry within max_age still finds its parts
+    """
+    now = time.time()
+    if now - _reaped_at.get(bucket, 0) < COMPOSITE_REAP_INTERVAL:
+        return
+    _reaped_at[bucket] = now
+
+    try:
+        expired = []
+        req = service.objects().list(bucket=bucket, prefix=COMPOSITE_PARTS_PREFIX,
+                                     fields='items(name,timeCreated),nextPageToken')
+        while req is not None:
+            resp = req.execute()
+            for item in resp.get('items', []):
+                created = calendar.timegm(time.strptime(item['timeCreated'][:19], '%Y-%m-%dT%H:%M:%S'))
+                if now - created > max_age:
+                    expired.append(item['name'])
+            req = service.objects().list_next(req, resp)
+
+        if expired:
+            logger.info("Deleting %d expired parts of composite uploads", len(expired))
+            for name, item in delete_many(expired, bucket, service).items():
+                if item.error is not None:
+                    logger.debug("Unable to delete expired part %s: %s", name, item.error)
+
+    except Exception as e:
+        logger.debug("Unable to delete the expired parts of composite uploads: %s", e)
+
+
+def _compose(service, bucket, sources, destination, mimetype):
+    body = {
+        'sourceObjects': [{'name': name} for name in sources],
+        'destination': {'contentType': mimetype},
+    }
+    with metrics.span('upload.compose', components=len(sources)):
+        return service.objects().compose(destinationBucket=bucket, destinationObject=destination, body=body).execute()
+
+
+def _upload_composite(service, local_path, remote_name, bucket, mimetype, parts, max_workers, policy):
+    """
+    Upload the parts of a file concurrently as temporary objects and compose them into remote_name (in tiers of
+    MAX_COMPOSE_COMPONENTS). The temporary objects are deleted once composed. When the upload fails, the parts
+    are kept under COMPOSITE_PARTS_PREFIX so the next attempt of the same upload only sends the missing ones, until
+    _reap_parts deletes them COMPOSITE_PARTS_MAX_AGE later.
+    The parts share the chunk policy, so every part benefits from the throughput measured by the others
+    :return: (object resource of the composed file, base64 CRC32C it should have), the CRC32C being combined from
+             those of the parts, each checked against the local file when uploaded
+    """
+    size = os.path.getsize(local_path)
+    parts = max(1, min(parts, size // CHUNK_SIZE or 1))
+    part_size = -(-size // parts) if size else 0
+    prefix = '%s%s/' % (COMPOSITE_PARTS_PREFIX, _composite_upload_id(local_path, remote_name, bucket))
+
+    logger.info("Uploading %s as a composite of %d parts", local_path, parts)
+
+    names = ['%s%05d' % (prefix, index) for index in range(parts)]
+    lengths = [max(min(part_size, size - index * part_size), 0) for index in range(parts)]
+    tiers = []
+    composed = False
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            existing = _list_parts(service, bucket, prefix)
+            futures = [pool.submit(_upload_part, service, local_path, bucket, name, index * part_size, length,
+                                   mimetype, existing, policy)
+                       for index, (name, length) in enumerate(zip(names, lengths))]
+            crc32c = None
+            for future, length in zip(futures, lengths):
+                part = future.result()
+                crc32c = part['crc32c'] if crc32c is None else crc32c_combine(crc32c, part['crc32c'], length)
+
+            components = list(names)
+            tier = 0
+            while len(components) > MAX_COMPOSE_COMPONENTS:
+                groups = [components[i:i + MAX_COMPOSE_COMPONENTS]
+                          for i in range(0, len(components), MAX_COMPOSE_COMPONENTS)]
+                components = ['%stier%d-%05d' % (prefix, tier, index) for index in range(len(groups))]
+                tiers.extend(components)
+                futures = [pool.submit(_compose, service, bucket, group, name, mimetype)
+                           for group, name in zip(groups, components)]
+                for future in futures:
+                    future.result()
+                tier += 1
+
+            resp = _compose(service, bucket, components, remote_name, mimetype)
+            composed = True
+            return resp, crc32c
+
+    finally:
+        # Intermediate composites are never reused, the parts are kept for the next attempt until composed
+        temporary = tiers + names if composed else tiers
+        if temporary:
+            for name, item in delete_many(temporary, bucket, service).items():
+                if item.error is not None:
+                    logger.debug("Unable to delete temporary object %s: %s", name, item.error)
+
 
-def check_if_file_exists(name, bucket=STORAGE_BUCKET):
+@metrics.timed('storage.exists')
+def check_if_file_exists(name, bucket=STORAGE_BUCKET, service=None):
     """
     Check if file exists on google cloud storage
     :param name: Name of file you are checking
     :param bucket: Bucket where you expect the file to be
+    :param service: Storage service to use instead of the shared one
     :return: True if exists. False otherwise
     """
     try:
-        service = discovery.build('storage', 'v1', credentials=get_storage_credentials())
+        service = get_storage_service(service)
 
-        request = service.objects().get(bucket=bucket, object=name)
-        request.execute()
+        request = service.objects().get(bucket=bucket, object=name, fields='name')
+        request.execute(num_retries=NUM_RETRIES)
 
         return True
 
-    except FileNotFoundError:
-        logger.debug("Image %s does not exist on google cloud" % name)
+    except HttpError as e:
+        if e.resp.status != 404:
+            raise
+        logger.debug("Image %s does not exist on google cloud", name)
         return False
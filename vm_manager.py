@@ -21,29 +21,64 @@ Purpose: Create, start, terminate and delete google cloud virtual machines via t
 # make install
 
 
-import json
-import time
+import inventory
+import metrics
 import os
+import threading
+import time
 
-from config import logger, PROJECT_NAME, NETWORK_NAME, get_compute_engine_credentials
-from apiclient import discovery
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from apiclient.errors import HttpError
+from batch import BatchItem
+from clients import get_compute_service, NUM_RETRIES
+from config import logger, PROJECT_NAME, NETWORK_NAME
+from operations import OperationWaiter, OPERATION_TIMEOUT
 
 DEFAULT_VM_ZONE = "us-central1-f"
+DEFAULT_SOURCE_IMAGE = "global/images/remotex-image-testing"
+FLEET_CONCURRENCY = 10      # Instances created at the same time by create_instances (disk and VM quotas of a zone)
+
+MACHINE_TYPES = {
+    'micro': 'f1-micro',
+    'small': 'g1-small',
+        '1': 'n1-standard-1',
+        '2': 'n1-standard-2',
+        '4': 'n1-standard-4',
+        '8': 'n1-standard-8',
+       '16': 'n1-standard-16',
+       '32': 'n1-standard-32'
+}
+
+# Outcome of create_instances for one VM: disk is the partial url of its boot disk, seconds the time it took
+InstanceReport = namedtuple('InstanceReport', ['name', 'created', 'disk', 'error', 'seconds'])
+
+_startup_script = None
 
 
-def list_vm_instances(project=PROJECT_NAME, zone=DEFAULT_VM_ZONE):
+@metrics.timed('compute.list_instances')
+def list_vm_instances(project=PROJECT_NAME, zone=DEFAULT_VM_ZONE, service=None, refresh=False):
+    """
+    Lists the instances of a zone, from the inventory cache
+
+    :param project: Name of Project
+    :param zone: Zone of the instances
+    :param service: Compute service to use instead of the shared one
+    :param refresh: True to list the instances again whatever the age of the cache
+    :return: Dict with the list of instances under 'items', like the response of instances().list
+    """
     try:
-        compute = discovery.build('compute', 'v1', credentials=get_compute_engine_credentials())
-        req = compute.instances().list(project=project, zone=zone)
-        response = req.execute()
-        print(json.dumps(response['items'], indent='\n'))
-        return response
+        instances = inventory.get_inventory(project, zone, service)
+        if refresh:
+            instances.refresh()
+        return {'items': instances.instances()}
 
     except Exception as e:
-        logger.debug("Unable to list instances: %s" % e)
+        logger.debug("Unable to list instances: %s", e)
 
 
-def create_disk_for_vm(name, source_image, disk_size, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME):
+@metrics.timed('compute.create_disk')
+def create_disk_for_vm(name, source_image, disk_size, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME, service=None):
     """
     Creates disk on Google Cloud compute engine to be used alongside a vm. Disk is generated from
     an image that is also stored on Google Cloud compute engine
@@ -53,10 +88,11 @@ def create_disk_for_vm(name, source_image, disk_size, zone=DEFAULT_VM_ZONE, proj
     :param disk_size: Size of disk
     :param zone: The zone the disk should be created in (same as VM zone)
     :param project: Name of project
+    :param service: Compute service to use instead of the shared one
     :return: Link of disk if successful, False if unsuccessful
     """
     try:
-        compute = discovery.build('compute', 'v1', credentials=get_compute_engine_credentials())
+        compute = get_compute_service(service)
 
         config = {
             'name': name,
@@ -66,102 +102,213 @@ def create_disk_for_vm(name, source_image, disk_size, zone=DEFAULT_VM_ZONE, proj
         }
 
         req = compute.disks().insert(project=project, zone=zone, body=config)
-        resp = req.execute()
+        resp = req.execute(num_retries=NUM_RETRIES)
 
-        completed = wait_for_operation(project, zone, resp['name'])
+        completed = wait_for_operation(project, zone, resp['name'], compute)
 
         if completed == 'DONE':
             link = resp['targetLink'].split('/v1/')[1]
             return link
 
     except Exception as e:
-        logger.debug("Creation of disk failed: %s" % e)
+        logger.debug("Creation of disk failed: %s", e)
         print(e)
         return False
 
 
-def get_instance(name, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME):
+@metrics.timed('compute.get_instance')
+def get_instance(name, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME, service=None, fresh=False):
     """
-    Gets the information of the instance
+    Gets the information of the instance, from the inventory cache
 
     :param name: Name of instance as specified on google cloud
     :param zone: Zone the VM exists in
     :param project: Name of Project
+    :param service: Compute service to use instead of the shared one
+    :param fresh: True to get the instance from the api instead of the cache (ex: to check its status)
     :return: Json object containing information on instance specified
     """
 
     try:
-        logger.info("Getting information for VM %s." % name)
-
-        compute = discovery.build('compute', 'v1', credentials=get_compute_engine_credentials())
-        req = compute.instances().get(project=project, zone=zone, instance=name)
-        response = req.execute()
+        logger.info("Getting information for VM %s.", name)
 
-        return response
+        return inventory.get_inventory(project, zone, service).get(name, fresh)
 
     except Exception as e:
-        logger.debug("Failed: %s" % e)
+        logger.debug("Failed: %s", e)
 
 
-def get_ip_address_of_vm(name, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME):
+def get_ip_address_of_vm(name, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME, service=None):
     """
     Gets the IP address of the instance
 
     :param name: Name of instance as specified on google cloud
     :param zone: Zone the VM exists in
     :param project: Name of Project
+    :param service: Compute service to use instead of the shared one
     :return: IP address of VM specified
     """
     try:
-        logger.info("Getting IP address of VM %s." % name)
+        logger.info("Getting IP address of VM %s.", name)
 
-        compute = discovery.build('compute', 'v1', credentials=get_compute_engine_credentials())
-        req = compute.instances().get(project=project, zone=zone, instance=name)
-        response = req.execute()
+        return inventory.get_inventory(project, zone, service).ip_address(name)
 
-        logger.info("Completed")
+    except Exception as e:
+        logger.debug("Failed: %s", e)
 
-        return response['networkInterfaces'][0]['accessConfigs'][0]['natIP']
 
-    except Exception as e:
-        logger.debug("Failed: %s" % e)
+def _get_startup_script():
+    """
+    :return: Content of startup-script.sh, read from disk once per process
+    """
+    global _startup_script
+    if _startup_script is None:
+        with open(os.path.join(os.path.dirname(__file__), 'startup-script.sh'), 'r') as script:
+            _startup_script = script.read()
+    return _startup_script
 
 
+def _machine_type(num_cores, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME):
+    """
+    :param num_cores: Options: Micro, small, 1, 2, 4, 8, 16, 32
+    :return: Partial url of the machine type
+    """
+    machine = MACHINE_TYPES.get(str(num_cores).lower())
+    if machine is None:
+        raise ValueError("Unsupported number of cores: %s" % num_cores)
+    return 'projects/%s/zones/%s/machineTypes/%s' % (project, zone, machine)
+
+
+def _instance_config(name, disk_link, disk_size, machine_type, network, project=PROJECT_NAME, startup_script=None):
+    """
+    Config that specifies specifications of vm
+
+    :param name: Name of VM instance
+    :param disk_link: Partial url of the boot disk
+    :param disk_size: Size of disk
+    :param machine_type: Partial url of the machine type
+    :param network: Name of the network the VM is created under
+    :param project: The project the VM is created under
+    :param startup_script: Content of the startup script of the VM (defaults to startup-script.sh)
+    :return: Body of instances().insert
+    """
+    if startup_script is None:
+        startup_script = _get_startup_script()
+
+    return {
+        'name': name,                          # Name of instance
+        # 'zone': zone,                          # Zone chosen for instance (There are zone quotas)
+        'machineType': machine_type,           # Machine Type for vm (dependent on zone)
+        'description': '',                     # Description for vm instance (Optional)
+        'canIpForward': False,                 # Needed only if we plan to forward routes from instance
+        'networkInterfaces': [                  # Specifies how this interface interacts with internet
+            {
+                'network': "projects/%s/global/networks/%s" % (project, network),  # Default Network access
+                'accessConfigs': [                        # Array of configurations for the interface
+                    {'type': 'ONE_TO_ONE_NAT',            # Only option available
+                     'name': 'External NAT'}              # Name can be anything
+                                                          # Can also specify natIP or left blank
+                ],
+            }
+        ],
+        'metadata': {
+            "items": [
+                {
+                    'key': 'startup-script',
+                    'value': startup_script
+                },
+                {
+                    'key': 'vm_name',
+                    'value': name
+                },
+                # {
+                #     'key': 'vm_start_time',              #Can be used to figure out cost of running vm
+                #     'value': START
+                # },
+                {
+                    'key': 'vm_disk_size',
+                    'value': disk_size
+                },
+                {
+                    'key': 'vm_machine_type',
+                    'value': machine_type
+                }
+            ]
+        },
+        'tags': {
+            "items": [
+                "http-server",
+                "https-server"
+            ]
+        },
+        'disks': [                              # Lists an array of disks associated with this instance
+            {
+                "index": 0,                     # Index of disk attached with vm (can be more than one)
+                "type": 'PERSISTENT',           # Can be SCRATCH or PERSISTENT (default = PERSISTENT)
+                "mode": 'READ_WRITE',           # Can be READ_WRITE (default) or READ_ONLY
+                "source": disk_link,            # Specifies a valid partial or full URL to an existing
+                                                #    Persistent Disk resource. This field is only
+                                                #    applicable for persistent disks when creating from existing
+                "deviceName": name,
+                "boot": True,                   # Indicates that this is boot disk
+                # "initializeParams": {           # Parameters for this disk
+                #    "sourceImage": disk_image,  # Disk image you want to use (can be custom image)
+                #    "diskSizeGb": 10,    # Size of disk
+                #    "diskType": disk_type       # Disk type to use to create instance
+                # },                              #   can be pd-standard, pd-ssd, local-ssd
+                "autoDelete": True,
+            }
+        ],
+        'serviceAccounts': [
+            {
+                'email': 'default',
+                'scopes':
+                [
+                    'https://www.googleapis.com/auth/devstorage.read_write',
+                    'https://www.googleapis.com/auth/logging.write'
+                ]
+            }
+        ],
+    }
+
+
+def _created_instance(config, operation):
+    """
+    Instance resource known once its insert operation is done, put in the inventory instead of fetching it again.
+    It has no status (nor ephemeral IP address) until it is fetched from the api
+
+    :param config: Body of instances().insert
+    :param operation: Operation resource of the insert
+    :return: Instance resource
+    """
+    return dict(config, id=operation.get('targetId'), selfLink=operation.get('targetLink'), zone=operation.get('zone'))
+
+
+@metrics.timed('compute.create_instance')
 def create_instance(name, disk_size, source_image=None, num_cores=2, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME,
-                    network=NETWORK_NAME):
+                    network=NETWORK_NAME, service=None, startup_script=None):
     """
     Creates vm_instances with disks that hold ftp distributor and retriever code.
 
     :param name: Name of VM instance
     :param disk_size: Size of disk
+    :param source_image: Image of the boot disk (defaults to DEFAULT_SOURCE_IMAGE)
     :param num_cores: Number of cores you want the VM to have.
                       Options: Micro, small, 1, 2, 4, 8, 16, 32
     :param zone: The zone you want instantiate the VM in
     :param project: The project the VM is created under
     :param network: The network the VM is created under
+    :param service: Compute service to use instead of the shared one
+    :param startup_script: Content of the startup script of the VM (defaults to startup-script.sh)
     :return: True or False
     """
 
     try:
-        logger.info("Creating VM named %s" % name)
-
-        startup_script = open(
-            os.path.join(os.path.dirname(__file__), 'startup-script.sh'), 'r'
-        ).read()
-
-        machine = {
-            'micro': 'f1-micro',
-            'small': 'g1-small',
-                '1': 'n1-standard-1',
-                '2': 'n1-standard-2',
-                '4': 'n1-standard-4',
-                '8': 'n1-standard-8',
-               '16': 'n1-standard-16',
-               '32': 'n1-standard-32'
-        }[str(num_cores)]
-        machine_type = 'projects/%s/zones/%s/machineTypes/%s' % (project, zone, machine)
-
-        disk_image = create_disk_for_vm(name, "global/images/remotex-image-testing", disk_size)
+        logger.info("Creating VM named %s", name)
+
+        machine_type = _machine_type(num_cores, zone, project)
+
+        disk_image = create_disk_for_vm(name, source_image or DEFAULT_SOURCE_IMAGE, disk_size, zone, project, service)
 
         # Use this if you want to create vm directly from VM
         # disk_image = 'projects/skywatch-app/global/images/remotex-image'
@@ -170,151 +317,310 @@ def create_instance(name, disk_size, source_image=None, num_cores=2, zone=DEFAUL
         if disk_image is False:
             return False
 
-        network = "projects/%s/global/networks/%s" % (project, network)
+        config = _instance_config(name, disk_image, disk_size, machine_type, network, project, startup_script)
 
-        # Config that specifies specifications of vm
-        config = {
-            'name': name,                          # Name of instance
-            # 'zone': zone,                          # Zone chosen for instance (There are zone quotas)
-            'machineType': machine_type,           # Machine Type for vm (dependent on zone)
-            'description': '',                     # Description for vm instance (Optional)
-            'canIpForward': False,                 # Needed only if we plan to forward routes from instance
-            'networkInterfaces': [                  # Specifies how this interface interacts with internet
-                {
-                    'network': network,                       # Default Network access
-                    'accessConfigs': [                        # Array of configurations for the interface
-                        {'type': 'ONE_TO_ONE_NAT',            # Only option available
-                         'name': 'External NAT'}              # Name can be anything
-                                                              # Can also specify natIP or left blank
-                    ],
-                }
-            ],
-            'metadata': {
-                "items": [
-                    {
-                        'key': 'startup-script',
-                        'value': startup_script
-                    },
-                    {
-                        'key': 'vm_name',
-                        'value': name
-                    },
-                    # {
-                    #     'key': 'vm_start_time',              #Can be used to figure out cost of running vm
-                    #     'value': START
-                    # },
-                    {
-                        'key': 'vm_disk_size',
-                        'value': disk_size
-                    },
-                    {
-                        'key': 'vm_machine_type',
-                        'value': machine_type
-                    }
-                ]
-            },
-            'tags': {
-                "items": [
-                    "http-server",
-                    "https-server"
-                ]
-            },
-            'disks': [                              # Lists an array of disks associated with this instance
-                {
-                    "index": 0,                     # Index of disk attached with vm (can be more than one)
-                    "type": 'PERSISTENT',           # Can be SCRATCH or PERSISTENT (default = PERSISTENT)
-                    "mode": 'READ_WRITE',           # Can be READ_WRITE (default) or READ_ONLY
-                    "source": disk_image,             # Specifies a valid partial or full URL to an existing
-                                                    #    Persistent Disk resource. This field is only
-                                                    #    applicable for persistent disks when creating from existing
-                    "deviceName": name,
-                    "boot": True,                   # Indicates that this is boot disk
-                    # "initializeParams": {           # Parameters for this disk
-                    #    "sourceImage": disk_image,  # Disk image you want to use (can be custom image)
-                    #    "diskSizeGb": 10,    # Size of disk
-                    #    "diskType": disk_type       # Disk type to use to create instance
-                    # },                              #   can be pd-standard, pd-ssd, local-ssd
-                    "autoDelete": True,
-                }
-            ],
-            'serviceAccounts': [
-                {
-                    'email': 'default',
-                    'scopes':
-                    [
-                        'https://www.googleapis.com/auth/devstorage.read_write',
-                        'https://www.googleapis.com/auth/logging.write'
-                    ]
-                }
-            ],
-        }
-
-        compute = discovery.build('compute', 'v1', credentials=get_compute_engine_credentials())
+        compute = get_compute_service(service)
         req = compute.instances().insert(project=project, zone=zone, body=config)
-        resp = req.execute()
+        resp = req.execute(num_retries=NUM_RETRIES)
 
-        wait_for_operation(project, zone, resp['name'])
+        wait_for_operation(project, zone, resp['name'], compute)
+        inventory.put(_created_instance(config, resp), project, zone)
 
-        logger.debug("Completed creating VM named %s." % name)
+        logger.debug("Completed creating VM named %s.", name)
 
         return True
 
     except Exception as e:
-        logger.debug("Unable to create instance: %s" % e)
+        logger.debug("Unable to create instance: %s", e)
         print(("Unable to create instance: %s" % e))
         return False
 
 
-def delete_instance(name, zone=DEFAULT_VM_ZONE):
+@metrics.timed('compute.create_instances')
+def create_instances(specs, max_concurrency=FLEET_CONCURRENCY, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME,
+                     network=NETWORK_NAME, service=None, timeout=OPERATION_TIMEOUT, startup_script=None):
+    """
+    Creates a fleet of vm_instances. Disks are inserted concurrently and each VM is inserted as soon as its own disk
+    is ready, with a single polling loop for every operation.
+
+    :param specs: List of dicts with the create_instance arguments of each VM:
+                  name, disk_size and optionally source_image, num_cores
+    :param max_concurrency: Maximum number of instances being created at the same time (keep it under zone quotas)
+    :param zone: The zone you want instantiate the VMs in
+    :param project: The project the VMs are created under
+    :param network: The network the VMs are created under
+    :param service: Compute service to use instead of the shared one
+    :param timeout: Deadline (sec) of each disk and VM operation
+    :param startup_script: Content of the startup script of the VMs (defaults to startup-script.sh)
+    :return: Dict of VM name to InstanceReport
+    """
+    logger.info("Creating %d VMs", len(specs))
+
+    compute = get_compute_service(service)
+    waiter = OperationWaiter(compute, timeout)
+    slots = threading.BoundedSemaphore(max_concurrency)
+    finished = threading.Semaphore(0)
+    started = {}
+    reports = {}
+
+    def finish(name, disk, error):
+        if error is not None:
+            logger.debug("Unable to create instance %s: %s", name, error)
+        reports[name] = InstanceReport(name, error is None, disk, error, time.time() - started[name])
+        slots.release()
+        finished.release()
+
+    def delete_disk(name):
+        # Free the name of the disk (and stop paying for it), so creating the instance again does not fail on it
+        try:
+            compute.disks().delete(project=project, zone=zone, disk=name).execute()
+        except Exception as e:
+            logger.debug("Unable to delete disk of instance %s: %s", name, e)
+
+    def insert_vm(name, disk, config):
+        try:
+            resp = compute.instances().insert(project=project, zone=zone, body=config).execute(num_retries=NUM_RETRIES)
+        except Exception as e:
+            delete_disk(name)
+            finish(name, disk, e)
+            return
+
+        def vm_ready(result, error):
+            if error is not None:
+                delete_disk(name)
+            else:
+                inventory.put(_created_instance(config, resp), project, zone)
+            finish(name, disk, error)
+
+        waiter.add(project, zone, resp, callback=vm_ready)
+
+    def insert_disk(spec):
+        name = spec['name']
+        try:
+            machine_type = _machine_type(spec.get('num_cores', 2), zone, project)
+            script = _get_startup_script() if startup_script is None else startup_script
+            body = {
+                'name': name,
+                'description': '',
+                'sizeGb': spec['disk_size'],
+                'sourceImage': spec.get('source_image') or DEFAULT_SOURCE_IMAGE,
+            }
+            resp = compute.disks().insert(project=project, zone=zone, body=body).execute(num_retries=NUM_RETRIES)
+        except Exception as e:
+            finish(name, None, e)
+            return
+
+        disk = resp['targetLink'].split('/v1/')[1]
+        config = _instance_config(name, disk, spec['disk_size'], machine_type, network, project, script)
+
+        def disk_ready(result, error):
+            if error is not None:
+                finish(name, None, error)
+            else:
+                pool.submit(insert_vm, name, disk, config)
+
+        waiter.add(project, zone, resp, callback=disk_ready)
+
+    polling = threading.Thread(target=waiter.wait, kwargs={'stop_when_idle': False})
+    polling.daemon = True
+    polling.start()
+
+    pool = ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        for spec in specs:
+            slots.acquire()
+            started[spec['name']] = time.time()
+            pool.submit(insert_disk, spec)
+        for _ in specs:
+            finished.acquire()
+    finally:
+        waiter.stop()
+        pool.shutdown()
+
+    logger.info("Created %d of %d VMs", sum(1 for report in reports.values() if report.created), len(specs))
+    return reports
+
+
+@metrics.timed('compute.delete_instance')
+def delete_instance(name, zone=DEFAULT_VM_ZONE, service=None):
     """
     Deletes VM instance on Google Cloud compute Engine
 
     :param name: Name of VM instance you want to delete
     :param zone: Zone of VM instance you want to delete
+    :param service: Compute service to use instead of the shared one
     :return: True or False
     """
     try:
-        logger.info("Deleting VM named %s." % name)
+        logger.info("Deleting VM named %s.", name)
 
-        compute = discovery.build('compute', 'v1', credentials=get_compute_engine_credentials())
+        compute = get_compute_service(service)
         req = compute.instances().delete(project=PROJECT_NAME, zone=zone, instance=name)
         response = req.execute()
 
-        wait_for_operation(PROJECT_NAME, zone, response['name'])
+        wait_for_operation(PROJECT_NAME, zone, response['name'], compute)
+        inventory.remove(name, PROJECT_NAME, zone)
 
         logger.info('Deletion successful!')
 
         return True
 
     except Exception as e:
-        logger.debug("Deletion of VM %s failed: %s" % e)
+        logger.debug("Deletion of VM %s failed: %s", name, e)
+        return False
+
+
+@metrics.timed('compute.delete_instances')
+def delete_instances(names, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME, service=None,
+                     max_concurrency=FLEET_CONCURRENCY, timeout=OPERATION_TIMEOUT):
+    """
+    Deletes many VM instances, issuing the deletes concurrently and waiting for all of them together
+
+    :param names: Names of the VM instances you want to delete
+    :param zone: Zone of the VM instances
+    :param project: Name of Project
+    :param service: Compute service to use instead of the shared one
+    :param max_concurrency: Number of delete requests issued at the same time
+    :param timeout: Deadline (sec) of each delete operation
+    :return: Dict of name to BatchItem, result being True if deleted and False if the VM did not exist
+    """
+    logger.info("Deleting %d VMs", len(names))
+
+    compute = get_compute_service(service)
+    waiter = OperationWaiter(compute, timeout)
+    results = {}
+
+    def delete(name):
+        try:
+            resp = compute.instances().delete(project=project, zone=zone, instance=name).execute()
+        except HttpError as e:
+            if e.resp.status != 404:
+                results[name] = BatchItem(None, e)
+                return
+            inventory.remove(name, project, zone)
+            results[name] = BatchItem(False, None)
+            return
+        except Exception as e:
+            results[name] = BatchItem(None, e)
+            return
+
+        def deleted(result, error):
+            if error is None:
+                inventory.remove(name, project, zone)
+            results[name] = BatchItem(True if error is None else None, error)
+
+        waiter.add(project, zone, resp, callback=deleted)
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        list(pool.map(delete, names))
+    waiter.wait()
+
+    for name, item in results.items():
+        if item.error is not None:
+            logger.debug("Deletion of VM %s failed: %s", name, item.error)
+    return results
+
+
+@metrics.timed('compute.start_instance')
+def start_instance(name, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME, service=None):
+    """
+    Starts a stopped VM instance
+
+    :param name: Name of VM instance you want to start
+    :param zone: Zone of VM instance
+    :param project: Name of Project
+    :param service: Compute service to use instead of the shared one
+    :return: True or False
+    """
+    try:
+        logger.info("Starting VM named %s.", name)
+
+        compute = get_compute_service(service)
+        response = compute.instances().start(project=project, zone=zone, instance=name).execute()
+
+        wait_for_operation(project, zone, response['name'], compute)
+        inventory.invalidate(name, project, zone)
+
+        return True
+
+    except Exception as e:
+        logger.debug("Unable to start VM %s: %s", name, e)
         return False
 
 
-def wait_for_operation(project, zone, operation):
+@metrics.timed('compute.stop_instance')
+def stop_instance(name, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME, service=None):
+    """
+    Stops (terminates) a VM instance, keeping its disk
+
+    :param name: Name of VM instance you want to stop
+    :param zone: Zone of VM instance
+    :param project: Name of Project
+    :param service: Compute service to use instead of the shared one
+    :return: True or False
+    """
+    try:
+        logger.info("Stopping VM named %s.", name)
+
+        compute = get_compute_service(service)
+        response = compute.instances().stop(project=project, zone=zone, instance=name).execute()
+
+        wait_for_operation(project, zone, response['name'], compute)
+        inventory.invalidate(name, project, zone)
+
+        return True
+
+    except Exception as e:
+        logger.debug("Unable to stop VM %s: %s", name, e)
+        return False
+
+
+@metrics.timed('compute.set_instance_metadata')
+def set_instance_metadata(name, metadata, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME, service=None):
+    """
+    Sets metadata keys of a VM instance, keeping its other keys
+
+    :param name: Name of VM instance
+    :param metadata: Dict of metadata key to value
+    :param zone: Zone of VM instance
+    :param project: Name of Project
+    :param service: Compute service to use instead of the shared one
+    :return: True or False
+    """
+    try:
+        compute = get_compute_service(service)
+        current = compute.instances().get(project=project, zone=zone, instance=name).execute().get('metadata', {})
+
+        items = [item for item in current.get('items', []) if item['key'] not in metadata]
+        items.extend({'key': key, 'value': value} for key, value in sorted(metadata.items()))
+        # The fingerprint makes the call fail instead of overwriting a concurrent change
+        body = {'fingerprint': current.get('fingerprint'), 'items': items}
+        response = compute.instances().setMetadata(project=project, zone=zone, instance=name, body=body).execute()
+
+        wait_for_operation(project, zone, response['name'], compute)
+        inventory.invalidate(name, project, zone)
+
+        return True
+
+    except Exception as e:
+        logger.debug("Unable to set metadata of VM %s: %s", name, e)
+        return False
+
+
+def wait_for_operation(project, zone, operation, service=None, timeout=OPERATION_TIMEOUT):
     """
     Checks if operation demanded (create/start/stop/delete) is completed
 
     :param project: Project name on google cloud
     :param zone: zone the vm_instance resides in
     :param operation: which operation is being run
-    :return: True when completed
+    :param service: Compute service to use instead of the shared one
+    :param timeout: Seconds to wait before raising OperationTimeout
+    :return: 'DONE' when completed, raises OperationError if the operation failed
     """
-    logger.debug('Waiting for operation to finish...')
-
-    while True:
-        try:
-            compute = discovery.build('compute', 'v1', credentials=get_compute_engine_credentials())
-            req = compute.zoneOperations().get(
-                project=project,
-                zone=zone,
-                operation=operation
-            )
-            result = req.execute()
-
-            if result['status'] == 'DONE':
-                return result['status']
-
-            time.sleep(1)
-        except Exception as e:
-            logger.debug('Checking if operation is completed failed: %s' % e)
+    waiter = OperationWaiter(service, timeout)
+    key = waiter.add(project, zone, operation)
+    result, error = waiter.wait()[key]
+    if error is not None:
+        raise error
+    return result['status']
@@ -0,0 +1,388 @@
+"""
+Name: Warm pool
+
+Purpose: Keep pre-provisioned google cloud virtual machines of each machine type stopped (or idle) and ready, so
+         acquiring a VM only costs setting its metadata and starting it, instead of creating a disk from an image and
+         booting a new VM. The pool is refilled in the background and idle VMs are deleted after a TTL. VMs a previous
+         process left behind under the same prefix are adopted (or deleted) when the pool starts
+"""
+
+import threading
+import time
+import uuid
+
+from collections import deque
+from clients import get_compute_service
+from config import logger, PROJECT_NAME, NETWORK_NAME
+from operations import wait_for_operations
+from vm_manager import DEFAULT_VM_ZONE, FLEET_CONCURRENCY, MACHINE_TYPES, create_instances, delete_instances, \
+    list_vm_instances, set_instance_metadata, start_instance, stop_instance
+
+
+IDLE_TTL = 1800         # Seconds before an idle VM above the pool size, or of a machine type not acquired, is deleted
+MAX_IDLE = 10           # Maximum number of idle VMs of one machine type, VMs released above it are deleted
+REFILL_INTERVAL = 30    # Seconds between two refills of the pool by the background thread
+POOL_PREFIX = 'warm'    # Prefix of the names of the VMs created by the pool
+
+
+class WarmPool(object):
+    """
+    Pool of idle VMs per machine type (the keys of vm_manager.MACHINE_TYPES: micro, small, 1, 2, 4, 8, 16, 32).
+
+    A machine type that is not acquired for a TTL drains to zero idle VMs and is refilled again on its next acquire,
+    so the pool does not pay for idle VMs nobody uses.
+    """
+
+    def __init__(self, sizes, disk_size, source_image=None, zone=DEFAULT_VM_ZONE, project=PROJECT_NAME,
+                 network=NETWORK_NAME, service=None, keep_running=False, ttl=IDLE_TTL, max_idle=MAX_IDLE,
+                 refill_interval=REFILL_INTERVAL, max_concurrency=FLEET_CONCURRENCY, prefix=POOL_PREFIX):
+        """
+        :param sizes: Dict of machine type (ex: 'micro', 2) to number of idle VMs to keep ready
+        :param disk_size: Size of the disk of the VMs
+        :param source_image: Image of the boot disks (defaults to vm_manager.DEFAULT_SOURCE_IMAGE)
+        :param zone: The zone of the VMs
+        :param project: The project the VMs are created under
+        :param network: The network the VMs are created under
+        :param service: Compute service to use instead of the shared one
+        :param keep_running: Keep idle VMs running (faster acquire) instead of stopped (only the disk is billed)
+        :param ttl: Seconds before an idle VM above the pool size is deleted
+        :param max_idle: Maximum number of idle VMs of one machine type
+        :param refill_interval: Seconds between two refills by the background thread
+        :param max_concurrency: Maximum number of VMs created at the same time
+        :param prefix: Prefix of the names of the VMs created by the pool
+        """
+        self.sizes = dict((str(key).lower(), size) for key, size in sizes.items())
+        for key in self.sizes:
+            if key not in MACHINE_TYPES:
+                raise ValueError("Unsupported machine type: %s" % key)
+
+        self.disk_size = disk_size
+        self.source_image = source_image
+        self.zone = zone
+        self.project = project
+        self.network = network
+        self.service = service
+        self.keep_running = keep_running
+        self.ttl = ttl
+        self.max_idle = max_idle
+        self.refill_interval = refill_interval
+        self.max_concurrency = max_concurrency
+        self.prefix = prefix
+
+        now = time.time()
+        self._idle = dict((key, deque()) for key in self.sizes)     # (name, idle since), most recent on the right
+        self._creating = dict.fromkeys(self.sizes, 0)
+        self._last_acquired = dict.fromkeys(self.sizes, now)
+        self._leased = {}                                           # Name of acquired VM to its machine type
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._refilling = threading.Lock()
+        self._closed = False
+        self._thread = None
+
+    def start(self):
+        """
+        Start refilling and reaping the pool in a background thread, which first adopts the VMs left under the prefix
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='warm-pool')
+                self._thread.daemon = True
+                self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self.adopt()
+        except Exception as e:
+            logger.debug("Adoption of the VMs left in the warm pool failed: %s", e)
+
+        while True:
+            try:
+                self.reap()
+                self.refill()
+            except Exception as e:
+                logger.debug("Maintenance of the warm pool failed: %s", e)
+
+            with self._lock:
+                if not self._closed:
+                    self._wakeup.wait(self.refill_interval)
+                if self._closed:
+                    return
+
+    def idle(self, num_cores=None):
+        """
+        :param num_cores: Machine type, None for every machine type
+        :return: Number of idle VMs
+        """
+        with self._lock:
+            if num_cores is not None:
+                return len(self._idle[str(num_cores).lower()])
+            return sum(len(idle) for idle in self._idle.values())
+
+    def _new_name(self, key):
+        return '%s-%s-%s' % (self.prefix, key, uuid.uuid4().hex[:12])
+
+    def _stop_all(self, names):
+        """
+        Stop VMs together
+        :return: Names of the VMs stopped
+        """
+        compute = get_compute_service(self.service)
+        pending = {}
+        for name in names:
+            try:
+                resp = compute.instances().stop(project=self.project, zone=self.zone, instance=name).execute()
+                pending[(self.zone, resp['name'])] = name
+            except Exception as e:
+                logger.debug("Unable to stop VM %s: %s", name, e)
+
+        results = wait_for_operations([(self.project, zone, operation) for zone, operation in pending], compute)
+        return [name for key, name in pending.items() if key in results and results[key].error is None]
+
+    def _create(self, keys):
+        """
+        Create idle VMs
+        :param keys: Machine type of each VM to create
+        :return: Dict of name to machine type of the VMs ready to be handed out
+        """
+        specs = [{'name': self._new_name(key), 'disk_size': self.disk_size, 'num_cores': key,
+                  'source_image': self.source_image} for key in keys]
+        reports = create_instances(specs, self.max_concurrency, self.zone, self.project, self.network, self.service)
+
+        created = dict((spec['name'], spec['num_cores']) for spec in specs
+                       if spec['name'] in reports and reports[spec['name']].created)
+        if not self.keep_running and created:
+            stopped = set(self._stop_all(list(created)))
+            broken = [name for name in created if name not in stopped]
+            if broken:
+                delete_instances(broken, self.zone, self.project, self.service)
+            created = dict((name, key) for name, key in created.items() if name in stopped)
+        return created
+
+    def _key_of(self, name):
+        """
+        :return: Machine type in the name of a VM of the pool, None if the name is not one of the pool
+        """
+        if not name.startswith(self.prefix + '-'):
+            return None
+        return name[len(self.prefix) + 1:].rpartition('-')[0] or None
+
+    def adopt(self):
+        """
+        Put back in the pool the VMs a previous process (ex: one that crashed) created under the prefix, so they are
+        handed out or reaped like the others. VMs of a machine type the pool does not keep, or in an unexpected state,
+        are deleted
+        :return: Number of VMs adopted
+        """
+        listed = list_vm_instances(self.project, self.zone, self.service, refresh=True)
+        if listed is None:
+            raise RuntimeError("Unable to list the instances of zone %s" % self.zone)
+
+        with self._lock:
+            known = set(self._leased)
+            known.update(name for idle in self._idle.values() for name, _ in idle)
+
+        ready = {}
+        running = {}
+        unwanted = []
+        for instance in listed['items']:
+            name = instance['name']
+            key = self._key_of(name)
+            if key is None or name in known:
+                continue
+            status = instance.get('status')
+            if key not in self.sizes:
+                unwanted.append(name)
+            elif status == ('RUNNING' if self.keep_running else 'TERMINATED'):
+                ready[name] = key
+            elif status == 'RUNNING':
+                running[name] = key
+            else:
+                unwanted.append(name)
+
+        if running:
+            stopped = set(self._stop_all(list(running)))
+            unwanted.extend(name for name in running if name not in stopped)
+            ready.update((name, key) for name, key in running.items() if name in stopped)
+
+        if unwanted:
+            logger.info("Deleting %d VMs left in the warm pool", len(unwanted))
+            delete_instances(unwanted, self.zone, self.project, self.service)
+
+        now = time.time()
+        with self._lock:
+            for name, key in ready.items():
+                self._idle[key].appendleft((name, now))
+        if ready:
+            logger.info("Adopted %d VMs left in the warm pool", len(ready))
+        return len(ready)
+
+    def refill(self):
+        """
+        Create the VMs missing for each machine type acquired within the TTL to reach its pool size
+        :return: Number of VMs added to the pool
+        """
+        with self._refilling:
+            now = time.time()
+            keys = []
+            with self._lock:
+                for key, size in self.sizes.items():
+                    if self._closed or now - self._last_acquired[key] >= self.ttl:
+                        continue
+                    missing = size - len(self._idle[key]) - self._creating[key]
+                    if missing > 0:
+                        self._creating[key] += missing
+                        keys.extend([key] * missing)
+
+            if not keys:
+                return 0
+
+            logger.info("Refilling warm pool with %d VMs", len(keys))
+            try:
+                created = self._create(keys)
+            finally:
+                with self._lock:
+                    for key in keys:
+                        self._creating[key] -= 1
+
+            now = time.time()
+            with self._lock:
+                closed = self._closed
+                if not closed:
+                    for name, key in created.items():
+                        self._idle[key].append((name, now))
+            if closed and created:
+                delete_instances(list(created), self.zone, self.project, self.service)
+                return 0
+            return len(created)
+
+    def reap(self):
+        """
+        Delete the VMs idle for longer than the TTL, above the pool size (or all of them for a machine type that was
+        not acquired within the TTL)
+        :return: Number of VMs deleted
+        """
+        now = time.time()
+        expired = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                keep = self.sizes[key] if now - self._last_acquired[key] < self.ttl else 0
+                # Oldest VMs are on the left
+                while len(idle) > keep and idle[0][1] + self.ttl <= now:
+                    expired.append(idle.popleft()[0])
+
+        if expired:
+            logger.info("Reaping %d idle VMs", len(expired))
+            delete_instances(expired, self.zone, self.project, self.service)
+        return len(expired)
+
+    def _activate(self, name, metadata):
+        if metadata and not set_instance_metadata(name, metadata, self.zone, self.project, self.service):
+            return False
+        if not self.keep_running:
+            return start_instance(name, self.zone, self.project, self.service)
+        return True
+
+    def acquire(self, num_cores, metadata=None):
+        """
+        Get a running VM, from the pool when it has one, created on the spot otherwise
+        :param num_cores: Machine type of the VM
+        :param metadata: Dict of metadata key to value set on the VM before it is started
+        :return: Name of the VM, None if no VM could be acquired
+        """
+        key = str(num_cores).lower()
+        if key not in MACHINE_TYPES:
+            raise ValueError("Unsupported machine type: %s" % num_cores)
+
+        with self._lock:
+            if key in self._last_acquired:
+                self._last_acquired[key] = time.time()
+            self._wakeup.notify_all()
+
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                name = idle.pop()[0]
+                self._leased[name] = key
+                if len(idle) < self.sizes[key]:
+                    self._wakeup.notify_all()
+
+            if self._activate(name, metadata):
+                logger.info("Acquired VM %s from the warm pool", name)
+                return name
+
+            logger.debug("Dropping VM %s from the warm pool", name)
+            with self._lock:
+                self._leased.pop(name, None)
+            delete_instances([name], self.zone, self.project, self.service)
+
+        # Nothing idle: pay for a cold start
+        logger.info("Warm pool of machine type %s is empty", key)
+        name = self._new_name(key)
+        report = create_instances([{'name': name, 'disk_size': self.disk_size, 'num_cores': key,
+                                    'source_image': self.source_image}],
+                                  1, self.zone, self.project, self.network, self.service).get(name)
+        if report is None or not report.created:
+            return None
+        if metadata and not set_instance_metadata(name, metadata, self.zone, self.project, self.service):
+            delete_instances([name], self.zone, self.project, self.service)
+            return None
+
+        with self._lock:
+            self._leased[name] = key
+        return name
+
+    def release(self, name, reuse=True):
+        """
+        Give back an acquired VM, which is stopped and put back in the pool if it has room, deleted otherwise
+        :param name: Name of the VM
+        :param reuse: False to delete the VM (ex: its state can not be trusted anymore)
+        :return: True if the VM went back to the pool, False if it was deleted or not leased by the pool
+        """
+        with self._lock:
+            if name not in self._leased:
+                # Released twice, or a VM of something else: deleting it would lose a VM that is not ours to delete
+                logger.info("Ignoring release of VM %s, which the warm pool did not lease", name)
+                return False
+            key = self._leased.pop(name)
+            room = (reuse and key in self._idle and not self._closed and
+                    len(self._idle[key]) + self._creating[key] < self.max_idle)
+
+        if room and (self.keep_running or stop_instance(name, self.zone, self.project, self.service)):
+            with self._lock:
+                if not self._closed:
+                    self._idle[key].append((name, time.time()))
+                    return True
+
+        delete_instances([name], self.zone, self.project, self.service)
+        return False
+
+    def close(self, delete=True):
+        """
+        Stop the background thread
+        :param delete: Delete the idle VMs (acquired VMs are left alone)
+        """
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify_all()
+            thread = self._thread
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+        with self._lock:
+            names = [name for idle in self._idle.values() for name, _ in idle]
+            for idle in self._idle.values():
+                idle.clear()
+
+        if delete and names:
+            delete_instances(names, self.zone, self.project, self.service)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()